@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+#
+# Bounded admission queue in front of a concurrent.futures executor
+#
+# The executors' own work queues are unbounded, so a burst of requests piles up
+# futures with no visibility. An AdmissionQueue keeps at most `workers` jobs inside
+# the executor and at most `limit` jobs waiting in front of it. Anything beyond
+# that is refused immediately with QueueFull, which carries a retry-after hint the
+# caller can hand back to the client.
+#
+# Work nobody is waiting for any more is not run: a job can have owners (the
+# clients waiting on it) and a deadline. When its last owner goes away or the
+# deadline passes, a queued job is dropped and a running one is asked to stop
+# through its cancel_event, if the work checks one. Either way the job's future
+# fails with Cancelled / DeadlineExceeded straight away. The executor time this
+# saves (estimated from the average run time) and the time spent on results
+# nobody got are counted.
+#
+# Waiting jobs are served by priority class, then round robin between their
+# owners, see scheduler.py. `owner_limit` caps the jobs one owner can have waiting.
+#
+# All methods must be called from the event loop thread.
+#
+
+import time
+import math
+import asyncio
+import functools
+
+import scheduler
+
+
+class QueueFull(Exception):
+    '''
+    Raised by AdmissionQueue.submit() when no more work can be admitted
+    '''
+
+    def __init__(self, name, depth, retry_after):
+        super().__init__("{} queue full ({} waiting), retry after {}s".format(name, depth, retry_after))
+        self.name = name
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+class Cancelled(Exception):
+    '''
+    Set on a job's future when the job was cancelled before it finished
+    '''
+
+
+class DeadlineExceeded(Cancelled):
+    '''
+    Set on a job's future when its deadline passed before it finished
+    '''
+
+
+class Job:
+    '''
+    A unit of work waiting for, or running in, an executor
+    '''
+
+    def __init__(self, fn, args, future, depth, queue=None, owner=None, priority=scheduler.INTERACTIVE):
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.depth = depth # jobs already waiting when this one was admitted
+        self.queue = queue # the AdmissionQueue that admitted it
+        self.submitted_on = time.monotonic()
+        self.started_on = None
+        self.finished_on = None
+        self.on_start = None # called with the job when it is handed to the executor
+        self.owner = owner # who submitted it, for scheduling
+        self.priority = priority
+        self.owners = set() # everyone waiting for it
+        self.deadline = None # time.monotonic() value
+        self.cancel_event = None # threading.Event the work checks, if it can stop early
+        self.cancelled = False
+        self.expiry = None # asyncio.TimerHandle of the deadline
+
+    @property
+    def queue_wait(self):
+        '''
+        Seconds spent waiting for a worker (so far, if still queued)
+        '''
+        return (self.started_on or time.monotonic()) - self.submitted_on
+
+    @property
+    def run_time(self):
+        '''
+        Seconds spent in the executor, None if not finished
+        '''
+        if self.started_on is None or self.finished_on is None:
+            return None
+        return self.finished_on - self.started_on
+
+
+class AdmissionQueue:
+    '''
+    Admit at most `limit` waiting jobs in front of an executor with `workers` workers
+    '''
+
+    # weight of the newest sample in the run time moving average
+    ewma_weight = 0.2
+
+    def __init__(self, executor, workers, limit, retry_after=None, name="executor", owner_limit=None):
+        '''
+        :executor concurrent.futures.Executor
+        :workers int Jobs handed to the executor at once, normally its max_workers.
+        :limit int Maximum number of jobs waiting for a worker.
+        :retry_after int Fixed retry-after in seconds, None to estimate it from the queue.
+        :name string Used in logs and stats.
+        :owner_limit int Maximum number of jobs one owner can have waiting, None for limit.
+        '''
+        self.executor = executor
+        self.workers = workers
+        self.limit = limit
+        self.retry_after = retry_after
+        self.name = name
+        self.owner_limit = owner_limit
+
+        self.pending = scheduler.FairQueue()
+        self.running = 0
+
+        self.owned = {} # owner -> set of its unfinished jobs
+
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.avg_run_time = None
+        self.avg_queue_wait = 0.0
+
+        self.dropped = 0 # cancelled while queued, never ran
+        self.stopped = 0 # asked to stop while running
+        self.expired = 0 # deadline passed
+        self.saved_secs = 0.0 # estimated executor time not spent on dropped / stopped jobs
+        self.wasted_secs = 0.0 # executor time spent on jobs cancelled too late to stop
+
+    @property
+    def depth(self):
+        '''
+        Number of jobs waiting for a worker
+        '''
+        return len(self.pending)
+
+    def estimate_retry_after(self):
+        '''
+        Seconds until a new job would likely be admitted
+
+        :return int
+        '''
+        if self.retry_after is not None:
+            return self.retry_after
+
+        run_time = self.avg_run_time or 1.0
+
+        # the whole backlog has to drain through `workers` workers
+        return max(1, math.ceil(run_time * (self.depth / self.workers + 1)))
+
+    def submit(self, fn, *args, owner=None, deadline=None, cancel_event=None, priority=scheduler.INTERACTIVE):
+        '''
+        Admit fn(*args) for execution.
+
+        :fn callable Run in the executor.
+        :owner Who waits for the result, e.g. a sid. See cancel_owner().
+        :priority int scheduler.INTERACTIVE or scheduler.BATCH.
+        :deadline float Seconds the job may take, queued and running, None for no limit.
+        :cancel_event threading.Event Set to ask running work to stop, if fn checks it.
+        :return Job Await job.future for the result.
+        :raises QueueFull
+        '''
+        if self.running >= self.workers and len(self.pending) >= self.limit:
+            self.rejected += 1
+            raise QueueFull(self.name, len(self.pending), self.estimate_retry_after())
+
+        if self.owner_limit is not None and owner is not None and self.pending.depth_of(owner) >= self.owner_limit:
+            self.rejected += 1
+            raise QueueFull(self.name, self.pending.depth_of(owner), self.estimate_retry_after())
+
+        loop = asyncio.get_event_loop()
+        job = Job(fn, args, loop.create_future(), len(self.pending), self, owner, priority)
+        job.cancel_event = cancel_event
+
+        if owner is not None:
+            self.add_owner(job, owner)
+
+        if deadline is not None:
+            job.deadline = job.submitted_on + deadline
+            job.expiry = loop.call_later(deadline, self._expire, job)
+
+        self.admitted += 1
+        self.pending.append(job)
+        self._dispatch(loop)
+
+        return job
+
+    def add_owner(self, job, owner):
+        '''
+        Another client waits for job, e.g. a coalesced request
+
+        :job Job
+        :owner
+        :return None
+        '''
+        if job.future.done():
+            return
+        job.owners.add(owner)
+        self.owned.setdefault(owner, set()).add(job)
+
+    def cancel_owner(self, owner):
+        '''
+        The owner went away: cancel the jobs nobody else waits for
+
+        :owner
+        :return int Number of jobs cancelled
+        '''
+        count = 0
+        for job in self.owned.pop(owner, ()):
+            job.owners.discard(owner)
+            if not job.owners and self.cancel(job, Cancelled("{} gone".format(owner))):
+                count += 1
+        self.pending.forget(owner)
+        return count
+
+    def cancel(self, job, exc=None):
+        '''
+        Cancel a job: a queued job is dropped, a running one is asked to stop through
+        its cancel_event and its result discarded. job.future fails with exc.
+
+        :job Job
+        :exc Cancelled Default Cancelled("cancelled").
+        :return bool False if the job had already finished
+        '''
+        if job.future.done():
+            return False
+
+        job.cancelled = True
+
+        if job.started_on is None:
+            try:
+                self.pending.remove(job)
+            except ValueError:
+                pass
+            self.dropped += 1
+            self.saved_secs += self.avg_run_time or 0.0
+            self._forget(job)
+        elif job.cancel_event is not None:
+            job.cancel_event.set()
+            self.stopped += 1
+
+        job.future.set_exception(exc or Cancelled("cancelled"))
+        return True
+
+    def _expire(self, job):
+        '''
+        Deadline timer callback
+        '''
+        job.expiry = None
+        if self.cancel(job, DeadlineExceeded("{} job deadline passed".format(self.name))):
+            self.expired += 1
+
+    def _forget(self, job):
+        '''
+        Drop a job that is done with the executor from the owner index and cancel its deadline
+        '''
+        for owner in job.owners:
+            jobs = self.owned.get(owner)
+            if jobs is not None:
+                jobs.discard(job)
+                if not jobs:
+                    del self.owned[owner]
+
+        if job.expiry is not None:
+            job.expiry.cancel()
+            job.expiry = None
+
+    def _dispatch(self, loop):
+        '''
+        Hand waiting jobs to the executor while workers are free
+        '''
+        while self.pending and self.running < self.workers:
+            job = self.pending.popleft()
+
+            # the caller went away while the job was waiting
+            if job.future.done():
+                self._forget(job)
+                continue
+
+            self.running += 1
+            job.started_on = time.monotonic()
+            if job.on_start is not None:
+                job.on_start(job)
+
+            f = loop.run_in_executor(self.executor, job.fn, *job.args)
+            f.add_done_callback(functools.partial(self._finished, loop, job))
+
+    def _finished(self, loop, job, f):
+        '''
+        Executor future done callback
+        '''
+        self.running -= 1
+        self.completed += 1
+        job.finished_on = time.monotonic()
+        self._forget(job)
+
+        w = self.ewma_weight
+        if job.cancelled and job.cancel_event is not None:
+            # stopped early, a short run time says nothing about the work
+            self.saved_secs += max(0.0, (self.avg_run_time or 0.0) - job.run_time)
+        else:
+            if job.cancelled:
+                self.wasted_secs += job.run_time
+            if self.avg_run_time is None:
+                self.avg_run_time = job.run_time
+            else:
+                self.avg_run_time = (1 - w) * self.avg_run_time + w * job.run_time
+        self.avg_queue_wait = (1 - w) * self.avg_queue_wait + w * job.queue_wait
+
+        if not job.future.done():
+            if f.cancelled():
+                job.future.cancel()
+            elif f.exception() is not None:
+                job.future.set_exception(f.exception())
+            else:
+                job.future.set_result(f.result())
+        elif not f.cancelled():
+            f.exception() # nobody is waiting, don't warn about an unretrieved exception
+
+        self._dispatch(loop)
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        return {
+            "name": self.name,
+            "workers": self.workers,
+            "running": self.running,
+            "depth": len(self.pending),
+            "limit": self.limit,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "avg_run_time": self.avg_run_time,
+            "avg_queue_wait": self.avg_queue_wait,
+            "dropped": self.dropped,
+            "stopped": self.stopped,
+            "expired": self.expired,
+            "saved_secs": self.saved_secs,
+            "wasted_secs": self.wasted_secs,
+            "scheduler": self.pending.stats()
+        }
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+#
+# Executor strategy benchmark
+#
+# Grown out of the asyncio_executor_thread/process/combined demos: blocking tasks
+# run through loop.run_in_executor() while a coroutine keeps ticking on the event
+# loop. Instead of a fixed range(6) of time.sleep() tasks this sweeps
+#
+#   pool type x pool size x task count x workload
+#
+# where the workloads are real CPU work (workloads.count_primes), io (a sleep) or
+# both. Each pool is created fresh, so every run also measures its start up.
+#
+# Per run:
+#   tasks_per_sec   tasks / wall time
+#   run_ms          mean time a task spent running in the worker
+#   overhead_ms     per task, worker time not spent running task code:
+#                   (wall * workers - sum(run)) / tasks. Dispatch, pickling, result
+#                   transfer and idle workers all land here.
+#   start_delay_ms  submission to start in the worker, p50 / p99
+#   loop_lag_ms     how late a 10ms ticker on the event loop ran, p99 / max. Thread
+#                   pools running CPU work compete with the loop for the GIL.
+#   startup_ms      creating the pool and getting every worker to run a task
+#
+# A separate transfer test times a round trip of payloads of increasing size
+# through each pool type: the process pool's extra cost is pickling and the pipe.
+# It also times getting a result of each size back, pickled and, for process
+# pools, through a shared memory segment (shm_ms, see shmresult.py).
+#
+# Example:
+#   ./asyncio_executor_bench.py --pools=thread,process --workers=1,2,4 --tasks=8,64 -o executors.json
+#
+
+import os
+import sys
+import json
+import time
+import getopt
+import pickle
+import asyncio
+import logging
+import platform
+import concurrent.futures
+
+import workloads
+import shmresult
+
+#
+# globals
+#
+pools = ["thread", "process"]
+worker_counts = [1, 2, 4]
+task_counts = [8, 64]
+workload_names = ["cpu", "io", "mixed"]
+cpu_size = 20000    # count_primes(n) for cpu work
+io_secs = 0.01      # sleep for io work
+payload_sizes = [0, 10000, 100000, 1000000]
+transfer_rounds = 20
+tick_secs = 0.01
+output = None
+
+EXECUTORS = {
+    "thread": concurrent.futures.ThreadPoolExecutor,
+    "process": concurrent.futures.ProcessPoolExecutor
+}
+
+def usage():
+    program_name = sys.argv[0]
+    print("Usage: {} [options]".format(program_name))
+    print("  -h\tHelp.")
+    print("  -o file\tSave the results as JSON.")
+    print("  --pools=list\tPool types, default {}.".format(",".join(pools)))
+    print("  --workers=list\tPool sizes, default {}.".format(",".join(map(str, worker_counts))))
+    print("  --tasks=list\tTasks per run, default {}.".format(",".join(map(str, task_counts))))
+    print("  --workloads=list\tcpu, io and/or mixed, default {}.".format(",".join(workload_names)))
+    print("  --cpu-size=n\tcount_primes(n) per cpu task, default {}.".format(cpu_size))
+    print("  --io-secs=secs\tSleep per io task, default {}.".format(io_secs))
+    print("  --payloads=list\tTransfer test payload sizes in bytes, default {}, empty to skip.".format(",".join(map(str, payload_sizes))))
+
+#
+# helpers
+#
+
+def percentile(samples, p):
+    '''
+    :samples list sorted
+    :p float 0 - 100
+    :return float None if there are no samples
+    '''
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def ms(secs):
+    return round(secs * 1000, 3) if secs is not None else None
+
+
+def task_for(workload):
+    '''
+    :workload string
+    :return tuple (function, args) to run through workloads.timed()
+    '''
+    if workload == "cpu":
+        return workloads.count_primes, (cpu_size,)
+    if workload == "io":
+        return workloads.sleep_for, (io_secs,)
+    if workload == "mixed":
+        return workloads.cpu_and_sleep, (cpu_size, io_secs)
+    raise ValueError("unknown workload {}".format(workload))
+
+
+def start_pool(kind, workers):
+    '''
+    Create a pool and wait until every worker has run a task
+
+    :return tuple (executor, seconds it took, less the warm up task's own sleep)
+    '''
+    warm_secs = 0.05
+    started = time.perf_counter()
+    executor = EXECUTORS[kind](max_workers=workers)
+    futures = [executor.submit(workloads.warm_up, warm_secs) for i in range(workers)]
+    for f in futures:
+        f.result()
+    return executor, max(0.0, time.perf_counter() - started - warm_secs)
+
+
+async def ticker(lags, stop):
+    '''
+    Sleep tick_secs at a time and record how late each wake up is
+    '''
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        expected = loop.time() + tick_secs
+        await asyncio.sleep(tick_secs)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def run_tasks(executor, fn, args, count):
+    '''
+    Submit count tasks at once while the ticker runs
+
+    :return tuple (wall seconds, list of (submitted, started, finished), loop lags)
+    '''
+    loop = asyncio.get_event_loop()
+    lags = []
+    stop = asyncio.Event()
+    tick = asyncio.ensure_future(ticker(lags, stop))
+
+    started = time.perf_counter()
+    submitted = time.monotonic()
+    futures = [loop.run_in_executor(executor, workloads.timed, fn, *args) for i in range(count)]
+    results = await asyncio.gather(*futures)
+    wall = time.perf_counter() - started
+
+    stop.set()
+    await tick
+
+    return wall, [(submitted, r[0], r[1]) for r in results], lags
+
+
+def run_one(loop, kind, workers, count, workload):
+    '''
+    :return dict
+    '''
+    fn, args = task_for(workload)
+    executor, startup = start_pool(kind, workers)
+
+    try:
+        wall, times, lags = loop.run_until_complete(run_tasks(executor, fn, args, count))
+    finally:
+        executor.shutdown(wait=True)
+
+    run_times = [finished - started for submitted, started, finished in times]
+    delays = sorted(started - submitted for submitted, started, finished in times)
+    lags.sort()
+
+    return {
+        "pool": kind,
+        "workers": workers,
+        "tasks": count,
+        "workload": workload,
+        "tasks_per_sec": round(count / wall, 1),
+        "wall_ms": ms(wall),
+        "run_ms": ms(sum(run_times) / count),
+        "overhead_ms": ms(max(0.0, wall * min(workers, count) - sum(run_times)) / count),
+        "start_delay_ms": {"p50": ms(percentile(delays, 50)), "p99": ms(percentile(delays, 99))},
+        "loop_lag_ms": {"p99": ms(percentile(lags, 99)), "max": ms(lags[-1] if lags else None)},
+        "startup_ms": ms(startup)
+    }
+
+
+def transfer(kind):
+    '''
+    Round trip time of each payload size through a one worker pool
+
+    :return list of dict
+    '''
+    # before the pool forks, see shmresult.py
+    segments = shmresult.SegmentPool(threshold=0, max_size=max(payload_sizes + [1])) if kind == "process" and shmresult.available else None
+    executor, startup = start_pool(kind, 1)
+    results = []
+
+    try:
+        for size in payload_sizes:
+            payload = bytes(size)
+
+            started = time.perf_counter()
+            for i in range(transfer_rounds):
+                executor.submit(workloads.echo_size, payload).result()
+            round_trip = (time.perf_counter() - started) / transfer_rounds
+
+            started = time.perf_counter()
+            for i in range(transfer_rounds):
+                pickle.loads(pickle.dumps(payload))
+            pickling = (time.perf_counter() - started) / transfer_rounds
+
+            started = time.perf_counter()
+            for i in range(transfer_rounds):
+                executor.submit(workloads.make_blob, size).result()
+            result = (time.perf_counter() - started) / transfer_rounds
+
+            shm = None
+            if segments is not None:
+                started = time.perf_counter()
+                for i in range(transfer_rounds):
+                    segment = segments.allocate(size)
+                    stored, length = executor.submit(shmresult.into_segment, segment.name, segments.size_class(size), workloads.make_blob, size).result()
+                    shmresult.SharedResult(segments, segment, length).release()
+                shm = (time.perf_counter() - started) / transfer_rounds
+
+            results.append({"pool": kind, "bytes": size, "round_trip_ms": ms(round_trip), "pickle_ms": ms(pickling),
+                            "result_ms": ms(result), "shm_ms": ms(shm)})
+    finally:
+        executor.shutdown(wait=True)
+        if segments is not None:
+            segments.close()
+
+    return results
+
+
+def report(runs, transfers):
+    print("{:<8} {:>7} {:>6} {:<6} {:>10} {:>9} {:>11} {:>11} {:>11} {:>10}".format(
+        "pool", "workers", "tasks", "load", "tasks/s", "run ms", "overhead ms", "delay p99", "lag p99", "startup ms"))
+    for r in runs:
+        print("{pool:<8} {workers:>7} {tasks:>6} {workload:<6} {tasks_per_sec:>10} {run_ms:>9} {overhead_ms:>11} {delay:>11} {lag:>11} {startup_ms:>10}".format(
+            delay=r["start_delay_ms"]["p99"], lag=r["loop_lag_ms"]["p99"], **r))
+
+    if transfers:
+        print()
+        print("{:<8} {:>9} {:>14} {:>10} {:>10} {:>10}".format("pool", "bytes", "round trip ms", "pickle ms", "result ms", "shm ms"))
+        for t in transfers:
+            print("{pool:<8} {bytes:>9} {round_trip_ms:>14} {pickle_ms:>10} {result_ms:>10} {shm:>10}".format(shm=str(t["shm_ms"]), **t))
+
+#
+# main
+#
+if __name__ == "__main__":
+
+    def int_list(a):
+        return [int(x) for x in a.split(",") if x]
+
+    try:
+       opts, args = getopt.getopt(sys.argv[1:], "ho:", ["help", "pools=", "workers=", "tasks=", "workloads=", "cpu-size=", "io-secs=", "payloads="])
+    except getopt.GetoptError:
+       usage()
+       sys.exit(2)
+
+    if len(args) > 0:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-o":
+            output = a
+        elif o == "--pools":
+            pools = a.split(",")
+        elif o == "--workers":
+            worker_counts = int_list(a)
+        elif o == "--tasks":
+            task_counts = int_list(a)
+        elif o == "--workloads":
+            workload_names = a.split(",")
+        elif o == "--cpu-size":
+            cpu_size = int(a)
+        elif o == "--io-secs":
+            io_secs = float(a)
+        elif o == "--payloads":
+            payload_sizes = int_list(a)
+        elif o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        else:
+            assert False, "unhandled option"
+
+    if any(p not in EXECUTORS for p in pools) or any(w not in ("cpu", "io", "mixed") for w in workload_names):
+        usage()
+        sys.exit(2)
+
+    logging.basicConfig(level=logging.INFO, format='PID %(process)5s %(name)18s: %(message)s', stream=sys.stderr)
+
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+
+    runs = []
+    try:
+        for kind in pools:
+            for workers in worker_counts:
+                for count in task_counts:
+                    for workload in workload_names:
+                        logging.info("{} pool, {} workers, {} {} tasks".format(kind, workers, count, workload))
+                        runs.append(run_one(event_loop, kind, workers, count, workload))
+    finally:
+        event_loop.close()
+
+    transfers = []
+    for kind in pools:
+        transfers += transfer(kind)
+
+    report(runs, transfers)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({
+                "config": {
+                    "cpu_size": cpu_size,
+                    "io_secs": io_secs,
+                    "cpus": os.cpu_count(),
+                    "python": platform.python_version(),
+                    "started_on": time.strftime("%Y-%m-%dT%H:%M:%S")
+                },
+                "runs": runs,
+                "transfers": transfers
+            }, f, indent=2)
+        print("results saved to {}".format(output))
+
+# end file
@@ -1,37 +1,73 @@
-#!/usr/bin/env python3.6
+#!/usr/bin/env python3
 #
 # Web server with websocket/socket.io exploration
 #
 
+import os
 import sys
+import getopt
+import signal
 import logging
+import tempfile
 import threading
 import aiohttp_cors
 import time
-import json
+import static_cache
+import admission
+import dispatcher
+import workloads
+import cluster
+import logqueue
+import registry
+import responses
+import metrics
+import loopmonitor
+import eventloop
+import coalesce
+import jobs
+import scheduler
+import ratelimit
+import stdio
+import bridge
+import idlereaper
+import transport
+import shmresult
+import warmpool
 
 # https://python-socketio.readthedocs.io/en/latest/index.html
 import socketio
 
-# https://docs.python.org/3.6/library/asyncio.html
+# https://docs.python.org/3/library/asyncio.html
 # used to manage the aiohttp server tasks, get the async event loop
 import asyncio
 
-# Used to asynchronously spawn a web server response thread
+# Used to asynchronously spawn web server response threads and processes
 from concurrent.futures import ThreadPoolExecutor
 
 # https://docs.aiohttp.org/en/stable/index.html
 # used for base web server
 from aiohttp import web
 
-# creates a new Async Socket.IO Server (note: socket.io is not strictly a websocket server)
-sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins='*') # , async_handlers=True will prevent queueing of messages from a single client
-
 #
 # globals
 #
 app =  None
 
+# socket.io's engine.io message handler, called by inbound_message()
+socketio_message_handler = None
+
+# the socket.io server and what hangs off it, created in main from the options.
+# A cpu pool worker started by forkserver or spawn imports this file as
+# __mp_main__ and only gets the definitions.
+sio = None
+transport_profile = None
+transport_traffic = None
+shared_segments = None
+responder = None
+rate_limiter = None
+stdin_feed = None
+client_manager = None
+
 logfile = 'asyncwebserver.2.log'
 
 server_address = "localhost"
@@ -39,18 +75,172 @@ server_port = "8080"
 
 Webserver_loop = None
 
+# event loop implementation for the web server: auto (uvloop if installed), asyncio
+# or uvloop, see eventloop.py. Resolved to asyncio or uvloop once logging is set up.
+event_loop = eventloop.AUTO
+
 # delay/block in the long_request hander for n seconds
 long_request_delay = 4
 
-tp_executor = ThreadPoolExecutor(max_workers = 2)
-
-logging.basicConfig(
-    format="%(asctime)s: %(message)s",
-    filename=logfile,
-    filemode='w',
-    level=logging.INFO,
-    datefmt="%H:%M:%S"
-)
+# n for the count_primes() work in the cpu_request handler
+cpu_request_size = 100000
+
+# io-bound work (long_request) runs in a thread pool, cpu-bound work (cpu_request)
+# in a process pool that is started with the web server. Each pool admits at most
+# *_queue_limit waiting requests before the server answers "busy". retry-after is
+# estimated from the queue unless set here.
+io_workers = 2
+io_queue_limit = 8
+cpu_workers = 2
+cpu_queue_limit = 8
+retry_after = None
+
+# long_request / cpu_request work still queued or running request_deadline seconds
+# after it was submitted is cancelled and the client gets a timeout reply. Work is
+# also cancelled when every client waiting for it has disconnected, see admission.py.
+request_deadline = 30.0
+
+# waiting executor work is served interactive requests first, then jobs, and round
+# robin between clients within each, see scheduler.py. One client can have at most
+# client_queue_limit requests waiting per pool.
+client_queue_limit = 4
+
+# inbound events are rate limited per connection: event -> (events per second, burst),
+# see ratelimit.py. Over the limit an event is rejected, or in "delay" mode held up to
+# rate_limit_max_delay seconds first. "off" disables the limits.
+rate_limits = {
+    "short_request": (20, 40),
+    "long_request": (2, 5),
+    "cpu_request": (2, 5),
+    "connections": (2, 5),
+    "serializer": (1, 3),
+    "job_submit": (2, 5),
+    "job_status": (5, 10),
+    "job_cancel": (5, 10),
+    "stdin": (1, 3)
+}
+rate_limit_mode = ratelimit.REJECT
+rate_limit_max_delay = 1.0
+
+# STDIN lines are streamed to the clients that subscribe with the stdin request.
+# Each client has a queue of stdin_feed_queue_size lines, when it falls behind the
+# oldest lines are dropped ("drop-oldest") or only the newest is kept ("coalesce"),
+# see bridge.py. Not in cluster mode, where the master reads STDIN.
+stdin_feed_queue_size = 256
+stdin_feed_policy = bridge.DROP_OLDEST
+
+# clients that send nothing for idle_timeout seconds are disconnected, 0 to keep
+# them. Checked every idle_tick seconds on a timing wheel, see idlereaper.py.
+# Clients subscribed to the connections list or the STDIN feed only listen and are
+# never disconnected for it, see listening().
+idle_timeout = 300.0
+idle_tick = 1.0
+
+# socket.io transports: the ones clients may use (index.2.html is websocket only),
+# engine.io's ping interval and timeout in seconds, and the smallest message that
+# is compressed in bytes, 0 to never compress, see transport.py
+transports = (transport.WEBSOCKET,)
+ping_interval = 25
+ping_timeout = 20
+compression_threshold = 1024
+
+# the cpu pool starts all its workers at startup, each preloading cpu_preload and
+# the blob data first. Workers are checked every cpu_health_interval seconds and a
+# pool with a dead worker is replaced, see warmpool.py. cpu_pool_start is how
+# workers are started: "forkserver" forks them from a server process that has
+# imported cpu_preload, which is also safe once threads run; "fork" or "spawn".
+cpu_pool_start = "forkserver"
+cpu_preload = ("workloads", "shmresult")
+cpu_health_interval = 5.0
+cpu_executor = None
+
+# cpu pool results of shared_result_min bytes or more come back through shared
+# memory segments instead of the result pipe (python 3.8+), see shmresult.py.
+# /blob?size=n streams one, at most blob_max bytes, blob_chunk bytes per write.
+shared_results = shmresult.available
+shared_result_min = 64 * 1024
+blob_size = 1024 * 1024
+blob_max = 64 * 1024 * 1024
+blob_chunk = 256 * 1024
+
+# job_submit: the requests that can run as jobs, most jobs kept and how long
+# finished jobs are kept, see jobs.py. block_for() checks for a cancel and reports
+# progress every block_for_step seconds when run as a job.
+job_requests = ("long_request", "cpu_request")
+job_max = 1000
+job_retention = 300.0
+block_for_step = 0.25
+
+# connections request page size when the client doesn't ask for one, and the largest allowed
+connections_page_limit = 100
+connections_page_max = 1000
+
+# the pools are added by dispatcher_init(), see dispatcher.py
+work_dispatcher = dispatcher.Dispatcher()
+
+# identical long_request / cpu_request requests in flight share one executor job,
+# results are cached for result_cache_ttl seconds, see coalesce.py
+result_cache_size = 256
+result_cache_ttl = 10.0
+long_request_results = coalesce.Coalescer("long_request", result_cache_size, result_cache_ttl)
+cpu_request_results = coalesce.Coalescer("cpu_request", result_cache_size, result_cache_ttl)
+
+# X-Forwarded-For is only used for the client address when the request comes from
+# one of these proxy addresses, see registry.py
+trusted_proxies = ()
+
+# static pages are cached in memory, see static_cache.py
+index_page = 'index.2.html'
+index_cache = static_cache.StaticCache()
+
+# handler latency, executor and client stats, served on /metrics, see metrics.py
+server_metrics = metrics.Metrics("asyncwebserver")
+
+# event loop health: lag is sampled every loop_lag_interval seconds, a callback or
+# coroutine step holding the loop longer than slow_callback_threshold is logged with
+# its stack, see loopmonitor.py
+loop_lag_interval = 0.1
+slow_callback_threshold = 0.1
+loop_monitor = loopmonitor.LoopMonitor(loop_lag_interval, slow_callback_threshold)
+
+# cluster mode: number of web server worker processes sharing the port, and the
+# Unix socket they relay broadcasts through, see cluster.py
+cluster_workers = 1
+cluster_socket = os.path.join(tempfile.gettempdir(), "asyncwebserver.2.{}.sock".format(os.getpid()))
+cluster_master = None
+
+# logging: "sync" writes the log file on the calling thread, "queue" hands records to
+# a writer thread, see logqueue.py. In queue mode the handler entry/exit lines can be
+# limited to log_entry_exit_rate per second and/or sampled 1 in log_entry_exit_sample.
+log_mode = "sync"
+log_entry_exit_rate = None
+log_entry_exit_sample = 1
+
+def usage():
+    program_name = sys.argv[0]
+    print("Usage: {} [options]".format(program_name))
+    print("  -h\tHelp.")
+    print("  -w n\tCluster mode, run n web server worker processes.")
+    print("  -l mode\tLogging mode, sync (default) or queue.")
+    print("  --trusted-proxy=addrs\tComma separated proxy addresses whose X-Forwarded-For is believed.")
+    print("  --log-rate=n\tQueue mode, log at most n handler entry/exit lines per second.")
+    print("  --log-sample=n\tQueue mode, log 1 in n handler entry/exit lines.")
+    print("  --loop=name\tEvent loop, auto (default, uvloop if installed), asyncio or uvloop.")
+    print("  --rate-limit=mode\tPer connection event limits, reject (default), delay or off.")
+    print("  --stdin-policy=name\tSTDIN feed slow client policy, drop-oldest (default) or coalesce.")
+    print("  --idle-timeout=secs\tDisconnect clients idle this long, 0 to keep them (default 300).")
+    print("  --transports=list\tTransports clients may use, websocket (default) or polling,websocket.")
+    print("  --ping=interval,timeout\tengine.io ping interval and pong timeout in seconds (default 25,20).")
+    print("  --compress=bytes\tCompress messages of this size or larger, 0 to never compress (default 1024).")
+    print("  --shared-results=on|off\tLarge cpu pool results through shared memory (default on, python 3.8+).")
+    print("  --cpu-start=method\tcpu pool worker start method, forkserver (default), fork or spawn.")
+
+# constant replies, encoded once
+short_request_reply = responses.Frame(responses.reply("short_request"))
+shutdown_reply = responses.Frame(responses.reply("shutdown"))
+connections_error_reply = responses.Frame(responses.reply("connections", "error", "invalid cursor or limit", 400))
+job_status_id_error_reply = responses.Frame(responses.reply("job_status", "error", "job must be a job id string", 400))
+job_cancel_id_error_reply = responses.Frame(responses.reply("job_cancel", "error", "job must be a job id string", 400))
 
 #
 # helper methods
@@ -69,8 +259,17 @@ def shutdown_server():
 
     logging.info("shutdown_server: entry")
 
-    # before stopping the web server, cancel all tasks
-    for task in asyncio.Task.all_tasks(Webserver_loop):
+    # the cluster master has no web server of its own, it stops the workers instead
+    if cluster_master is not None:
+        cluster_master.stop()
+        return
+
+    if Webserver_loop is None:
+        return
+
+    # before stopping the web server, cancel all tasks (Task.all_tasks is gone in python 3.9)
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    for task in all_tasks(Webserver_loop):
         logging.info("shutdown_server: Cancel task")
         Webserver_loop.call_soon_threadsafe(task.cancel)
 
@@ -78,22 +277,261 @@ def shutdown_server():
     Webserver_loop.call_soon_threadsafe(Webserver_loop.stop)
 
 
-def block_for(secs):
+def busy_response(request, e):
+    '''
+    Build the reply for a request refused by a full executor queue
+
+    :request string The request name.
+    :e admission.QueueFull
+    :return dict
+    '''
+    return responses.reply(request, "busy", "busy, retry after {}s".format(e.retry_after), 503,
+                           retry_after=e.retry_after, queue_depth=e.depth)
+
+
+async def rate_limited(sid, event, retry_after):
+    '''
+    Tell a client its event was dropped by the rate limiter
+
+    :sid string
+    :event string
+    :retry_after float Seconds until the event is allowed again.
+    :return string The event's ack
+    '''
+    logging.info("rate_limited({}) - {}, retry after {:.3f}s".format(sid, event, retry_after))
+    await responder.send(sid, responses.reply(event, "rate-limited", "too many {} requests".format(event), 429,
+                                              retry_after=round(retry_after, 3)))
+    return "{} rate-limited".format(event)
+
+
+def dispatcher_init():
+    '''
+    Create and start the executor pools
+
+    Must run before any thread is started, see dispatcher.Dispatcher.warm().
+
+    :return None
+    '''
+    global cpu_executor
+
+    cpu_executor = warmpool.WarmProcessPool(cpu_workers, workloads.preload, (cpu_preload,), cpu_pool_start, cpu_preload, cpu_health_interval)
+
+    work_dispatcher.add_pool(dispatcher.IO_BOUND, ThreadPoolExecutor(max_workers = io_workers), io_workers, io_queue_limit, retry_after, client_queue_limit)
+    work_dispatcher.add_pool(dispatcher.CPU_BOUND, cpu_executor, cpu_workers, cpu_queue_limit, retry_after, client_queue_limit)
+    work_dispatcher.warm()
+
+
+def metrics_init():
+    '''
+    Register the gauges and rates computed when /metrics is scraped
+
+    :return None
+    '''
+    pools = work_dispatcher.pools
+
+    server_metrics.gauge("executor_queue_depth", "Jobs waiting for an executor worker",
+                         lambda: {kind: pool.queue.depth for kind, pool in pools.items()}, "pool")
+    server_metrics.gauge("executor_active_workers", "Executor workers running a job",
+                         lambda: {kind: pool.queue.running for kind, pool in pools.items()}, "pool")
+    server_metrics.gauge("executor_workers", "Executor workers",
+                         lambda: {kind: pool.workers for kind, pool in pools.items()}, "pool")
+    server_metrics.counter("executor_rejected_total", "Jobs refused with a busy reply",
+                         lambda: sum(pool.queue.rejected for pool in pools.values()))
+    server_metrics.gauge("executor_queue_depth_by_class", "Jobs waiting for an executor worker, every pool",
+                         lambda: class_stats("depth"), "class")
+    server_metrics.counter("executor_served_total", "Jobs handed to an executor worker after waiting, every pool",
+                         lambda: class_stats("served"), "class")
+    server_metrics.gauge("executor_clients_waiting", "Clients with jobs waiting for an executor worker",
+                         lambda: {kind: pool.queue.pending.stats(0)["clients_waiting"] for kind, pool in pools.items()}, "pool")
+    server_metrics.counter("executor_dropped_total", "Queued jobs cancelled before they ran",
+                         lambda: {kind: pool.queue.dropped for kind, pool in pools.items()}, "pool")
+    server_metrics.counter("executor_stopped_total", "Running jobs asked to stop early",
+                         lambda: {kind: pool.queue.stopped for kind, pool in pools.items()}, "pool")
+    server_metrics.counter("executor_expired_total", "Jobs cancelled at their deadline",
+                         lambda: {kind: pool.queue.expired for kind, pool in pools.items()}, "pool")
+    server_metrics.counter("executor_saved_seconds_total", "Estimated executor time not spent on cancelled jobs",
+                         lambda: {kind: pool.queue.saved_secs for kind, pool in pools.items()}, "pool")
+    server_metrics.counter("executor_wasted_seconds_total", "Executor time spent on jobs cancelled too late to stop",
+                         lambda: {kind: pool.queue.wasted_secs for kind, pool in pools.items()}, "pool")
+    caches = (long_request_results, cpu_request_results)
+    server_metrics.counter("result_cache_hits_total", "Requests answered from the result cache",
+                         lambda: {c.name: c.hits for c in caches}, "event")
+    server_metrics.counter("result_cache_misses_total", "Requests that started an executor job",
+                         lambda: {c.name: c.misses for c in caches}, "event")
+    server_metrics.counter("result_cache_coalesced_total", "Requests that joined an identical job in flight",
+                         lambda: {c.name: c.coalesced for c in caches}, "event")
+    server_metrics.gauge("jobs", "Jobs in the job table",
+                         lambda: dict(app['jobs'].stats()["states"]), "state")
+    server_metrics.counter("jobs_submitted_total", "Jobs submitted", lambda: app['jobs'].submitted)
+    server_metrics.counter("jobs_cancelled_total", "Jobs cancelled", lambda: app['jobs'].cancelled)
+    server_metrics.gauge("event_loop_info", "Event loop implementation of the web server", lambda: {event_loop: 1}, "loop")
+    server_metrics.gauge("clients_connected", "Clients connected to this process", lambda: len(app['connections']))
+    if cluster_workers > 1:
+        server_metrics.gauge("cluster_clients_connected", "Clients connected to every worker", lambda: len(sio.manager.node))
+    server_metrics.gauge("loop_lag_seconds", "Event loop scheduling lag, recent samples",
+                         lambda: {q: loop_monitor.lag.percentile(float(q) * 100) for q in ("0.5", "0.9", "0.99")}, "quantile")
+    server_metrics.gauge("loop_lag_max_seconds", "Largest event loop scheduling lag", lambda: loop_monitor.lag.max)
+    server_metrics.counter("loop_slow_callbacks_total", "Callbacks or coroutine steps that blocked the event loop",
+                         lambda: loop_monitor.slow_count)
+    server_metrics.counter("rate_limited_total", "Events rejected by the per connection rate limits",
+                         lambda: dict(rate_limiter.rejected), "event")
+    server_metrics.counter("rate_delayed_total", "Events held back by the per connection rate limits",
+                         lambda: dict(rate_limiter.delayed), "event")
+    server_metrics.gauge("stdin_feed_subscribers", "Clients subscribed to the STDIN feed", lambda: len(stdin_feed))
+    server_metrics.counter("stdin_feed_lines_total", "STDIN lines published to the feed", lambda: stdin_feed.published)
+    server_metrics.counter("stdin_feed_dropped_total", "STDIN feed lines dropped for slow clients, every client",
+                         lambda: stdin_feed.dropped)
+    server_metrics.gauge("stdin_feed_lag_max_lines", "Lines the slowest STDIN feed client is behind", lambda: stdin_feed.max_lag()[0])
+    server_metrics.gauge("stdin_feed_lag_max_seconds", "Age of the oldest line not yet acked by a STDIN feed client",
+                         lambda: stdin_feed.max_lag()[1])
+    server_metrics.gauge("idle_tracked_connections", "Connections watched by the idle reaper",
+                         lambda: len(app['idle_reaper'].wheel) if app['idle_reaper'] else 0)
+    server_metrics.counter("idle_checked_total", "Connections checked by the idle reaper",
+                         lambda: app['idle_reaper'].checked if app['idle_reaper'] else 0)
+    server_metrics.counter("idle_reaped_total", "Clients disconnected for being idle",
+                         lambda: app['idle_reaper'].reaped if app['idle_reaper'] else 0)
+    server_metrics.counter("idle_exempted_total", "Idle clients kept because they are subscribed to a feed",
+                         lambda: app['idle_reaper'].exempted if app['idle_reaper'] else 0)
+    server_metrics.counter("transport_messages_in_total", "Websocket frames / polling requests received",
+                         lambda: transport_traffic.total("messages_in"), "transport")
+    server_metrics.counter("transport_bytes_in_total", "Bytes received",
+                         lambda: transport_traffic.total("bytes_in"), "transport")
+    server_metrics.counter("transport_messages_out_total", "Websocket frames / polling responses sent",
+                         lambda: transport_traffic.total("messages_out"), "transport")
+    server_metrics.counter("transport_bytes_out_total", "Bytes sent, websocket before compression",
+                         lambda: transport_traffic.total("bytes_out"), "transport")
+    server_metrics.counter("transport_compressed_total", "Messages sent compressed",
+                         lambda: transport_traffic.total("compressed_out"), "transport")
+    server_metrics.gauge("shm_segments", "Shared memory result segments",
+                         lambda: {"free": shared_segments.stats()["segments_free"], "in_use": len(shared_segments.in_use)}, "state")
+    server_metrics.gauge("shm_bytes_mapped", "Bytes in shared memory result segments", lambda: shared_segments.stats()["bytes_mapped"])
+    server_metrics.counter("shm_results_total", "cpu pool results by how they came back",
+                         lambda: {"shared": shared_segments.shared_results, "pickled": shared_segments.pickled_results}, "path")
+    server_metrics.counter("shm_segments_created_total", "Shared memory segments created", lambda: shared_segments.created)
+    server_metrics.gauge("cpu_pool_startup_seconds", "Time to start every cpu pool worker, current pool", lambda: cpu_executor.last_startup)
+    server_metrics.gauge("cpu_pool_ready", "1 once every cpu pool worker is up", lambda: int(cpu_executor.ready))
+    server_metrics.counter("cpu_pool_replacements_total", "cpu pools replaced after a worker died", lambda: cpu_executor.replacements)
+    server_metrics.gauge("cpu_cold_job_seconds", "Latency of cpu jobs submitted while the pool was starting",
+                         lambda: {q: cpu_executor.cold_latency.percentile(float(q) * 100) for q in ("0.5", "0.99")}, "quantile")
+    server_metrics.gauge("cpu_warm_job_seconds", "Latency of cpu jobs submitted to a started pool",
+                         lambda: {q: cpu_executor.warm_latency.percentile(float(q) * 100) for q in ("0.5", "0.99")}, "quantile")
+    server_metrics.counter("cpu_cold_jobs_total", "cpu jobs submitted while the pool was starting", lambda: cpu_executor.cold_latency.count)
+    server_metrics.counter("messages_in_total", "socket.io requests handled", server_metrics.messages)
+    server_metrics.counter("messages_out_total", "socket.io replies sent", lambda: responder.sent)
+    server_metrics.rate("messages_in_per_second", "socket.io requests per second since the last scrape", server_metrics.messages)
+    server_metrics.rate("messages_out_per_second", "socket.io replies per second since the last scrape", lambda: responder.sent)
+
+
+def connections_index():
+    '''
+    The connected clients in arrival order, node wide in cluster mode
+
+    :return registry.SidIndex
+    '''
+    if cluster_workers > 1:
+        return sio.manager.node
+    return app['connections'].index
+
+
+async def connections_delta(op, sid):
+    '''
+    Tell the clients subscribed to the connections list about a connect/disconnect
+
+    :op string "connect" or "disconnect"
+    :sid string
+    :return None
+    '''
+    delta = {"op": op, "sid": sid, "count": len(connections_index())}
+    await sio.emit("connections_delta", responses.json_dumps(delta), room="connections")
+
+
+def class_stats(name):
+    '''
+    A scheduler stat summed over the pools, by priority class
+
+    :name string "depth" or "served", see scheduler.FairQueue.stats().
+    :return dict class name -> value
+    '''
+    totals = {}
+    for pool in work_dispatcher.pools.values():
+        for class_name, stats in pool.queue.pending.stats(0)["classes"].items():
+            totals[class_name] = totals.get(class_name, 0) + stats[name]
+    return totals
+
+
+async def job_notify(record, event):
+    '''
+    Push a job's state to its client
+
+    :record jobs.JobRecord
+    :event string "job_update" or "job_result"
+    :return None
+    '''
+    await responder.send(record.sid, record.to_dict(), event=event)
+
+
+def submit_job(record):
+    '''
+    Start the work for a job
+
+    :record jobs.JobRecord
+    :return admission.Job
+    :raises admission.QueueFull
+    '''
+    if record.request == "long_request":
+        return work_dispatcher.submit(dispatcher.IO_BOUND, block_for, long_request_delay, record.context,
+                                      owner=record.sid, cancel_event=record.context.cancelled, priority=scheduler.BATCH)
+    return work_dispatcher.submit(dispatcher.CPU_BOUND, workloads.count_primes, cpu_request_size,
+                                  owner=record.sid, priority=scheduler.BATCH)
+
+
+def block_for(secs, context=None):
     '''
     Block / return after secs seconds have passed.
 
     :secs integer Delay in seconds.
+    :context jobs.JobContext For progress and cancel.
     :return string
+    :raises jobs.JobCancelled
     '''
     logging.info("block_for - entry({})".format(secs))
 
-    time.sleep(secs)
+    if context is None:
+        time.sleep(secs)
+    else:
+        # in steps, to report progress and notice a cancel
+        steps = max(1, int(secs / block_for_step))
+        for i in range(steps):
+            context.check()
+            time.sleep(secs / steps)
+            context.progress((i + 1) / steps)
 
     logging.info("block_for - exit")
 
     return "block_for done"
 
 
+async def disconnect_idle(sid):
+    '''
+    Idle reaper callback, disconnect a client that has sent nothing for idle_timeout seconds
+
+    :sid string
+    :return None
+    '''
+    await sio.disconnect(sid)
+
+
+def listening(sid):
+    '''
+    Idle reaper exemption: a client subscribed to server pushes sends nothing and
+    socket.io clients do not reconnect after a server side disconnect
+
+    :sid string
+    :return bool True if sid is subscribed to connections_delta or the STDIN feed
+    '''
+    return sid in stdin_feed.subscribers or "connections" in sio.rooms(sid)
+
+
 def aiohttp_init():
     '''
     Create a web server
@@ -102,13 +540,23 @@ def aiohttp_init():
     '''
     global sio
     global app
+    global socketio_message_handler
 
     logging.info("aiohttp_init - entry")
 
     # Creates a new Aiohttp Web Application
     app = web.Application()
 
-    app['connections'] = {}
+    # connected clients, see registry.py
+    app['connections'] = registry.ConnectionRegistry(trusted_proxies)
+
+    # disconnects idle clients, see idlereaper.py
+    app['idle_reaper'] = idlereaper.IdleReaper(app['connections'], idle_timeout, disconnect_idle, idle_tick, listening) if idle_timeout > 0 else None
+
+    # submitted jobs, see jobs.py
+    app['jobs'] = jobs.JobTable(job_notify, job_max, job_retention)
+
+    rate_limiter.on_reject = rate_limited
 
     # register state change handlers
     app.on_startup.append(startup)
@@ -118,8 +566,19 @@ def aiohttp_init():
     # Binds our Socket.IO server to our Web App instance
     sio.attach(app)
 
+    # websocket compression threshold, traffic counts
+    app.middlewares.append(transport_profile.install(sio, transport_traffic))
+    logging.info("aiohttp_init - transport profile {}".format(transport_profile.server_options()))
+
+    # every packet from a client goes through inbound_message() before socket.io handles it
+    socketio_message_handler = sio.eio.handlers['message']
+    sio.eio.on('message', inbound_message)
+
     # We bind our aiohttp endpoint to our app router
     app.router.add_get('/', index_page_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/executor', executor_stats_handler)
+    app.router.add_get('/blob', blob_handler)
 
     cors = aiohttp_cors.setup(app)
 
@@ -150,48 +609,111 @@ def web_server(runner):
     global Webserver_loop
 
     logging.info("web_server thread - entry")
-    Webserver_loop = asyncio.new_event_loop()
+    Webserver_loop = eventloop.new_event_loop(event_loop)
     asyncio.set_event_loop(Webserver_loop)
+    loop_monitor.start(Webserver_loop)
 
     # server setup
     Webserver_loop.run_until_complete(runner.setup())
-    site = web.TCPSite(runner, server_address, server_port)
+    # cluster workers each bind the same port, the kernel balances connections
+    site = web.TCPSite(runner, server_address, server_port, reuse_port=cluster_workers > 1)
     Webserver_loop.run_until_complete(site.start())
+
+    # STDIN is read on this loop, cluster workers leave it to the master
+    if cluster_master is None and cluster_workers == 1:
+        stdin_task = Webserver_loop.create_task(stdin_pipeline()) # the loop only keeps a weak reference
+
     logging.info("web_server - thread starting run loop")
 
     # start the server, run until explicitly stopped
     Webserver_loop.run_forever()
 
+    loop_monitor.stop()
+
     # once stop is called, we run the cleanup task
     Webserver_loop.run_until_complete(runner.cleanup())
 
     logging.info("web_server thread - exit")
 
 
-def stdin_reader():
+def web_worker():
+    '''
+    Cluster worker process: start the executors and run the web server until it is stopped
+
+    :return None
+    '''
+    global cluster_master
+
+    logging.info("web_worker - entry")
+
+    # forked after the master was set up, but this process is not the master
+    cluster_master = None
+
+    dispatcher_init()
+    metrics_init()
+
+    # the master sends SIGTERM on shutdown (set after forking the process pool)
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_server())
+
+    t_webserver = threading.Thread(target=web_server, args=(aiohttp_init(),), daemon=False)
+    t_webserver.start()
+    t_webserver.join()
+
+    # the worker leaves with os._exit(), which skips the executors' exit handlers
+    work_dispatcher.shutdown(wait=True)
+
+    logging.info("web_worker - exit")
+
+
+def log_lines(lines):
+    '''
+    STDIN pipeline callback, log a batch of lines in one record and pass them to
+    the subscribed clients
+
+    :lines list of string
+    :return None
+    '''
+    logging.info("STDIN: {}".format("\nSTDIN: ".join(lines)))
+
+    # the cluster master runs no socket.io server
+    if cluster_master is None:
+        stdin_feed.publish(lines)
+
+
+async def stdin_pipeline():
     '''
-    Read from STDIN until CTRL-D
+    Read from STDIN until CTRL-D, on the loop it is started on, see stdio.py
 
-    :id int The thread id
     :return None
     '''
-    global Verbose
+    logging.info("stdin_pipeline - entry")
 
-    logging.info("stdin_reader thread - entry")
+    stats = await stdio.pipeline(log_lines, output=False)
 
-    for line in sys.stdin:
-        logging.info("STDIN: {}".format(line.rstrip()))
+    logging.info("stdin_pipeline - read {lines} line(s), {bytes} bytes in {seconds:.3f}s".format(**stats))
 
     shutdown_server()
 
-    logging.info("stdin_reader thread - exit")
+    logging.info("stdin_pipeline - exit")
 
 #
 # async handlers
 #
 
-@sio.on('connect', namespace='/')
-def connect_handler(sid, environ):
+async def inbound_message(eio_sid, data):
+    '''
+    engine.io message handler, records the packet as the client's last_seen /
+    last_message then hands it to socket.io. Events and acks alike count.
+
+    :eio_sid string engine.io session, not the socket.io sid
+    :data string or bytes
+    :return None
+    '''
+    app['connections'].touch(sio.manager.sid_from_eio_sid(eio_sid, '/'), registry.packet_name(data))
+    await socketio_message_handler(eio_sid, data)
+
+
+async def connect_handler(sid, environ):
     '''
     Connection handler
 
@@ -208,21 +730,20 @@ def connect_handler(sid, environ):
         print("Error ----------- conn exists")
         logging.info("Error ----------- conn exists")
     else:
-        conn = {
-            "id": sid,
-            "environ": environ,
-            "last_seen": time.time(),
-            "connected_on": time.time(),
-            "last_message": ""
-        }
+        # keeps what we need from environ, not environ itself
+        app['connections'].add(sid, environ)
+        if app['idle_reaper']:
+            app['idle_reaper'].add(sid)
+
+    if cluster_workers > 1:
+        await sio.manager.add_client(sid)
 
-    app['connections'][sid] = conn
+    await connections_delta("connect", sid)
 
     logging.info("connect - exit")
 
 
-@sio.on('disconnect', namespace='/')
-def disconnect_handler(sid):
+async def disconnect_handler(sid):
     '''
     Disconnect handler
 
@@ -232,10 +753,26 @@ def disconnect_handler(sid):
     logging.info("disconnect(" + sid + ") - entry")
 
     if sid in app['connections']:
-        app['connections'].pop(sid, None)
+        app['connections'].remove(sid)
+        if app['idle_reaper']:
+            app['idle_reaper'].remove(sid)
     else:
         logging.info("disconnect - Error: Unknown connection: " + sid)
 
+    responder.forget(sid)
+    rate_limiter.forget(sid)
+    stdin_feed.unsubscribe(sid)
+
+    # nobody is left to get the results
+    cancelled = work_dispatcher.cancel_owner(sid)
+    if cancelled:
+        logging.info("disconnect - cancelled {} job(s)".format(cancelled))
+
+    if cluster_workers > 1:
+        await sio.manager.remove_client(sid)
+
+    await connections_delta("disconnect", sid)
+
     logging.info("disconnect - exit")
 
 
@@ -246,7 +783,18 @@ async def startup(app):
     :app object web.Application
     :return None
     '''
-    logging.info("web server startup - entry/exit")
+    logging.info("web server startup - entry")
+
+    # load the index page before the first client asks for it
+    await index_cache.get(index_page)
+
+    if app['idle_reaper']:
+        app['idle_reaper'].start()
+
+    # replaces the cpu pool if a worker dies
+    cpu_executor.start_monitor()
+
+    logging.info("web server startup - exit")
 
 
 async def cleanup(app):
@@ -258,6 +806,12 @@ async def cleanup(app):
     '''
     logging.info("web server cleanup: entry/exit")
 
+    shared_segments.close()
+    cpu_executor.stop_monitor()
+
+    if app['idle_reaper']:
+        app['idle_reaper'].stop()
+
 
 async def shutdown(app):
     '''
@@ -271,83 +825,533 @@ async def shutdown(app):
 
 # we can define aiohttp endpoints just as we normally would with no change
 async def index_page_handler(request):
-    with open('index.2.html') as f:
-        return web.Response(text=f.read(), content_type='text/html')
+    return await index_cache.response(request, index_page)
+
+
+async def metrics_handler(request):
+    return web.Response(text=server_metrics.render(), content_type="text/plain", charset="utf-8")
+
 
+async def executor_stats_handler(request):
+    # pools, scheduler classes and the busiest clients, for capacity planning
+    return web.Response(text=responses.json_dumps(work_dispatcher.stats()), content_type="application/json")
 
-@sio.on('short_request')
+
+async def blob_handler(request):
+    '''
+    Generate ?size=n bytes in the cpu pool and stream them to the client, straight
+    from the shared memory segment when the result came back through one
+
+    :request web.Request
+    :return web.StreamResponse
+    '''
+    logging.info("blob_handler - entry")
+
+    try:
+        size = min(int(request.query.get("size", blob_size)), blob_max)
+    except ValueError:
+        raise web.HTTPBadRequest(text="invalid size")
+
+    def submit(fn, *args):
+        return work_dispatcher.submit(dispatcher.CPU_BOUND, fn, *args, deadline=request_deadline).future
+
+    try:
+        result = await shared_segments.run(submit, size, workloads.make_blob, size)
+    except admission.QueueFull as e:
+        raise web.HTTPServiceUnavailable(text=responses.json_dumps(busy_response("blob", e)), content_type="application/json")
+    except admission.DeadlineExceeded:
+        raise web.HTTPGatewayTimeout(text="timeout")
+
+    sent = False
+    try:
+        response = web.StreamResponse(headers={"Content-Type": "application/octet-stream", "X-Shared-Memory": str(int(result.shared))})
+        response.content_length = len(result)
+        await response.prepare(request)
+        for chunk in result.chunks(blob_chunk):
+            await response.write(chunk)
+        chunk = None # a view of the segment, it can't be reused while one is around
+        await response.write_eof()
+
+        # the socket may still hold slices of the segment, it is reused once they are sent
+        sock = request.transport
+        waited = 0.0
+        while sock is not None and sock.get_write_buffer_size() and waited < request_deadline:
+            await asyncio.sleep(0.005)
+            waited += 0.005
+        sent = sock is None or not sock.get_write_buffer_size()
+    finally:
+        # not known to be sent: the segment is dropped instead of reused
+        result.release(reuse=sent)
+
+    logging.info("blob_handler - exit")
+    return response
+
+
+@server_metrics.timed('short_request')
 async def handle_short_request(sid, data):
     logging.info("handle_short_request(" + sid + ") - entry")
-    await sio.emit("message", '{"response":"ok", "response-text":"ok", "response-code":200, "request":"short_request"}', room=sid)
+    await responder.send(sid, short_request_reply)
     logging.info("handle_short_request - exit")
     return "short_request ack"
 
 
-@sio.on('long_request')
+@server_metrics.timed('long_request')
 async def handle_long_request(sid, data):
     logging.info("handle_long_request(" + sid + ") - entry")
 
-    loop = asyncio.get_event_loop()
+    job = None
+
+    # block_for() checks the context to stop early once nobody waits for it
+    context = jobs.JobContext(asyncio.get_event_loop())
+
+    def start():
+        nonlocal job
+        job = work_dispatcher.submit(dispatcher.IO_BOUND, block_for, long_request_delay, context, # task block for n seconds
+                                     owner=sid, deadline=request_deadline, cancel_event=context.cancelled)
+        return job
+
+    # refuse right away rather than queueing without bound
+    try:
+        result, source = await long_request_results.run(coalesce.make_key("long_request", data), start, sid)
+    except admission.QueueFull as e:
+        logging.info("handle_long_request - busy, depth: {}, retry after: {}s".format(e.depth, e.retry_after))
+        await responder.send(sid, busy_response("long_request", e))
+        logging.info("handle_long_request - exit")
+        return "long_request busy"
+    except admission.DeadlineExceeded as e:
+        logging.info("handle_long_request - timeout: {}".format(e))
+        await responder.send(sid, responses.reply("long_request", "timeout", "no result within {}s".format(request_deadline), 504))
+        logging.info("handle_long_request - exit")
+        return "long_request timeout"
+    except admission.Cancelled as e:
+        # the client disconnected, there is nobody to reply to
+        logging.info("handle_long_request - exit, cancelled: {}".format(e))
+        return "long_request cancelled"
+
+    if job is not None:
+        logging.info('handle_long_request - results: {!r}, queue depth: {}, queue wait: {:.3f}s'.format(result, job.depth, job.queue_wait))
+        response = responses.reply("long_request", cache=source, queue_depth=job.depth, queue_wait=round(job.queue_wait, 3))
+    else:
+        logging.info('handle_long_request - results: {!r}, {}'.format(result, source))
+        response = responses.reply("long_request", cache=source)
 
-    # will block until there are threads available
-    task = loop.run_in_executor(tp_executor, block_for, long_request_delay) # task block for n seconds
+    await responder.send(sid, response)
 
-    completed, pending = await asyncio.wait([task])
+    logging.info("handle_long_request - exit")
 
-    results = [t.result() for t in completed]
+    return "long_request ack"
 
-    logging.info('handle_long_request - results: {!r}'.format(results))
 
-    await sio.emit("message", '{"response":"ok", "response-text":"ok", "response-code":200, "request":"long_request"}', room=sid)
+@server_metrics.timed('cpu_request')
+async def handle_cpu_request(sid, data):
+    logging.info("handle_cpu_request(" + sid + ") - entry")
+
+    job = None
+
+    def start():
+        nonlocal job
+        job = work_dispatcher.submit(dispatcher.CPU_BOUND, workloads.count_primes, cpu_request_size,
+                                     owner=sid, deadline=request_deadline)
+        return job
+
+    # cpu-bound, so it runs in the process pool and leaves the GIL to the event loop
+    try:
+        result, source = await cpu_request_results.run(coalesce.make_key("cpu_request", data), start, sid)
+    except admission.QueueFull as e:
+        logging.info("handle_cpu_request - busy, depth: {}, retry after: {}s".format(e.depth, e.retry_after))
+        await responder.send(sid, busy_response("cpu_request", e))
+        logging.info("handle_cpu_request - exit")
+        return "cpu_request busy"
+    except admission.DeadlineExceeded as e:
+        logging.info("handle_cpu_request - timeout: {}".format(e))
+        await responder.send(sid, responses.reply("cpu_request", "timeout", "no result within {}s".format(request_deadline), 504))
+        logging.info("handle_cpu_request - exit")
+        return "cpu_request timeout"
+    except admission.Cancelled as e:
+        # the client disconnected, there is nobody to reply to
+        logging.info("handle_cpu_request - exit, cancelled: {}".format(e))
+        return "cpu_request cancelled"
+
+    if job is not None:
+        logging.info('handle_cpu_request - results: {!r}, queue depth: {}, queue wait: {:.3f}s'.format(result, job.depth, job.queue_wait))
+        response = responses.reply("cpu_request", result, cache=source, queue_depth=job.depth, queue_wait=round(job.queue_wait, 3))
+    else:
+        logging.info('handle_cpu_request - results: {!r}, {}'.format(result, source))
+        response = responses.reply("cpu_request", result, cache=source)
 
-    logging.info("handle_long_request - exit")
+    await responder.send(sid, response)
 
-    return "long_request ack"
+    logging.info("handle_cpu_request - exit")
+
+    return "cpu_request ack"
 
 
-@sio.on('shutdown')
+@server_metrics.timed('shutdown')
 async def handle_shutdown_request(sid, data):
     logging.info("handle_shutdown_request(" + sid + ") - entry")
-    await sio.emit("message", '{"response":"ok", "response-text":"ok", "response-code":200, "request":"shutdown"}', room=sid)
-    shutdown_server()
+    await responder.send(sid, shutdown_reply)
+    if cluster_workers > 1:
+        # the master stops every worker, this one included
+        os.kill(os.getppid(), signal.SIGTERM)
+    else:
+        shutdown_server()
     logging.info("handle_shutdown_request - exit")
     return "shutdown_request ack"
 
 
-@sio.on('connections')
+@server_metrics.timed('connections')
 async def handle_connections_request(sid, data):
+    '''
+    List the connected clients, a page at a time
+
+    data (all optional):
+        cursor: the cursor returned with the previous page, omit for the first page
+        limit: page size, 0 to only get the count
+        subscribe: true to receive connections_delta events on connect/disconnect,
+                   false to stop them
+    '''
     logging.info("handle_connections_request(" + sid + ") - entry")
-    conn_list = json.dumps(list(app['connections'].keys()));
-    await sio.emit("message", '{"response":' + conn_list + ', "response-text":"ok", "response-code":200, "request":"connections"}', room=sid)
+
+    if not isinstance(data, dict):
+        data = {}
+
+    try:
+        cursor = data.get("cursor")
+        cursor = int(cursor) if cursor is not None else None
+        limit = min(int(data.get("limit", connections_page_limit)), connections_page_max)
+    except (TypeError, ValueError):
+        await responder.send(sid, connections_error_reply)
+        logging.info("handle_connections_request - exit")
+        return "connections_ack"
+
+    if "subscribe" in data:
+        if data["subscribe"]:
+            await sio.enter_room(sid, "connections")
+        else:
+            await sio.leave_room(sid, "connections")
+
+    index = connections_index()
+    conn_ids, next_cursor = index.page(cursor, limit)
+
+    response = responses.reply("connections", conn_ids, count=len(index), cursor=next_cursor)
+    await responder.send(sid, response)
     logging.info("handle_connections_request - exit")
     return "connections_ack"
 
 
+@server_metrics.timed('stdin')
+async def handle_stdin_request(sid, data):
+    '''
+    data: {"subscribe": true} to receive STDIN lines as "stdin" events, false to
+    stop them. Ack each event, the next one is sent once it is acked, see bridge.py.
+    The reply has the client's feed stats.
+    '''
+    logging.info("handle_stdin_request(" + sid + ") - entry")
+
+    if isinstance(data, dict) and "subscribe" in data:
+        if data["subscribe"]:
+            stdin_feed.subscribe(sid)
+        else:
+            stdin_feed.unsubscribe(sid)
+
+    subscriber = stdin_feed.subscribers.get(sid)
+    stats = subscriber.to_dict(stdin_feed.last_seq, time.monotonic()) if subscriber is not None else None
+    await responder.send(sid, responses.reply("stdin", stats, subscribed=subscriber is not None, policy=stdin_feed.policy))
+    logging.info("handle_stdin_request - exit")
+    return "stdin ack"
+
+
+@server_metrics.timed('serializer')
+async def handle_serializer_request(sid, data):
+    '''
+    Choose the reply format for this client
+
+    data: {"format": "json" or "msgpack"}, msgpack replies are sent as binary.
+    The reply to this request is already in the new format.
+    '''
+    logging.info("handle_serializer_request(" + sid + ") - entry")
+
+    fmt = data.get("format") if isinstance(data, dict) else data
+
+    if responder.set_format(sid, fmt):
+        response = responses.reply("serializer", fmt)
+    else:
+        response = responses.reply("serializer", "error", "unknown format, use one of {}".format(", ".join(responses.formats())), 400)
+
+    await responder.send(sid, response)
+    logging.info("handle_serializer_request - exit")
+    return "serializer_ack"
+
+
+@server_metrics.timed('job_submit')
+async def handle_job_submit(sid, data):
+    '''
+    Start a request as a job and return at once
+
+    data: {"request": "long_request" or "cpu_request"}
+    The ack is the job id. job_update events follow as the job starts and makes
+    progress, a job_result event once it is done, failed or cancelled.
+    '''
+    logging.info("handle_job_submit(" + sid + ") - entry")
+
+    request = data.get("request") if isinstance(data, dict) else data
+
+    if request not in job_requests:
+        await responder.send(sid, responses.reply("job_submit", "error", "request must be one of {}".format(", ".join(job_requests)), 400))
+        logging.info("handle_job_submit - exit")
+        return "job_submit error"
+
+    try:
+        record = app['jobs'].new(sid, request, context=(request == "long_request"))
+    except jobs.TooManyJobs as e:
+        await responder.send(sid, responses.reply("job_submit", "busy", str(e), 503))
+        logging.info("handle_job_submit - exit")
+        return "job_submit busy"
+
+    try:
+        job = submit_job(record)
+    except admission.QueueFull as e:
+        app['jobs'].discard(record)
+        logging.info("handle_job_submit - busy, depth: {}, retry after: {}s".format(e.depth, e.retry_after))
+        await responder.send(sid, busy_response("job_submit", e))
+        logging.info("handle_job_submit - exit")
+        return "job_submit busy"
+
+    app['jobs'].attach(record, job)
+
+    await responder.send(sid, responses.reply("job_submit", record.to_dict()))
+    logging.info("handle_job_submit - exit, job {}".format(record.id))
+    return record.id
+
+
+@server_metrics.timed('job_status')
+async def handle_job_status(sid, data=None):
+    '''
+    data: {"job": id}, or nothing for all of this client's jobs
+    '''
+    logging.info("handle_job_status(" + sid + ") - entry")
+
+    job_id = data.get("job") if isinstance(data, dict) else data
+
+    if not job_id:
+        response = responses.reply("job_status", [record.to_dict() for record in app['jobs'].for_sid(sid)])
+    elif not isinstance(job_id, str):
+        response = job_status_id_error_reply
+    else:
+        record = app['jobs'].get(job_id, sid)
+        if record is None:
+            response = responses.reply("job_status", "error", "unknown job", 404, job=job_id)
+        else:
+            response = responses.reply("job_status", record.to_dict())
+
+    await responder.send(sid, response)
+    logging.info("handle_job_status - exit")
+    return "job_status ack"
+
+
+@server_metrics.timed('job_cancel')
+async def handle_job_cancel(sid, data=None):
+    '''
+    data: {"job": id}
+    The job_result event reports when the job is actually cancelled.
+    '''
+    logging.info("handle_job_cancel(" + sid + ") - entry")
+
+    job_id = data.get("job") if isinstance(data, dict) else data
+    record = app['jobs'].get(job_id, sid) if job_id and isinstance(job_id, str) else None
+
+    if not job_id or not isinstance(job_id, str):
+        response = job_cancel_id_error_reply
+    elif record is None:
+        response = responses.reply("job_cancel", "error", "unknown job", 404, job=job_id)
+    elif not app['jobs'].cancel(record):
+        response = responses.reply("job_cancel", "error", "job already {}".format(record.state), 409, job=job_id)
+    else:
+        response = responses.reply("job_cancel", job=job_id)
+
+    await responder.send(sid, response)
+    logging.info("handle_job_cancel - exit")
+    return "job_cancel ack"
+
+
+def handlers_init():
+    '''
+    Register the socket.io event handlers, once sio and rate_limiter exist
+
+    :return None
+    '''
+    sio.on('connect', connect_handler, namespace='/')
+    sio.on('disconnect', disconnect_handler, namespace='/')
+    sio.on('shutdown', handle_shutdown_request)
+
+    # rate limited per connection, see rate_limits
+    limited = (
+        ('short_request', handle_short_request),
+        ('long_request', handle_long_request),
+        ('cpu_request', handle_cpu_request),
+        ('connections', handle_connections_request),
+        ('stdin', handle_stdin_request),
+        ('serializer', handle_serializer_request),
+        ('job_submit', handle_job_submit),
+        ('job_status', handle_job_status),
+        ('job_cancel', handle_job_cancel)
+    )
+    for event, handler in limited:
+        sio.on(event, rate_limiter.limited(event)(handler))
+
+
 #
 # main
 #
 if __name__ == "__main__":
 
+    try:
+        opts, args = getopt.getopt(sys.argv[1:] , "hw:l:", ["help", "workers=", "log=", "trusted-proxy=", "log-rate=", "log-sample=", "loop=", "rate-limit=", "stdin-policy=", "idle-timeout=", "transports=", "ping=", "compress=", "shared-results=", "cpu-start="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    if len(args) > 0:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-w", "--workers"):
+            cluster_workers = int(a)
+        elif o in ("-l", "--log"):
+            if a not in ("sync", "queue"):
+                usage()
+                sys.exit(2)
+            log_mode = a
+        elif o == "--trusted-proxy":
+            trusted_proxies = tuple(addr.strip() for addr in a.split(",") if addr.strip())
+        elif o == "--log-rate":
+            log_entry_exit_rate = float(a)
+        elif o == "--log-sample":
+            log_entry_exit_sample = int(a)
+        elif o == "--loop":
+            if a not in eventloop.CHOICES:
+                usage()
+                sys.exit(2)
+            event_loop = a
+        elif o == "--rate-limit":
+            if a == "off":
+                rate_limits = {}
+            elif a in ratelimit.MODES:
+                rate_limit_mode = a
+            else:
+                usage()
+                sys.exit(2)
+        elif o == "--stdin-policy":
+            if a not in bridge.POLICIES:
+                usage()
+                sys.exit(2)
+            stdin_feed_policy = a
+        elif o == "--idle-timeout":
+            idle_timeout = float(a)
+        elif o == "--transports":
+            transports = tuple(name.strip() for name in a.split(","))
+            if not transports or any(name not in transport.TRANSPORTS for name in transports):
+                usage()
+                sys.exit(2)
+        elif o == "--ping":
+            try:
+                ping_interval, ping_timeout = (float(value) for value in a.split(","))
+            except ValueError:
+                usage()
+                sys.exit(2)
+        elif o == "--compress":
+            compression_threshold = int(a)
+        elif o == "--shared-results":
+            if a not in ("on", "off"):
+                usage()
+                sys.exit(2)
+            shared_results = a == "on"
+        elif o == "--cpu-start":
+            if a not in ("fork", "forkserver", "spawn"):
+                usage()
+                sys.exit(2)
+            cpu_pool_start = a
+        elif o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        else:
+            assert False, "unhandled option"
+
+    if log_mode == "queue":
+        logqueue.setup(
+            logfile,
+            format="%(asctime)s: %(message)s",
+            filemode='w',
+            level=logging.INFO,
+            datefmt="%H:%M:%S",
+            entry_exit_rate=log_entry_exit_rate,
+            entry_exit_sample=log_entry_exit_sample
+        )
+    else:
+        logging.basicConfig(
+            format="%(asctime)s: %(message)s",
+            filename=logfile,
+            filemode='w',
+            level=logging.INFO,
+            datefmt="%H:%M:%S"
+        )
+
+    event_loop = eventloop.resolve(event_loop)
+
+    # creates a new Async Socket.IO Server (note: socket.io is not strictly a websocket server)
+    # in cluster mode the workers share emits and the connection list through the master
+    client_manager = cluster.ClusterManager(cluster_socket) if cluster_workers > 1 else None
+    transport_profile = transport.Profile(transports, ping_interval, ping_timeout, compression_threshold)
+    sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins='*', client_manager=client_manager, **transport_profile.server_options()) # , async_handlers=True will prevent queueing of messages from a single client
+
+    # messages and bytes by transport, see transport.py
+    transport_traffic = transport.TrafficStats()
+
+    # shared memory segments for large cpu pool results, see shmresult.py
+    shared_segments = shmresult.SegmentPool(shared_result_min, max_size=blob_max, enabled=shared_results)
+
+    # replies go out through the responder, in JSON or in the format the client asked for
+    # with the serializer request, see responses.py
+    responder = responses.Responder(sio)
+
+    # per connection event limits, replies to rejected events are sent by rate_limited()
+    rate_limiter = ratelimit.RateLimiter(rate_limits, rate_limit_mode, rate_limit_max_delay)
+
+    # STDIN lines for the subscribed clients, see bridge.py
+    stdin_feed = bridge.Bridge(sio, "stdin", stdin_feed_queue_size, stdin_feed_policy)
+
+    # socket.io event handlers, they need sio and rate_limiter
+    handlers_init()
+
     #logging.basicConfig(format="%(asctime)s: %(message)s", filename='asyncwebserver.2.log', filemode='w',  level=logging.DEBUG, datefmt="%H:%M:%S")
 
-    print("UI on http://{}:{}, logging to {}".format(server_address, server_port, logfile))
+    print("UI on http://{}:{}, logging to {}, event loop: {}".format(server_address, server_port, logfile, eventloop.describe(event_loop)))
 
-    logging.info("main - entry")
+    logging.info("main - entry, event loop: {}".format(eventloop.describe(event_loop)))
 
-    # start the STDIN reader as a daemon so that it goes away when main exits
-    t_stdin_reader = threading.Thread(target=stdin_reader, args=(), daemon=True)
+    if cluster_workers > 1:
+        # fork the workers before any thread is started, the master keeps STDIN
+        cluster_master = cluster.Master(cluster_socket, cluster_workers)
+        cluster_master.start(web_worker)
 
-    # the server isn't a daemon because it needs a clean shutdown
-    t_webserver = threading.Thread(target=web_server, args=(aiohttp_init(),), daemon=False)
+        logging.info("main - running cluster master, {} workers".format(cluster_workers))
 
-    logging.info("main - starting stdin reader")
+        cluster_master.run(stdin_pipeline) # wait for the workers to exit
+    else:
+        # start the executors while main is still the only thread
+        dispatcher_init()
+        metrics_init()
 
-    t_stdin_reader.start()
+        # the server isn't a daemon because it needs a clean shutdown
+        t_webserver = threading.Thread(target=web_server, args=(aiohttp_init(),), daemon=False)
 
-    logging.info("main - starting web server")
+        logging.info("main - starting web server")
 
-    t_webserver.start()
-    t_webserver.join() # wait for web server thread to exit
+        t_webserver.start()
+        t_webserver.join() # wait for web server thread to exit
+
+        work_dispatcher.shutdown(wait=True)
 
     print("Goodbye", flush=True)
 
@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.6
+#!/usr/bin/env python3
 #
 # Web server with websockets + does IO via STDIN/STDOUT
 #
@@ -15,6 +15,12 @@ import asyncio
 import logging
 import threading
 import aiohttp_cors
+import static_cache
+import logqueue
+import registry
+import eventloop
+import responses
+import stdio
 
 from aiohttp import web
 
@@ -22,17 +28,22 @@ server_address = "localhost"
 server_port = "8080"
 
 Verbose = False
+LogMode = "sync" # sync or queue, see logqueue.py
+EventLoop = eventloop.AUTO # auto, asyncio or uvloop, see eventloop.py
 Webserver_loop = None
-Connections = {} # could be a attrib of App
+Connections = registry.ConnectionRegistry() # could be a attrib of App
 
 def usage():
     program_name = sys.argv[0]
     print("Usage: {} [options]".format(program_name))
     print("  -h\tHelp.")
     print("  -v\tVerbose.")
+    print("  -l mode\tLogging mode, sync (default) or queue.")
+    print("  --loop=name\tEvent loop, auto (default, uvloop if installed), asyncio or uvloop.")
+    print("  --trusted-proxy=addrs\tComma separated proxy addresses whose X-Forwarded-For is believed.")
 
 try:
-   opts, args = getopt.getopt(sys.argv[1:] , "hv", ["help", "verbose"])
+   opts, args = getopt.getopt(sys.argv[1:] , "hvl:", ["help", "verbose", "log=", "loop=", "trusted-proxy="])
 except getopt.GetoptError:
    usage()
    sys.exit(2)
@@ -44,37 +55,59 @@ if len(args) > 0:
 for o, a in opts:
     if o == "-v":
         Verbose = True
+    elif o in ("-l", "--log"):
+        if a not in ("sync", "queue"):
+            usage()
+            sys.exit(2)
+        LogMode = a
+    elif o == "--loop":
+        if a not in eventloop.CHOICES:
+            usage()
+            sys.exit(2)
+        EventLoop = a
+    elif o == "--trusted-proxy":
+        Connections.trusted_proxies = frozenset(addr.strip() for addr in a.split(",") if addr.strip())
     elif o in ("-h", "--help"):
         usage()
         sys.exit(0)
     else:
         assert False, "unhandled option"
 
-if Verbose:
-    logging.info("options: {}".format(opts))
-    logging.info("args: {}".format(args))
+def reverse_lines(lines):
+    '''
+    STDIN pipeline callback, reverse each input line
 
-def stdin_reader():
+    :lines list of string A batch of input lines.
+    :return string The output
     '''
-    Read from STDIN until CTRL-D
+    reversed_lines = [line.strip()[::-1] for line in lines]
+
+    # one log record per batch, not per line
+    if Verbose:
+        logging.info("STDIN   : {}".format("\nSTDIN   : ".join(lines)))
+        logging.info("STDOUT  : {}".format("\nSTDOUT  : ".join(reversed_lines)))
+    else:
+        logging.info("STDIN   : {} line(s)".format(len(lines)))
+
+    reversed_lines.append("")
+    return "\n".join(reversed_lines)
+
+
+async def stdin_pipeline():
+    '''
+    Read from STDIN until CTRL-D, write the reversed lines to STDOUT, see stdio.py
 
-    :id int The thread id
     :return None
     '''
-    global Verbose
+    logging.info("Task    : stdin_pipeline is starting")
 
-    logging.info("Thread  : stdin_reader is starting")
+    stats = await stdio.pipeline(reverse_lines)
 
-    for line in sys.stdin:
-        s = line.strip()
-        logging.info("STDIN   : {}".format(s))
-        rs = s[::-1]
-        logging.info("STDOUT  : {}".format(rs))
-        print(rs) # reverse the input
+    logging.info("Task    : stdin_pipeline read {lines} line(s), {bytes} bytes in {seconds:.3f}s".format(**stats))
 
     shutdown_server()
 
-    logging.info("Thread  : stdin_reader is finishing")
+    logging.info("Task    : stdin_pipeline is finishing")
 
 
 def aiohttp_server():
@@ -94,10 +127,20 @@ def aiohttp_server():
     # Binds our Socket.IO server to our Web App instance
     sio.attach(app)
 
+    # replies go to the sender only, broadcasts are explicit, see responses.py
+    responder = responses.Responder(sio)
+
     # we can define aiohttp endpoints just as we normally would with no change
+    index_cache = static_cache.StaticCache()
+
     async def index_page_handler(request):
-        with open('index.html') as f:
-            return web.Response(text=f.read(), content_type='text/html')
+        return await index_cache.response(request, 'index.html')
+
+    async def startup(app):
+        # load the index page before the first client asks for it
+        await index_cache.get('index.html')
+
+    app.on_startup.append(startup)
 
 
     @sio.event(namespace='/')
@@ -115,7 +158,7 @@ def aiohttp_server():
 
         logging.info("Client connected: {}".format(sid))
 
-        Connections[sid] = environ;
+        Connections.add(sid, environ)
 
 
     @sio.event(namespace='/')
@@ -130,7 +173,8 @@ def aiohttp_server():
 
         logging.info('Client disconnected {}'.format(sid))
 
-        Connections.pop(sid, None)
+        Connections.remove(sid)
+        responder.forget(sid)
 
 
     # If we wanted to create a new websocket endpoint, use this decorator,
@@ -138,7 +182,8 @@ def aiohttp_server():
     @sio.on('message', namespace="/")
     async def message_handler(sid, message):
         # When we receive a new event of type 'message' through a socket.io connection
-        # we print the socket ID and the message
+        # we print the socket ID and the message. The reply only goes to the sender,
+        # CMD:BROADCAST:<text> sends <text> to every client.
 
         response = '{"response":"error", "response-text":"error", "response-code":400}'
 
@@ -146,13 +191,20 @@ def aiohttp_server():
             cmd = message[4:]
             if cmd == "SHUTDOWN":
                 response = '{"response":"ok", "response-text":"ok", "response-code":200}'
-                await sio.emit("message", response)
+                await responder.send(sid, response)
                 shutdown_server()
+            elif cmd.startswith("BROADCAST:"):
+                text = cmd[len("BROADCAST:"):]
+                recipients, secs = await responder.broadcast({"response": text, "response-text": "broadcast", "response-code": 200, "from": sid})
+                logging.info("Thread  : broadcast to {} client(s) in {:.3f}ms".format(recipients, secs * 1000))
+                response = responses.json_dumps({"response": "ok", "response-text": "ok", "response-code": 200, "recipients": recipients, "fan-out-ms": round(secs * 1000, 3)})
+                await responder.send(sid, response)
             else:
                 logging.info("Thread  : Invalid command {}".format(cmd))
+                await responder.send(sid, response)
         else:
-            response = '{"response":' + message[::-1] + ', "response-text":"ok", "response-code":200}'
-            await sio.emit("message", response)
+            response = responses.json_dumps({"response": message[::-1], "response-text": "ok", "response-code": 200})
+            await responder.send(sid, response)
             logging.info("Thread  : socket response: {}".format(response))
 
     # We bind our aiohttp endpoint to our app router
@@ -183,13 +235,17 @@ def run_server(runner):
     global Webserver_loop
 
     logging.info("Thread  : run_server entry")
-    Webserver_loop = asyncio.new_event_loop()
+    Webserver_loop = eventloop.new_event_loop(EventLoop)
     asyncio.set_event_loop(Webserver_loop)
 
     # server setup
     Webserver_loop.run_until_complete(runner.setup())
     site = web.TCPSite(runner, server_address, server_port)
     Webserver_loop.run_until_complete(site.start())
+
+    # STDIN is read on the server's loop, no thread of its own
+    stdin_task = Webserver_loop.create_task(stdin_pipeline()) # the loop only keeps a weak reference
+
     logging.info("Thread  : run_server start loop")
 
     # start the server, run until explicitly stopped
@@ -211,8 +267,9 @@ def shutdown_server():
 
     logging.info("shutdown_server: entry")
 
-    # before stopping the web server, cancel all tasks
-    for task in asyncio.Task.all_tasks(Webserver_loop):
+    # before stopping the web server, cancel all tasks (Task.all_tasks is gone in python 3.9)
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    for task in all_tasks(Webserver_loop):
         logging.info("shutdown_server: Cancel task")
         Webserver_loop.call_soon_threadsafe(task.cancel)
 
@@ -228,16 +285,25 @@ if __name__ == "__main__":
     # setup logging
     logfile = 'asyncwebserver.log'
     format = "%(asctime)s: %(message)s"
-    logging.basicConfig(format=format, filename=logfile, filemode='w',  level=logging.INFO, datefmt="%H:%M:%S")
+    if LogMode == "queue":
+        # log records are written by a separate thread, see logqueue.py
+        logqueue.setup(logfile, format=format, filemode='w', level=logging.INFO, datefmt="%H:%M:%S")
+    else:
+        logging.basicConfig(format=format, filename=logfile, filemode='w',  level=logging.INFO, datefmt="%H:%M:%S")
 
-    print("UI on http://{}:{}. Logging to {}".format(server_address, server_port, logfile))
+    # after logging is set up, falling back to asyncio logs a warning
+    EventLoop = eventloop.resolve(EventLoop)
 
-    logging.info("Main    : Entry")
+    print("UI on http://{}:{}. Logging to {}. Event loop: {}".format(server_address, server_port, logfile, eventloop.describe(EventLoop)))
 
-    logging.info("Main    : Creating threads ...")
+    logging.info("Main    : Entry, event loop: {}".format(eventloop.describe(EventLoop)))
 
-    # start the STDIN reader as a daemon so that it goes away when main exits
-    t_stdin_reader = threading.Thread(target=stdin_reader, args=(), daemon=True)
+    # not before logging is set up, the first logging call configures it
+    if Verbose:
+        logging.info("options: {}".format(opts))
+        logging.info("args: {}".format(args))
+
+    logging.info("Main    : Creating threads ...")
 
     # the server isn't a daemon because it needs a clean shutdown
     t_webserver = threading.Thread(target=run_server, args=(aiohttp_server(),), daemon=False)
@@ -246,7 +312,6 @@ if __name__ == "__main__":
 
     logging.info("Main    : Starting threads ...")
 
-    t_stdin_reader.start()
     t_webserver.start()
 
     logging.info("Main    : Starting threads ... done.")
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+#
+# socket.io load generator for asyncwebserver.2.py
+#
+# Starts the server (or uses one already running), connects many socket.io clients
+# and has each of them send requests back to back for a while, picking the event
+# from a weighted mix. Latency is the time to the request's ack.
+#
+# Throughput counts the requests answered within the run time. Requests still
+# in flight at the end are waited for, their latency is recorded.
+#
+# Every request carries a nonce of its own, so a server that caches or coalesces
+# identical requests still has to run each one. --cached sends the same {}
+# payload every time, which measures the cache instead.
+#
+# Reports throughput, latency percentiles per event and the server's memory per
+# connection (resident memory of the server and its child processes, before and
+# after the clients connect), and saves everything as JSON. Compare against an
+# earlier run with --compare to catch regressions.
+#
+# Example:
+#   ./benchmark.py -c 1000 -d 30 --mix=short_request:8,connections:1,long_request:1 -o run.json
+#   ./benchmark.py -c 1000 -d 30 --compare=run.json
+#
+
+import os
+import sys
+import json
+import time
+import random
+import getopt
+import itertools
+import asyncio
+import platform
+import subprocess
+import urllib.request
+
+import socketio
+
+#
+# globals
+#
+url = "http://localhost:8080"
+server = "asyncwebserver.2.py"
+server_args = ["--rate-limit=off"] # clients send back to back, far over the per connection limits
+start_server = True
+clients = 100
+duration = 10.0
+connect_batch = 100
+request_timeout = 30.0
+mix = {"short_request": 1}
+output = None
+compare = None
+tolerance = 10.0 # percent
+unique_payloads = True # False to send {} every time, repeats may be answered from a cache
+
+def usage():
+    program_name = sys.argv[0]
+    print("Usage: {} [options]".format(program_name))
+    print("  -h\tHelp.")
+    print("  -c n\tConcurrent clients, default {}.".format(clients))
+    print("  -d secs\tHow long to send requests, default {}.".format(duration))
+    print("  -o file\tSave the results as JSON.")
+    print("  --mix=event:weight,...\tRequests to send, default short_request:1.")
+    print("  --server=script\tServer to start, default {}.".format(server))
+    print("  --server-args=args\tServer options, default \"{}\", e.g. \"-w 4 --loop=uvloop\".".format(" ".join(server_args)))
+    print("  --url=url\tUse the server already running at url, don't start one.")
+    print("  --batch=n\tClients connecting at the same time, default {}.".format(connect_batch))
+    print("  --compare=file\tCompare with an earlier run, exit 1 on a regression.")
+    print("  --tolerance=pct\tAllowed throughput drop / latency increase, default {}.".format(tolerance))
+    print("  --cached\tSend identical payloads, a caching server may answer repeats from its cache.")
+
+def parse_mix(value):
+    '''
+    :value string "event:weight,event:weight", weights default to 1
+    :return dict event -> weight
+    '''
+    result = {}
+    for item in value.split(","):
+        event, _, weight = item.partition(":")
+        result[event.strip()] = float(weight) if weight else 1.0
+    return result
+
+# request nonces, unique across the run's clients
+nonces = itertools.count()
+
+#
+# helpers
+#
+
+def percentile(samples, p):
+    '''
+    :samples list sorted
+    :p float 0 - 100
+    :return float None if there are no samples
+    '''
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def latency_stats(samples):
+    '''
+    :samples list of seconds
+    :return dict milliseconds
+    '''
+    samples = sorted(samples)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "count": len(samples),
+        "mean": ms(sum(samples) / len(samples)) if samples else None,
+        "p50": ms(percentile(samples, 50)),
+        "p99": ms(percentile(samples, 99)),
+        "p999": ms(percentile(samples, 99.9)),
+        "max": ms(samples[-1]) if samples else None
+    }
+
+
+def process_tree_rss(pid):
+    '''
+    Resident memory of a process and its descendants, from /proc (Linux only)
+
+    :pid int
+    :return int bytes, None if unavailable
+    '''
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            rss = next((int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:")), 0)
+
+        children = []
+        for task in os.listdir("/proc/{}/task".format(pid)):
+            with open("/proc/{}/task/{}/children".format(pid, task)) as f:
+                children += [int(c) for c in f.read().split()]
+    except OSError:
+        return None
+
+    for child in children:
+        rss += process_tree_rss(child) or 0
+
+    return rss
+
+
+def raise_fd_limit(needed):
+    '''
+    Every client holds a socket, raise the soft open file limit as far as allowed
+    '''
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard == resource.RLIM_INFINITY else min(hard, max(needed, soft)), hard))
+
+
+def wait_for_server(timeout=15.0):
+    '''
+    :return bool True once the server answers on url
+    '''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+#
+# load
+#
+
+async def connect_clients(n):
+    '''
+    Connect n clients, connect_batch at a time
+
+    :return tuple (list of connected socketio.AsyncClient, number that failed)
+    '''
+    connected = []
+    failed = 0
+
+    async def connect():
+        client = socketio.AsyncClient(reconnection=False)
+        await client.connect(url, transports=['websocket'])
+        return client
+
+    for i in range(0, n, connect_batch):
+        results = await asyncio.gather(*[connect() for j in range(min(connect_batch, n - i))], return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                failed += 1
+            else:
+                connected.append(r)
+
+    return connected, failed
+
+
+def ack_outcome(event, ack):
+    '''
+    :event string
+    :ack The handler's return value, e.g. "short_request ack" or "long_request timeout".
+    :return string "ok", "busy" (try again later) or "error"
+    '''
+    if not isinstance(ack, str):
+        return "error"
+    if ack.endswith(("busy", "rate-limited")):
+        return "busy"
+    # "<event> ack" or "<event>_ack", job_submit acks with the job id
+    if ack.endswith("ack") or (event == "job_submit" and " " not in ack):
+        return "ok"
+    return "error"
+
+
+async def drive(client, deadline, events, weights, results):
+    '''
+    Send requests from one client, one at a time, until deadline
+
+    :results dict event -> {"latency": [], "in_time": int, "busy": int, "errors": int}
+    '''
+    while time.monotonic() < deadline:
+        event = random.choices(events, weights)[0]
+        result = results[event]
+        started = time.perf_counter()
+        try:
+            payload = {"nonce": next(nonces)} if unique_payloads else {}
+            ack = await client.call(event, payload, timeout=request_timeout)
+        except (socketio.exceptions.TimeoutError, socketio.exceptions.BadNamespaceError, socketio.exceptions.DisconnectedError):
+            result["errors"] += 1
+            if not client.connected:
+                return
+            continue
+
+        outcome = ack_outcome(event, ack)
+        if outcome == "busy":
+            result["busy"] += 1
+        elif outcome == "error":
+            result["errors"] += 1
+        else:
+            result["latency"].append(time.perf_counter() - started)
+            if time.monotonic() <= deadline:
+                result["in_time"] += 1
+
+
+async def run(server_pid):
+    '''
+    :server_pid int For memory readings, None if unknown.
+    :return dict The results
+    '''
+    rss_before = process_tree_rss(server_pid) if server_pid else None
+
+    connect_started = time.perf_counter()
+    connected, failed = await connect_clients(clients)
+    connect_time = time.perf_counter() - connect_started
+
+    # let the server settle before reading its memory
+    await asyncio.sleep(1.0)
+    rss_after = process_tree_rss(server_pid) if server_pid else None
+
+    events = list(mix)
+    weights = [mix[e] for e in events]
+    results = {e: {"latency": [], "in_time": 0, "busy": 0, "errors": 0} for e in events}
+
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[drive(c, deadline, events, weights, results) for c in connected])
+
+    await asyncio.gather(*[c.disconnect() for c in connected], return_exceptions=True)
+
+    completed = sum(r["in_time"] for r in results.values())
+    memory = None
+    if rss_before is not None and rss_after is not None:
+        memory = {
+            "rss_before": rss_before,
+            "rss_after": rss_after,
+            "per_connection": round((rss_after - rss_before) / len(connected)) if connected else None
+        }
+
+    return {
+        "clients": {"requested": clients, "connected": len(connected), "failed": failed, "connect_time": round(connect_time, 3)},
+        "duration": duration,
+        "requests": completed,
+        "throughput": round(completed / duration, 1),
+        "events": {
+            e: dict(latency_stats(r["latency"]), busy=r["busy"], errors=r["errors"],
+                    throughput=round(r["in_time"] / duration, 1))
+            for e, r in results.items()
+        },
+        "memory": memory
+    }
+
+
+def regressions(result, baseline):
+    '''
+    :return list of strings, one per metric that got worse by more than tolerance
+    '''
+    found = []
+    limit = tolerance / 100
+
+    if baseline.get("throughput") and result["throughput"] is not None:
+        if result["throughput"] < baseline["throughput"] * (1 - limit):
+            found.append("throughput {} -> {} req/s".format(baseline["throughput"], result["throughput"]))
+
+    for event, stats in result["events"].items():
+        before = baseline.get("events", {}).get(event)
+        if before is None:
+            continue
+        for p in ("p50", "p99", "p999"):
+            if before.get(p) and stats.get(p) is not None and stats[p] > before[p] * (1 + limit):
+                found.append("{} {} {} -> {} ms".format(event, p, before[p], stats[p]))
+
+    before = (baseline.get("memory") or {}).get("per_connection")
+    after = (result.get("memory") or {}).get("per_connection")
+    if before and after is not None and after > before * (1 + limit):
+        found.append("memory per connection {} -> {} bytes".format(before, after))
+
+    return found
+
+
+def report(result):
+    if result["config"]["payloads"] == "unique":
+        print("payloads: unique, every request runs")
+    else:
+        print("payloads: identical (--cached), repeats may be answered from a cache")
+    print("clients: {connected} connected, {failed} failed, in {connect_time}s".format(**result["clients"]))
+    print("requests: {} in {}s, {} req/s".format(result["requests"], result["duration"], result["throughput"]))
+    for event, stats in result["events"].items():
+        print("  {:<16} {:>8} ok {:>6} busy {:>6} errors  p50 {} ms  p99 {} ms  p999 {} ms".format(
+            event, stats["count"], stats["busy"], stats["errors"], stats["p50"], stats["p99"], stats["p999"]))
+    if result["memory"]:
+        print("server memory: {rss_before} -> {rss_after} bytes, {per_connection} bytes per connection".format(**result["memory"]))
+
+#
+# main
+#
+if __name__ == "__main__":
+
+    try:
+       opts, args = getopt.getopt(sys.argv[1:], "hc:d:o:", ["help", "mix=", "server=", "server-args=", "url=", "batch=", "compare=", "tolerance=", "cached"])
+    except getopt.GetoptError:
+       usage()
+       sys.exit(2)
+
+    if len(args) > 0:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-c":
+            clients = int(a)
+        elif o == "-d":
+            duration = float(a)
+        elif o == "-o":
+            output = a
+        elif o == "--mix":
+            mix = parse_mix(a)
+        elif o == "--server":
+            server = a
+        elif o == "--server-args":
+            server_args = a.split()
+        elif o == "--url":
+            url = a
+            start_server = False
+        elif o == "--batch":
+            connect_batch = int(a)
+        elif o == "--compare":
+            compare = a
+        elif o == "--tolerance":
+            tolerance = float(a)
+        elif o == "--cached":
+            unique_payloads = False
+        elif o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        else:
+            assert False, "unhandled option"
+
+    raise_fd_limit(clients + 256)
+
+    process = None
+    if start_server:
+        # the server exits when its STDIN is closed
+        here = os.path.dirname(os.path.abspath(__file__))
+        process = subprocess.Popen([sys.executable, server] + server_args, cwd=here,
+                                   stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        if not wait_for_server():
+            process.kill()
+            print("server did not start")
+            sys.exit(1)
+
+    try:
+        result = asyncio.new_event_loop().run_until_complete(run(process.pid if process else None))
+    finally:
+        if process is not None:
+            process.stdin.close()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    result["config"] = {
+        "url": url,
+        "server": server if start_server else None,
+        "server_args": server_args,
+        "clients": clients,
+        "duration": duration,
+        "mix": mix,
+        "payloads": "unique" if unique_payloads else "cached",
+        "python": platform.python_version(),
+        "started_on": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+    report(result)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+        print("results saved to {}".format(output))
+
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)
+        found = regressions(result, baseline)
+        if baseline.get("config", {}).get("payloads", "cached") != result["config"]["payloads"]:
+            print("note: {} was run with {} payloads, this run with {}".format(
+                compare, baseline.get("config", {}).get("payloads", "cached"), result["config"]["payloads"]))
+        if found:
+            print("regressions against {} (tolerance {}%):".format(compare, tolerance))
+            for line in found:
+                print("  " + line)
+            sys.exit(1)
+        print("no regressions against {} (tolerance {}%)".format(compare, tolerance))
+
+# end file
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+#
+# STDIN to socket.io bridge
+#
+# Lines published to the bridge are streamed to every subscribed client. Each
+# subscriber has a bounded send queue and a sender task of its own, so a stalled
+# browser only holds up its own feed:
+#
+#   - the sender sends everything queued as one message and waits for the client's
+#     ack (or ack_timeout) before sending the next, so at most one message per
+#     client is in flight and queued lines are batched while it is
+#   - a message not acked in time goes back to the front of the queue and is sent
+#     again with what was queued since, so a client may see a seq twice. Lines that
+#     no longer fit the queue are dropped.
+#   - when the queue is full the slow consumer policy applies: DROP_OLDEST drops
+#     the oldest queued line, COALESCE keeps only the newest line
+#
+# A message is {"seq": first line's number, "lines": [...], "dropped": lines
+# dropped since the last message}. Lines are numbered as they are published, so
+# a client can also spot a gap itself.
+#
+# Per client sent / dropped counts and lag (lines and seconds behind the newest
+# published line) are kept, see stats().
+#
+# All methods must be called from the event loop thread.
+#
+
+import time
+import asyncio
+import collections
+
+DROP_OLDEST = "drop-oldest"
+COALESCE = "coalesce"
+
+POLICIES = (DROP_OLDEST, COALESCE)
+
+
+class Subscriber:
+    '''
+    One client's send queue and counters
+    '''
+
+    def __init__(self, sid, queue_size, policy):
+        self.sid = sid
+        # (seq, published_on, line), a COALESCE queue holds only the newest line
+        self.queue = collections.deque(maxlen=queue_size if policy == DROP_OLDEST else 1)
+        self.ready = asyncio.Event()
+        self.task = None
+        self.sent = 0 # lines acked by the client
+        self.messages = 0
+        self.dropped = 0
+        self.unsent_drops = 0 # dropped since the last message
+        self.timeouts = 0 # acks that did not arrive in time
+        self.retried = 0 # lines sent again after a timeout
+        self.acked_seq = 0 # last line the client acked
+        self.oldest_unacked_on = None # published_on of the oldest line not yet acked
+
+    def lag(self, last_seq, now):
+        '''
+        :return tuple (lines, seconds) behind the newest published line
+        '''
+        seconds = now - self.oldest_unacked_on if self.oldest_unacked_on is not None else 0.0
+        return last_seq - self.acked_seq, seconds
+
+    def to_dict(self, last_seq, now):
+        lines, seconds = self.lag(last_seq, now)
+        return {
+            "queued": len(self.queue),
+            "sent": self.sent,
+            "messages": self.messages,
+            "dropped": self.dropped,
+            "timeouts": self.timeouts,
+            "retried": self.retried,
+            "lag_lines": lines,
+            "lag_secs": round(seconds, 3)
+        }
+
+
+class Bridge:
+    '''
+    Stream published lines to subscribed sids
+    '''
+
+    def __init__(self, sio, event="stdin", queue_size=256, policy=DROP_OLDEST, ack_timeout=5.0):
+        '''
+        :sio socketio.AsyncServer
+        :event string The event the lines are sent as.
+        :queue_size int Lines queued per client, DROP_OLDEST only.
+        :policy string DROP_OLDEST or COALESCE.
+        :ack_timeout float Seconds to wait for a client's ack before sending the next message.
+        '''
+        if policy not in POLICIES:
+            raise ValueError("unknown slow consumer policy {}, use one of {}".format(policy, ", ".join(POLICIES)))
+
+        self.sio = sio
+        self.event = event
+        self.queue_size = queue_size
+        self.policy = policy
+        self.ack_timeout = ack_timeout
+        self.subscribers = {} # sid -> Subscriber
+        self.last_seq = 0
+        self.published = 0
+        self.dropped = 0 # lines dropped, every subscriber
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self, sid):
+        '''
+        Start streaming to sid, from the next published line
+
+        :return bool False if sid was already subscribed
+        '''
+        if sid in self.subscribers:
+            return False
+
+        subscriber = Subscriber(sid, self.queue_size, self.policy)
+        subscriber.acked_seq = self.last_seq
+        subscriber.task = asyncio.ensure_future(self._sender(subscriber))
+        self.subscribers[sid] = subscriber
+        return True
+
+    def unsubscribe(self, sid):
+        '''
+        Stop streaming to sid, e.g. on disconnect
+
+        :return bool False if sid was not subscribed
+        '''
+        subscriber = self.subscribers.pop(sid, None)
+        if subscriber is None:
+            return False
+        subscriber.task.cancel()
+        return True
+
+    def publish(self, lines):
+        '''
+        Queue lines for every subscriber. Never waits.
+
+        :lines list of string
+        :return None
+        '''
+        now = time.monotonic()
+        first_seq = self.last_seq + 1
+        self.last_seq += len(lines)
+        self.published += len(lines)
+
+        if not self.subscribers:
+            return
+
+        # every queue has the same maxlen, lines before the last maxlen would only be dropped
+        maxlen = self.queue_size if self.policy == DROP_OLDEST else 1
+        skipped = max(0, len(lines) - maxlen)
+        records = [(seq, now, line) for seq, line in enumerate(lines[skipped:], first_seq + skipped)]
+
+        for subscriber in self.subscribers.values():
+            queue = subscriber.queue
+            # the deque drops its oldest lines on extend
+            drops = max(0, len(queue) + len(lines) - maxlen)
+            if drops:
+                subscriber.dropped += drops
+                subscriber.unsent_drops += drops
+                self.dropped += drops
+            queue.extend(records)
+
+            if subscriber.oldest_unacked_on is None:
+                subscriber.oldest_unacked_on = now
+            subscriber.ready.set()
+
+    async def _sender(self, subscriber):
+        '''
+        One per subscriber: send what is queued, wait for the ack, repeat
+        '''
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await subscriber.ready.wait()
+            subscriber.ready.clear()
+
+            while subscriber.queue:
+                batch = list(subscriber.queue)
+                subscriber.queue.clear()
+
+                message = {"seq": batch[0][0], "lines": [line for seq, published_on, line in batch],
+                           "dropped": subscriber.unsent_drops}
+                subscriber.unsent_drops = 0
+
+                acked = loop.create_future()
+
+                def on_ack(*args, acked=acked):
+                    if not acked.done():
+                        acked.set_result(None)
+
+                await self.sio.emit(self.event, message, room=subscriber.sid, callback=on_ack)
+                subscriber.messages += 1
+
+                try:
+                    await asyncio.wait_for(acked, self.ack_timeout)
+                except asyncio.TimeoutError:
+                    subscriber.timeouts += 1
+                    self._requeue(subscriber, batch)
+                    continue
+
+                subscriber.sent += len(batch)
+                subscriber.acked_seq = batch[-1][0]
+                subscriber.oldest_unacked_on = subscriber.queue[0][1] if subscriber.queue else None
+
+    def _requeue(self, subscriber, batch):
+        '''
+        Put a batch that was not acked back in front of the lines queued since,
+        dropping the oldest lines that no longer fit
+
+        :subscriber Subscriber
+        :batch list of (seq, published_on, line)
+        :return None
+        '''
+        queue = subscriber.queue
+        records = batch + list(queue)
+        drops = max(0, len(records) - queue.maxlen)
+        if drops:
+            subscriber.dropped += drops
+            subscriber.unsent_drops += drops
+            self.dropped += drops
+
+        queue.clear()
+        queue.extend(records[drops:])
+        subscriber.retried += len(batch) - min(drops, len(batch))
+
+    def stats(self, top=10):
+        '''
+        :top int Number of clients to list, most lines behind first.
+        :return dict
+        '''
+        now = time.monotonic()
+        lagging = sorted(self.subscribers.values(), key=lambda s: s.lag(self.last_seq, now), reverse=True)[:top]
+        return {
+            "subscribers": len(self.subscribers),
+            "policy": self.policy,
+            "published": self.published,
+            "dropped": self.dropped,
+            "clients": {s.sid: s.to_dict(self.last_seq, now) for s in lagging}
+        }
+
+    def max_lag(self):
+        '''
+        :return tuple (lines, seconds) of the subscriber furthest behind
+        '''
+        now = time.monotonic()
+        lags = [s.lag(self.last_seq, now) for s in self.subscribers.values()]
+        return (max(l[0] for l in lags), max(l[1] for l in lags)) if lags else (0, 0.0)
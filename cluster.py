@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#
+# Multi-process cluster mode for the socket.io web server
+#
+# The master process forks N workers. Each worker runs its own event loop and
+# aiohttp app, and binds the same port with SO_REUSEPORT so the kernel spreads
+# incoming connections across them.
+#
+# Workers talk to each other through a relay (Master) listening on a Unix socket.
+# Every message a worker sends is relayed to all workers, one JSON object per
+# line. ClusterManager plugs this into python-socketio as a pub/sub client
+# manager, so sio.emit() to a room or to everyone reaches the clients of every
+# worker. The same channel carries connect/disconnect notices, which gives each
+# worker a node wide view of the connected clients. No Redis required.
+#
+# The relay never waits for a slow worker. Once more than high_water bytes are
+# waiting to go to a worker, emits for it are dropped (and counted) until it
+# catches up. Connect/disconnect notices are always sent, the workers' view of
+# the clients depends on them.
+#
+# A line longer than MAX_MESSAGE is a protocol error, the relay drops the worker
+# that sent it and the worker reconnects. Workers don't send such lines.
+#
+
+import os
+import sys
+import json
+import uuid
+import signal
+import socket
+import asyncio
+import logging
+import threading
+
+# python-socketio 5, the base class for pub/sub backed client managers
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+import registry
+
+# relayed lines starting with this are connect/disconnect notices, see ClusterManager._send()
+REGISTRY_PREFIX = json.dumps({"method": "registry"})[:-1].encode()
+
+# longest relayed line in bytes, asyncio streams stop at 64KB by default
+MAX_MESSAGE = 16 * 1024 * 1024
+
+
+class Master:
+    '''
+    Fork the workers and relay messages between them
+    '''
+
+    def __init__(self, path, workers, high_water=4 * 1024 * 1024):
+        '''
+        :path string Unix socket path for the relay.
+        :workers int Number of worker processes.
+        :high_water int Bytes buffered for a worker before emits to it are dropped.
+        '''
+        self.path = path
+        self.workers = workers
+        self.high_water = high_water
+        self.pids = []
+        self.writers = {} # writer -> worker pid, None until its hello
+        self.sock = None
+        self.relayed = 0
+        self.dropped = 0 # emits not sent to a worker that was over high_water
+        self.dropping = set() # writers over high_water
+
+    def start(self, target):
+        '''
+        Bind the relay socket and fork the workers. Call before starting threads.
+
+        :target callable Run by each worker, the worker exits when it returns.
+        :return None
+        '''
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        # bind before forking so the workers can connect right away
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(self.workers)
+
+        for i in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.sock.close()
+                code = 0
+                try:
+                    # Ctrl-C goes to the whole process group, let the master stop us
+                    signal.signal(signal.SIGINT, signal.SIG_IGN)
+                    target()
+                except Exception:
+                    logging.exception("cluster worker - failed")
+                    code = 1
+                finally:
+                    # os._exit() skips the exit handlers that flush stdout and the log
+                    sys.stdout.flush()
+                    logging.shutdown()
+                    os._exit(code)
+
+            self.pids.append(pid)
+            logging.info("cluster master - started worker {}".format(pid))
+
+    def stop(self):
+        '''
+        Ask every worker to shut down. Safe to call from any thread.
+
+        :return None
+        '''
+        logging.info("cluster master - stopping workers")
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _wait_workers(self, loop):
+        '''
+        Thread target, stops the relay loop once every worker has exited
+        '''
+        for pid in self.pids:
+            os.waitpid(pid, 0)
+            logging.info("cluster master - worker {} exited".format(pid))
+        loop.call_soon_threadsafe(loop.stop)
+
+    def run(self, *coroutines):
+        '''
+        Relay messages until every worker has exited. Blocks.
+
+        :coroutines coroutine functions Also run on the relay loop, e.g. a STDIN reader.
+        :return None
+        '''
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        server = loop.run_until_complete(asyncio.start_unix_server(self._relay, sock=self.sock, limit=MAX_MESSAGE))
+
+        tasks = [loop.create_task(coroutine()) for coroutine in coroutines]
+
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+
+        threading.Thread(target=self._wait_workers, args=(loop,), daemon=True).start()
+
+        logging.info("cluster master - relaying on {}".format(self.path))
+        loop.run_forever()
+
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+        os.unlink(self.path)
+        logging.info("cluster master - exit, {} message(s) relayed, {} dropped".format(self.relayed, self.dropped))
+
+    def _fan_out(self, line):
+        '''
+        Write a line to every worker, dropping emits for the ones over high_water
+
+        :line bytes
+        :return None
+        '''
+        self.relayed += 1
+        droppable = not line.startswith(REGISTRY_PREFIX)
+
+        for w, worker in self.writers.items():
+            over = w.transport.get_write_buffer_size() > self.high_water
+            if over and droppable:
+                self.dropped += 1
+                if w not in self.dropping:
+                    self.dropping.add(w)
+                    logging.info("cluster master - worker {} is behind, dropping emits to it".format(worker))
+                continue
+            if not over and w in self.dropping:
+                self.dropping.discard(w)
+                logging.info("cluster master - worker {} caught up, {} emit(s) dropped so far".format(worker, self.dropped))
+            w.write(line)
+
+    async def _relay(self, reader, writer):
+        '''
+        Connection handler, one per worker
+        '''
+        self.writers[writer] = None
+        worker = None
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                if worker is None:
+                    # the first message is the worker's hello
+                    worker = json.loads(line.decode()).get("worker")
+                    self.writers[writer] = worker
+
+                # everyone gets it, the sender included
+                self._fan_out(line)
+        except ConnectionError:
+            pass
+        except ValueError as e:
+            # an over long line (readline() raises ValueError) or a bad hello, the
+            # stream can't be trusted any more
+            logging.info("cluster master - dropping worker {}: {}".format(worker, e))
+        finally:
+            self.writers.pop(writer, None)
+            self.dropping.discard(writer)
+            writer.close()
+
+            if worker is not None:
+                # the other workers forget this worker's clients
+                gone = json.dumps({"method": "registry", "op": "gone", "worker": worker}) + "\n"
+                self._fan_out(gone.encode())
+
+
+class ClusterManager(AsyncPubSubManager):
+    '''
+    socket.io client manager that shares emits and clients through the Master relay
+    '''
+
+    name = 'cluster'
+
+    # seconds to wait before reconnecting to the relay
+    retry_delay = 1.0
+
+    def __init__(self, path, channel='socketio', write_only=False, logger=None):
+        '''
+        :path string The Master's Unix socket path.
+        '''
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.worker = None
+        self.local = set()  # sids connected to this worker
+        self.remote = {}    # worker pid -> set of sids connected to that worker
+        self.node = registry.SidIndex() # every sid on the node, in arrival order
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    def initialize(self):
+        # the manager was created before the workers were forked, and the pub/sub
+        # manager drops messages carrying its own host_id, so each worker needs its own
+        self.host_id = uuid.uuid4().hex
+        super().initialize()
+
+    async def _connect(self):
+        '''
+        Connect to the relay if needed
+
+        :return asyncio.StreamReader
+        '''
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self._writer is None:
+                try:
+                    self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=MAX_MESSAGE)
+                except OSError:
+                    await asyncio.sleep(self.retry_delay)
+                    raise
+
+                # pid is only known for sure after the fork
+                self.worker = os.getpid()
+
+                # announce ourselves and our clients, the others reply with theirs
+                self._send({"method": "registry", "op": "hello", "worker": self.worker, "sids": list(self.local)})
+
+        return self._reader
+
+    def _send(self, message):
+        line = (json.dumps(message) + "\n").encode()
+        if len(line) > MAX_MESSAGE:
+            # the relay would drop this worker for it
+            logging.info("cluster worker {} - not relaying a {} byte message, over {} bytes".format(self.worker, len(line), MAX_MESSAGE))
+            return
+        self._writer.write(line)
+
+    async def _publish(self, data):
+        await self._connect()
+        self._send(data)
+        await self._writer.drain()
+
+    async def _listen(self):
+        reader = await self._connect()
+
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # over MAX_MESSAGE, start over on a new connection
+                line = b""
+                self._writer.close()
+
+            if not line:
+                self._writer = None
+                await asyncio.sleep(self.retry_delay)
+                raise ConnectionError("cluster relay closed the connection")
+
+            message = json.loads(line.decode())
+
+            if message.get("method") == "registry":
+                self._handle_registry(message)
+            else:
+                yield message
+
+    def _handle_registry(self, message):
+        '''
+        Apply another worker's connect/disconnect notice
+        '''
+        worker = message.get("worker")
+        if worker == self.worker:
+            return
+
+        op = message.get("op")
+
+        if op == "connect":
+            self.remote.setdefault(worker, set()).add(message["sid"])
+            self.node.add(message["sid"])
+        elif op == "disconnect":
+            self.remote.get(worker, set()).discard(message["sid"])
+            self.node.remove(message["sid"])
+        elif op in ("hello", "snapshot"):
+            self._forget(worker)
+            self.remote[worker] = set(message.get("sids", []))
+            for sid in self.remote[worker]:
+                self.node.add(sid)
+            if op == "hello":
+                self._send({"method": "registry", "op": "snapshot", "worker": self.worker, "sids": list(self.local)})
+        elif op == "gone":
+            self._forget(worker)
+
+    def _forget(self, worker):
+        '''
+        Drop every client of a worker
+        '''
+        for sid in self.remote.pop(worker, ()):
+            self.node.remove(sid)
+
+    async def add_client(self, sid):
+        '''
+        Tell the other workers a client connected here
+
+        :sid string
+        :return None
+        '''
+        self.local.add(sid)
+        self.node.add(sid)
+        await self._connect()
+        await self._publish({"method": "registry", "op": "connect", "worker": self.worker, "sid": sid})
+
+    async def remove_client(self, sid):
+        '''
+        Tell the other workers a client disconnected from here
+
+        :sid string
+        :return None
+        '''
+        self.local.discard(sid)
+        self.node.remove(sid)
+        await self._connect()
+        await self._publish({"method": "registry", "op": "disconnect", "worker": self.worker, "sid": sid})
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Request coalescing and result caching for the executor backed handlers
+#
+# Identical requests (same event, same payload once normalized) that arrive while
+# one is already running share its executor job instead of queueing their own
+# ("single flight"). Results are then kept in an LRU cache for `ttl` seconds, so a
+# repeat shortly after is answered without touching the executor at all.
+#
+# Failures are never cached: a busy reply or an exception goes to everyone waiting
+# on that flight, and the next request starts a new one.
+#
+# Every request that joins a flight becomes an owner of its admission.Job, so the
+# job is only cancelled once every client waiting on it has gone away. The first
+# request's deadline applies to the whole flight.
+#
+
+import json
+import time
+import asyncio
+import collections
+
+HIT = "hit"
+MISS = "miss"
+COALESCED = "coalesced"
+
+
+def make_key(event, payload):
+    '''
+    Cache key for a request: the event name and its payload with dict keys sorted
+
+    :event string
+    :payload The socket.io event data.
+    :return string
+    '''
+    try:
+        normalized = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    except (TypeError, ValueError):
+        normalized = repr(payload)
+    return event + ":" + normalized
+
+
+class ResultCache:
+    '''
+    LRU cache whose entries also expire after ttl seconds
+    '''
+
+    def __init__(self, maxsize=256, ttl=10.0):
+        '''
+        :maxsize int Most entries kept, least recently used go first.
+        :ttl float Seconds an entry stays valid.
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expires_on, value)
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+        :key string
+        :return tuple (True, value) on a hit, (False, None) otherwise
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+
+        if entry[0] <= time.monotonic():
+            del self.entries[key]
+            self.expired += 1
+            return False, None
+
+        self.entries.move_to_end(key)
+        return True, entry[1]
+
+    def put(self, key, value):
+        '''
+        :key string
+        :value
+        :return None
+        '''
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+
+class Coalescer:
+    '''
+    Single flight executor jobs with a ResultCache behind them
+    '''
+
+    def __init__(self, name, maxsize=256, ttl=10.0):
+        '''
+        :name string For stats.
+        :maxsize int See ResultCache.
+        :ttl float See ResultCache.
+        '''
+        self.name = name
+        self.cache = ResultCache(maxsize, ttl)
+        self.flights = {} # key -> admission.Job in flight
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def run(self, key, start, owner=None):
+        '''
+        Get the result for key from the cache, from the job already in flight for
+        key, or from a new job
+
+        :key string See make_key().
+        :start callable Starts the job and returns its admission.Job, only called on
+                        a miss. Exceptions it raises (admission.QueueFull) go to the caller.
+        :owner Added to the owners of a job in flight, see admission.AdmissionQueue.add_owner().
+        :return tuple (result, HIT, COALESCED or MISS)
+        :raises admission.Cancelled
+        '''
+        found, value = self.cache.get(key)
+        if found:
+            self.hits += 1
+            return value, HIT
+
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            if owner is not None:
+                flight.queue.add_owner(flight, owner)
+            # shield: one waiter going away must not cancel the others' job
+            return await asyncio.shield(flight.future), COALESCED
+
+        self.misses += 1
+        flight = start()
+        self.flights[key] = flight
+        flight.future.add_done_callback(lambda f: self._landed(key, flight))
+
+        return await asyncio.shield(flight.future), MISS
+
+    def _landed(self, key, flight):
+        '''
+        Flight future done callback
+        '''
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+        future = flight.future
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.flights),
+            "cached": len(self.cache),
+            "evicted": self.cache.evicted,
+            "expired": self.cache.expired
+        }
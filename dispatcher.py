@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+#
+# Route executor work by workload type
+#
+# io-bound work (blocking calls that mostly wait) goes to a thread pool,
+# cpu-bound work goes to a process pool so it does not hold the GIL the event loop
+# needs. Each pool sits behind its own AdmissionQueue (see admission.py) and keeps
+# its own latency stats.
+#
+
+import logging
+import functools
+
+import admission
+import metrics
+import workloads
+
+IO_BOUND = "io"
+CPU_BOUND = "cpu"
+
+
+class Pool:
+    '''
+    An executor, its admission queue and latency stats
+    '''
+
+    def __init__(self, kind, executor, workers, limit, retry_after=None, owner_limit=None):
+        self.kind = kind
+        self.executor = executor
+        self.workers = workers
+        self.queue = admission.AdmissionQueue(executor, workers, limit, retry_after=retry_after, name=kind, owner_limit=owner_limit)
+        self.queue_wait = metrics.LatencyStats()
+        self.run_time = metrics.LatencyStats()
+
+    def _record(self, job, future):
+        '''
+        Job future done callback
+        '''
+        if job.started_on is not None:
+            self.queue_wait.add(job.queue_wait)
+        if job.run_time is not None:
+            self.run_time.add(job.run_time)
+
+    def submit(self, fn, *args, **options):
+        job = self.queue.submit(fn, *args, **options)
+        job.future.add_done_callback(functools.partial(self._record, job))
+        return job
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        stats = self.queue.stats()
+        stats["queue_wait"] = self.queue_wait.stats()
+        stats["run_time"] = self.run_time.stats()
+        if hasattr(self.executor, "stats"):
+            stats["executor"] = self.executor.stats()
+        return stats
+
+
+class Dispatcher:
+    '''
+    Submit work tagged IO_BOUND or CPU_BOUND to the matching pool
+    '''
+
+    def __init__(self):
+        self.pools = {}
+
+    def add_pool(self, kind, executor, workers, limit, retry_after=None, owner_limit=None):
+        '''
+        Register the executor that runs `kind` work.
+
+        :kind string IO_BOUND, CPU_BOUND or any other tag.
+        :executor concurrent.futures.Executor
+        :workers int The executor's max_workers.
+        :limit int Maximum number of jobs waiting for a worker.
+        :retry_after int Fixed retry-after for busy replies, None to estimate.
+        :owner_limit int Maximum number of jobs one client can have waiting.
+        :return Pool
+        '''
+        pool = Pool(kind, executor, workers, limit, retry_after, owner_limit)
+        self.pools[kind] = pool
+        logging.info("dispatcher - {} pool: {} x {}, queue limit {}".format(kind, workers, type(executor).__name__, limit))
+        return pool
+
+    def submit(self, kind, fn, *args, **options):
+        '''
+        Submit fn(*args) to the pool for `kind`.
+
+        :kind string
+        :fn callable Must be picklable for process pools.
+        :options owner, deadline, cancel_event, priority, see admission.AdmissionQueue.submit().
+        :return admission.Job Await job.future for the result.
+        :raises admission.QueueFull
+        '''
+        try:
+            pool = self.pools[kind]
+        except KeyError:
+            raise ValueError("no pool for {} work".format(kind))
+
+        return pool.submit(fn, *args, **options)
+
+    def cancel_owner(self, owner):
+        '''
+        Cancel the jobs only owner was waiting for, in every pool
+
+        :return int Number of jobs cancelled
+        '''
+        return sum(pool.queue.cancel_owner(owner) for pool in self.pools.values())
+
+    def warm(self):
+        '''
+        Start every worker of every pool so the first requests don't pay for it.
+
+        Blocks. Process pool workers are forked, so call this before starting any
+        threads: a child forked while another thread holds a lock (sys.stdin's, for
+        one) deadlocks.
+        '''
+        for pool in self.pools.values():
+            if hasattr(pool.executor, "warm"):
+                # warms itself and keeps its own start up stats, see warmpool.py
+                pool.executor.warm()
+                continue
+            futures = [pool.executor.submit(workloads.warm_up) for i in range(pool.workers)]
+            workers = set(f.result() for f in futures)
+            logging.info("dispatcher - {} pool warm, {} worker(s)".format(pool.kind, len(workers)))
+
+    def shutdown(self, wait=True):
+        '''
+        Shut down every pool. Call once: on python 3.9+ a second call does not wait.
+        '''
+        for pool in self.pools.values():
+            pool.executor.shutdown(wait=wait)
+
+    def stats(self):
+        '''
+        :return dict kind -> pool stats
+        '''
+        return {kind: pool.stats() for kind, pool in self.pools.items()}
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+#
+# Event loop selection for the web server thread
+#
+# "auto" runs the server on uvloop when it is installed and on the stock asyncio
+# loop otherwise. Asking for uvloop when it is not installed falls back to asyncio
+# with a warning rather than failing to start.
+#
+
+import asyncio
+import logging
+import platform
+
+# uvloop is optional, https://github.com/MagicStack/uvloop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+AUTO = "auto"
+ASYNCIO = "asyncio"
+UVLOOP = "uvloop"
+
+CHOICES = (AUTO, ASYNCIO, UVLOOP)
+
+
+def resolve(name):
+    '''
+    The loop implementation that will actually be used
+
+    :name string AUTO, ASYNCIO or UVLOOP
+    :return string ASYNCIO or UVLOOP
+    '''
+    if name not in CHOICES:
+        raise ValueError("unknown event loop {}, use one of {}".format(name, ", ".join(CHOICES)))
+
+    if name == ASYNCIO:
+        return ASYNCIO
+
+    if uvloop is None:
+        if name == UVLOOP:
+            logging.warning("eventloop - uvloop is not installed, using asyncio")
+        return ASYNCIO
+
+    return UVLOOP
+
+
+def new_event_loop(name):
+    '''
+    Create a loop of the resolved implementation. Does not change the event loop policy.
+
+    :name string ASYNCIO or UVLOOP, see resolve().
+    :return asyncio.AbstractEventLoop
+    '''
+    if name == UVLOOP:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def describe(name):
+    '''
+    :name string ASYNCIO or UVLOOP
+    :return string Implementation and version, for the startup message
+    '''
+    if name == UVLOOP:
+        return "uvloop {}".format(uvloop.__version__)
+    return "asyncio (python {})".format(platform.python_version())
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#
+# Idle connection reaping on a hashed timing wheel
+#
+# Every packet a client sends updates its Connection's last_seen (see
+# registry.ConnectionRegistry.touch()), which is one attribute store and never
+# touches the wheel. Each connection sits in one wheel slot, the one for
+# last_seen + timeout as of when it was last checked. Once a tick the reaper
+# empties the slots that came due and checks their connections:
+#
+#   - idle for timeout seconds or more: disconnected with on_idle(sid)
+#   - seen since: moved to the slot for its new last_seen + timeout
+#   - exempt, e.g. subscribed to a feed it only listens to: moved to the slot
+#     for now + timeout, checked again then
+#
+# So a connection is looked at about once per timeout instead of once per tick
+# (a full scan) and needs no timer handle of its own. At 100k connections and a
+# 300s timeout that is ~330 checks a second, spread over the ticks.
+#
+# Times are time.time(), the registry's clock. engine.io's ping timeout still
+# catches dead transports, the reaper is for clients that are connected but send
+# nothing.
+#
+# All methods must be called from the event loop thread.
+#
+
+import math
+import time
+import asyncio
+import logging
+
+
+class TimingWheel:
+    '''
+    Keys in slots by due time, tick seconds per slot
+    '''
+
+    def __init__(self, tick, horizon, now=None):
+        '''
+        :tick float Seconds per slot, keys come due up to a tick late.
+        :horizon float Longest delay. Keys due later go in the last slot and come
+                       due early, the caller checks and schedules them again.
+        :now float Current time, default time.time().
+        '''
+        self.tick = tick
+        self.slots = [set() for i in range(int(math.ceil(horizon / tick)) + 1)]
+        self.where = {} # key -> slot index
+        self.current = int((time.time() if now is None else now) / tick) # last tick advanced to
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def schedule(self, key, when):
+        '''
+        Add a key, or move it if already scheduled
+
+        :key hashable
+        :when float Time the key is due.
+        :return None
+        '''
+        due = min(max(int(when / self.tick), self.current + 1), self.current + len(self.slots) - 1)
+        index = due % len(self.slots)
+
+        old = self.where.get(key)
+        if old is not None:
+            self.slots[old].discard(key)
+
+        self.slots[index].add(key)
+        self.where[key] = index
+
+    def cancel(self, key):
+        '''
+        :return bool False if key was not scheduled
+        '''
+        index = self.where.pop(key, None)
+        if index is None:
+            return False
+        self.slots[index].discard(key)
+        return True
+
+    def advance(self, now):
+        '''
+        Take out the keys due by now
+
+        :now float
+        :return list of keys
+        '''
+        target = int(now / self.tick)
+        # a jump past a whole turn of the wheel empties every slot once
+        first = max(self.current + 1, target - len(self.slots) + 1)
+        due = []
+
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                due.extend(slot)
+                for key in slot:
+                    del self.where[key]
+                slot.clear()
+
+        self.current = max(self.current, target)
+        return due
+
+
+class IdleReaper:
+    '''
+    Disconnect the connections of a registry.ConnectionRegistry idle for timeout seconds
+    '''
+
+    def __init__(self, connections, timeout, on_idle, tick=1.0, exempt=None):
+        '''
+        :connections registry.ConnectionRegistry
+        :timeout float Seconds without a packet before a client is disconnected.
+        :on_idle coroutine function on_idle(sid) disconnects the client.
+        :tick float Seconds between checks, clients are disconnected up to a tick late.
+        :exempt callable exempt(sid) True if the client is kept however long it is idle.
+        '''
+        self.connections = connections
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.exempt = exempt
+        self.wheel = TimingWheel(tick, timeout)
+        self.task = None
+        self.checked = 0 # connections looked at, reaped or not
+        self.reaped = 0
+        self.exempted = 0 # idle, but kept by exempt()
+
+    def add(self, sid):
+        '''
+        Start watching a new connection
+        '''
+        self.wheel.schedule(sid, time.time() + self.timeout)
+
+    def remove(self, sid):
+        '''
+        Stop watching a connection, e.g. on disconnect
+        '''
+        self.wheel.cancel(sid)
+
+    def start(self):
+        '''
+        Run the reaper on the current event loop
+
+        :return None
+        '''
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            await self.reap(time.time())
+
+    async def reap(self, now):
+        '''
+        Check the connections that came due, disconnect the idle ones
+
+        :now float
+        :return int Connections disconnected
+        '''
+        idle = []
+
+        for sid in self.wheel.advance(now):
+            conn = self.connections.get(sid)
+            if conn is None:
+                continue
+            self.checked += 1
+            if now - conn.last_seen < self.timeout:
+                self.wheel.schedule(sid, conn.last_seen + self.timeout)
+            elif self.exempt is not None and self.exempt(sid):
+                self.exempted += 1
+                self.wheel.schedule(sid, now + self.timeout)
+            else:
+                idle.append((sid, now - conn.last_seen))
+
+        for sid, secs in idle:
+            logging.info("idle reaper - disconnecting {}, idle {:.1f}s".format(sid, secs))
+            self.reaped += 1
+            try:
+                await self.on_idle(sid)
+            except Exception as e:
+                logging.info("idle reaper - disconnect {} failed: {}".format(sid, e))
+                if sid in self.connections:
+                    self.wheel.schedule(sid, now + self.timeout)
+
+        return len(idle)
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        return {
+            "timeout": self.timeout,
+            "tracked": len(self.wheel),
+            "checked": self.checked,
+            "reaped": self.reaped,
+            "exempted": self.exempted
+        }
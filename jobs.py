@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+#
+# Asynchronous jobs for long running requests
+#
+# A client submits work and gets a job id back right away instead of holding the
+# request's ack open until the work is done. The job's state changes and progress
+# are pushed to the client as "job_update" events, the outcome as a "job_result"
+# event. Clients can ask for a job's status and cancel it.
+#
+# The JobTable keeps finished jobs for `retention` seconds and at most `max_jobs`
+# jobs in total, dropping the oldest finished ones first.
+#
+# Thread pool work gets a JobContext to report progress and to check for a
+# cancel. Process pool work can't share one, it only reports queued, running and
+# finished, and a cancel while it runs only discards the result.
+#
+# Jobs are owned by the submitting sid in the admission queue, so a client that
+# disconnects has its unfinished jobs cancelled, see admission.py.
+#
+# All JobTable methods must be called from the event loop thread.
+#
+
+import time
+import uuid
+import asyncio
+import threading
+import collections
+
+import admission
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    '''
+    Raised by work that noticed its job was cancelled
+    '''
+
+
+class TooManyJobs(Exception):
+    '''
+    Raised by JobTable.new() when every job in the table is still active
+    '''
+
+
+class JobContext:
+    '''
+    Handed to thread pool work: report progress, check for a cancel
+    '''
+
+    def __init__(self, loop, on_progress=None):
+        '''
+        :loop asyncio.AbstractEventLoop The loop the JobTable runs on.
+        :on_progress callable Called on the loop with the progress, 0.0 - 1.0. None
+                     when only the cancel is of interest.
+        '''
+        self.loop = loop
+        self.on_progress = on_progress
+        self.cancelled = threading.Event()
+
+    def progress(self, fraction):
+        '''
+        Report progress. Safe to call from any thread.
+
+        :fraction float 0.0 - 1.0
+        :return None
+        '''
+        if self.on_progress is not None:
+            self.loop.call_soon_threadsafe(self.on_progress, fraction)
+
+    def check(self):
+        '''
+        :raises JobCancelled if the job was cancelled
+        '''
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+
+class JobRecord:
+    '''
+    One submitted job
+    '''
+
+    __slots__ = ("id", "sid", "request", "state", "progress", "result", "error",
+                 "created_on", "started_on", "finished_on", "context", "job")
+
+    def __init__(self, sid, request):
+        self.id = uuid.uuid4().hex[:16]
+        self.sid = sid
+        self.request = request
+        self.state = QUEUED
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created_on = time.time()
+        self.started_on = None
+        self.finished_on = None
+        self.context = None
+        self.job = None
+
+    def to_dict(self):
+        '''
+        :return dict What the client gets to see
+        '''
+        return {
+            "job": self.id,
+            "request": self.request,
+            "state": self.state,
+            "progress": round(self.progress, 3),
+            "result": self.result,
+            "error": self.error,
+            "created-on": self.created_on,
+            "started-on": self.started_on,
+            "finished-on": self.finished_on
+        }
+
+
+class JobTable:
+    '''
+    The jobs of every client, by id
+    '''
+
+    def __init__(self, notify, max_jobs=1000, retention=300.0, progress_step=0.05):
+        '''
+        :notify coroutine function notify(record, event) pushes an update to the job's
+                client, event is "job_update" or "job_result".
+        :max_jobs int Most jobs kept, finished or not.
+        :retention float Seconds a finished job is kept.
+        :progress_step float Smallest progress change pushed to the client.
+        '''
+        self.notify = notify
+        self.max_jobs = max_jobs
+        self.retention = retention
+        self.progress_step = progress_step
+        self.jobs = collections.OrderedDict() # id -> JobRecord, oldest first
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def new(self, sid, request, context=False):
+        '''
+        Add a job. Attach its work with attach().
+
+        :sid string The owner.
+        :request string
+        :context bool Create a JobContext for thread pool work.
+        :return JobRecord
+        :raises TooManyJobs
+        '''
+        self.prune()
+        if len(self.jobs) >= self.max_jobs:
+            raise TooManyJobs("{} jobs active".format(len(self.jobs)))
+
+        record = JobRecord(sid, request)
+        if context:
+            record.context = JobContext(asyncio.get_event_loop(), lambda fraction: self._progress(record, fraction))
+
+        self.jobs[record.id] = record
+        return record
+
+    def discard(self, record):
+        '''
+        Forget a job whose work could not be submitted
+        '''
+        self.jobs.pop(record.id, None)
+
+    def attach(self, record, job):
+        '''
+        Follow the admission.Job running the record's work
+
+        :record JobRecord
+        :job admission.Job
+        :return None
+        '''
+        self.submitted += 1
+        record.job = job
+        job.on_start = lambda job: self._started(record)
+        job.future.add_done_callback(lambda f: self._finished(record, f))
+
+        # submit() hands the job to a free worker right away
+        if job.started_on is not None:
+            self._started(record)
+
+    def get(self, job_id, sid=None):
+        '''
+        :job_id string
+        :sid string Only return the job if sid owns it.
+        :return JobRecord None if unknown
+        '''
+        record = self.jobs.get(job_id)
+        if record is None or (sid is not None and record.sid != sid):
+            return None
+        return record
+
+    def for_sid(self, sid):
+        '''
+        :return list The client's jobs, oldest first
+        '''
+        return [record for record in self.jobs.values() if record.sid == sid]
+
+    def cancel(self, record):
+        '''
+        Cancel a job: a queued job never runs, running thread pool work is asked to
+        stop, running process pool work finishes but its result is discarded.
+
+        :record JobRecord
+        :return bool False if the job had already finished
+        '''
+        if record.state in FINISHED:
+            return False
+
+        return record.job.queue.cancel(record.job)
+
+    def prune(self):
+        '''
+        Drop finished jobs past their retention, then the oldest finished jobs
+        until there is room for a new one
+        '''
+        expired_before = time.time() - self.retention
+        for record in list(self.jobs.values()):
+            if record.state in FINISHED and record.finished_on < expired_before:
+                del self.jobs[record.id]
+
+        if len(self.jobs) >= self.max_jobs:
+            for record in list(self.jobs.values()):
+                if len(self.jobs) < self.max_jobs:
+                    break
+                if record.state in FINISHED:
+                    del self.jobs[record.id]
+
+    def _push(self, record, event):
+        asyncio.ensure_future(self.notify(record, event))
+
+    def _started(self, record):
+        if record.state == QUEUED:
+            record.state = RUNNING
+            record.started_on = time.time()
+            self._push(record, "job_update")
+
+    def _progress(self, record, fraction):
+        if record.state == RUNNING and (fraction - record.progress >= self.progress_step or fraction >= 1.0):
+            record.progress = min(1.0, fraction)
+            self._push(record, "job_update")
+
+    def _finished(self, record, future):
+        record.finished_on = time.time()
+
+        if future.cancelled():
+            record.state = CANCELLED
+            self.cancelled += 1
+        elif isinstance(future.exception(), (JobCancelled, admission.Cancelled)):
+            record.state = CANCELLED
+            self.cancelled += 1
+        elif future.exception() is not None:
+            record.state = FAILED
+            record.error = str(future.exception())
+            self.failed += 1
+        else:
+            record.state = DONE
+            record.progress = 1.0
+            record.result = future.result()
+            self.completed += 1
+
+        self._push(record, "job_result")
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        states = collections.Counter(record.state for record in self.jobs.values())
+        return {
+            "jobs": len(self.jobs),
+            "states": dict(states),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled
+        }
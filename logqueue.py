@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+#
+# Non-blocking logging for the web servers
+#
+# With logging.basicConfig(filename=...) every logging.info() call is a file write
+# on the calling thread, which for the handlers is the event loop thread. In queue
+# mode the root logger only puts records on a bounded queue. A writer thread drains
+# the queue in batches and flushes the file once per batch. When the queue is full
+# records are dropped rather than blocking the caller, and the writer logs how many
+# were lost.
+#
+# The per-request "- entry" / "- exit" lines can also be rate limited or sampled
+# before they are queued.
+#
+# logging.shutdown(), which runs at exit, writes out whatever is still queued.
+#
+
+import os
+import time
+import queue
+import threading
+import logging
+import logging.handlers
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that never blocks, it counts the records it had to drop
+    '''
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+        self.listener = None
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # logging.shutdown() closes this handler before the file handler it feeds,
+        # so stopping the listener here writes out everything still queued
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+        super().close()
+
+
+class BatchFileHandler(logging.FileHandler):
+    '''
+    FileHandler that leaves flushing to the caller, see BatchQueueListener
+    '''
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    '''
+    QueueListener that handles records in batches and flushes once per batch
+    '''
+
+    def __init__(self, q, queue_handler, *handlers, batch_size=256, flush_interval=1.0):
+        '''
+        :q queue.Queue
+        :queue_handler DroppingQueueHandler Its drop count is reported in the log.
+        :handlers logging.Handler
+        :batch_size int Most records handled between two flushes.
+        :flush_interval float Flush at least this often while records keep coming.
+        '''
+        super().__init__(q, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.reported_dropped = 0
+
+    def enqueue_sentinel(self):
+        # unlike records, the sentinel must not be dropped on a full queue
+        self.queue.put(self._sentinel)
+
+    def _flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def _report_dropped(self):
+        dropped = self.queue_handler.dropped
+        if dropped != self.reported_dropped:
+            record = logging.makeLogRecord({
+                "msg": "logqueue - queue full, dropped {} log record(s), {} in total".format(
+                    dropped - self.reported_dropped, dropped),
+                "levelno": logging.WARNING,
+                "levelname": "WARNING"
+            })
+            self.reported_dropped = dropped
+            self.handle(record)
+
+    def _monitor(self):
+        q = self.queue
+        last_flush = time.monotonic()
+        stop = False
+
+        while not stop:
+            batch = [q.get()]
+
+            # take whatever else is already waiting, up to batch_size
+            drained = False
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    drained = True
+                    break
+
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+                q.task_done()
+
+            self._report_dropped()
+
+            now = time.monotonic()
+            if drained or stop or now - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = now
+
+    def reset_after_fork(self, queue_size):
+        '''
+        The writer thread does not survive a fork, start a new one on a new queue
+        '''
+        q = queue.Queue(queue_size)
+        self.queue = q
+        self.queue_handler.queue = q
+        self._thread = None
+        self.start()
+
+
+class EntryExitFilter(logging.Filter):
+    '''
+    Rate limit and/or sample the per-request "- entry" / "- exit" log lines
+
+    Entry and exit lines are sampled separately, every request logs one of each,
+    so a shared count would keep only one kind with an even sample. Other records
+    always pass. Thread safe, the filter runs on whichever thread logs.
+    '''
+
+    suffixes = ("- entry", "- exit")
+
+    def __init__(self, rate=None, sample=1):
+        '''
+        :rate float Most entry/exit lines per second, None for no limit.
+        :sample int Keep 1 in sample entry lines and 1 in sample exit lines.
+        '''
+        super().__init__()
+        self.rate = rate
+        self.sample = max(1, sample)
+        self.lock = threading.Lock()
+        self.tokens = rate or 0.0
+        self.refilled_on = time.monotonic()
+        self.seen = {suffix: 0 for suffix in self.suffixes}
+        self.suppressed = 0
+
+    def filter(self, record):
+        msg = record.msg
+        if not isinstance(msg, str) or not msg.endswith(self.suffixes):
+            return True
+
+        suffix = self.suffixes[0] if msg.endswith(self.suffixes[0]) else self.suffixes[1]
+
+        with self.lock:
+            self.seen[suffix] += 1
+
+            if self.seen[suffix] % self.sample:
+                self.suppressed += 1
+                return False
+
+            if self.rate is not None:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.refilled_on) * self.rate)
+                self.refilled_on = now
+
+                if self.tokens < 1.0:
+                    self.suppressed += 1
+                    return False
+
+                self.tokens -= 1.0
+
+        return True
+
+
+def setup(filename, filemode='a', format=None, datefmt=None, level=logging.INFO,
+          queue_size=10000, batch_size=256, flush_interval=1.0, entry_exit_rate=None, entry_exit_sample=1):
+    '''
+    Configure the root logger to log to filename through a queue and a writer thread
+
+    Takes the same basic arguments as logging.basicConfig().
+
+    :queue_size int Records buffered before new ones are dropped.
+    :batch_size int See BatchQueueListener.
+    :flush_interval float See BatchQueueListener.
+    :entry_exit_rate float See EntryExitFilter.
+    :entry_exit_sample int See EntryExitFilter.
+    :return BatchQueueListener
+    '''
+    file_handler = BatchFileHandler(filename, mode=filemode)
+    file_handler.setFormatter(logging.Formatter(format, datefmt))
+
+    q = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(q)
+
+    if entry_exit_rate is not None or entry_exit_sample > 1:
+        queue_handler.addFilter(EntryExitFilter(entry_exit_rate, entry_exit_sample))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    listener = BatchQueueListener(q, queue_handler, file_handler, batch_size=batch_size, flush_interval=flush_interval)
+    queue_handler.listener = listener
+    listener.start()
+
+    # process pool and cluster workers are forked, give each child its own writer.
+    # Nothing buffered may be copied into the child, logging itself re-creates the
+    # handler lock in the child.
+    if hasattr(os, 'register_at_fork'):
+        def before_fork():
+            file_handler.acquire()
+            file_handler.flush()
+
+        os.register_at_fork(
+            before=before_fork,
+            after_in_parent=file_handler.release,
+            after_in_child=lambda: listener.reset_after_fork(queue_size)
+        )
+
+    return listener
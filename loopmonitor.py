@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Event loop health: scheduling lag and slow callbacks
+#
+# A callback re-schedules itself every `interval` seconds with call_at(). How late it
+# runs is the loop's scheduling lag, what every other callback waiting at that
+# moment had to wait as well.
+#
+# A watchdog thread checks that the callback keeps running. When it is overdue by
+# more than `threshold` the loop is stuck in one callback or coroutine step, and the
+# watchdog takes the loop thread's stack (sys._current_frames()). Once the loop
+# catches up the stall is recorded and logged with the stack and the name of the
+# application function it was in.
+#
+# asyncio's own debug mode reports slow callbacks too, but it slows down every
+# callback to do so and does not say where the time went.
+#
+
+import sys
+import time
+import logging
+import sysconfig
+import threading
+import traceback
+import collections
+
+import metrics
+
+
+# frames from these are not "the handler"
+_library_paths = tuple(set(path for name, path in sysconfig.get_paths().items() if name in ("stdlib", "platstdlib", "purelib", "platlib")))
+
+
+class SlowCallback:
+    '''
+    One stall of the event loop
+    '''
+
+    __slots__ = ("on", "duration", "name", "stack")
+
+    def __init__(self, on, duration, name, stack):
+        self.on = on             # time.time() when it was noticed
+        self.duration = duration # lag seen by the sampler, at least this long
+        self.name = name         # the application function running, None if not caught
+        self.stack = stack       # list of "file:line in function", innermost last
+
+    def to_dict(self):
+        '''
+        :return dict
+        '''
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def handler_name(stack, runner=None):
+    '''
+    Name the function a stack is in: the outermost frame of the running callback
+    that is outside the python libraries, the innermost frame if they all are.
+
+    :stack traceback.StackSummary
+    :runner tuple (filename, function) of the frame running the loop, the callback
+                  is below it. Loops written in C (uvloop) leave no frame of their own.
+    :return string
+    '''
+    start = 0
+    for i, frame in enumerate(stack):
+        if (frame.filename, frame.name) == runner:
+            start = i + 1
+            break
+
+    for frame in stack[start:]:
+        if not frame.filename.startswith(_library_paths):
+            return frame.name
+    return stack[-1].name if stack else None
+
+
+class LoopMonitor:
+    '''
+    Sample an event loop's scheduling lag and catch the callbacks that stall it
+    '''
+
+    def __init__(self, interval=0.1, threshold=0.1, log_interval=60.0, stack_depth=8, keep=32):
+        '''
+        :interval float Seconds between lag samples.
+        :threshold float Lag, in seconds, that counts as a slow callback.
+        :log_interval float Seconds between lag summaries in the log, None for none.
+        :stack_depth int Frames kept per slow callback.
+        :keep int Slow callbacks kept for stats().
+        '''
+        self.interval = interval
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self.stack_depth = stack_depth
+
+        self.lag = metrics.LatencyStats()
+        self.slow = collections.deque(maxlen=keep)
+        self.slow_count = 0
+
+        self.loop = None
+        self.thread_id = None
+        self.runner = None
+        self.handle = None
+        self.expected = None
+        self.beat = None        # time.monotonic() of the last sample, read by the watchdog
+        self.caught = None      # (beat, stack) taken by the watchdog during a stall
+        self.logged_on = None
+        self.stopping = threading.Event()
+
+    def start(self, loop):
+        '''
+        Start sampling. Call from the function that runs the loop, in its thread.
+
+        :loop asyncio.AbstractEventLoop
+        :return None
+        '''
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        caller = sys._getframe(1).f_code
+        self.runner = (caller.co_filename, caller.co_name)
+        self.beat = self.logged_on = time.monotonic()
+        self.expected = loop.time() + self.interval
+        self.handle = loop.call_at(self.expected, self._sample)
+
+        self.stopping.clear()
+        threading.Thread(target=self._watch, name="loopmonitor", daemon=True).start()
+
+        logging.info("loopmonitor - sampling every {}s, slow callback threshold {}s".format(self.interval, self.threshold))
+
+    def stop(self):
+        '''
+        :return None
+        '''
+        self.stopping.set()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _sample(self):
+        '''
+        Loop callback, records how late it was called and schedules the next one
+        '''
+        now = self.loop.time()
+        lag = max(0.0, now - self.expected)
+        last_beat = self.beat
+        self.beat = time.monotonic()
+
+        self.lag.add(lag)
+
+        if lag >= self.threshold:
+            caught = self.caught
+            stack = caught[1] if caught is not None and caught[0] == last_beat else None
+            self._record(lag, stack)
+
+        if self.log_interval is not None and self.beat - self.logged_on >= self.log_interval:
+            self.logged_on = self.beat
+            stats = self.stats()
+            logging.info("loopmonitor - lag p50: {:.4f}s, p99: {:.4f}s, max: {:.4f}s, slow callbacks: {}".format(
+                stats["p50"], stats["p99"], stats["max"], self.slow_count))
+
+        self.expected = now + self.interval
+        self.handle = self.loop.call_at(self.expected, self._sample)
+
+    def _record(self, lag, stack):
+        name = handler_name(stack, self.runner) if stack else None
+        lines = ["{}:{} in {}".format(f.filename, f.lineno, f.name) for f in stack[-self.stack_depth:]] if stack else []
+
+        self.slow_count += 1
+        self.slow.append(SlowCallback(time.time(), lag, name, lines))
+
+        logging.warning("loopmonitor - event loop blocked for {:.3f}s in {}\n    {}".format(
+            lag, name or "unknown", "\n    ".join(lines) if lines else "(stack not caught)"))
+
+    def _watch(self):
+        '''
+        Watchdog thread, takes the loop thread's stack while the loop is stalled
+        '''
+        timeout = self.interval + self.threshold
+
+        # a stall shorter than threshold / 4 past the timeout may go without a stack
+        while not self.stopping.wait(self.threshold / 4):
+            beat = self.beat
+            if self.caught is not None and self.caught[0] == beat:
+                continue # this stall is already caught
+
+            if time.monotonic() - beat > timeout:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self.caught = (beat, traceback.extract_stack(frame))
+                del frame
+
+    def stats(self):
+        '''
+        :return dict Lag percentiles in seconds, slow callback count and the most recent ones
+        '''
+        return {
+            "count": self.lag.count,
+            "p50": self.lag.percentile(50) or 0.0,
+            "p90": self.lag.percentile(90) or 0.0,
+            "p99": self.lag.percentile(99) or 0.0,
+            "max": self.lag.max,
+            "slow_callbacks": self.slow_count,
+            "recent": [s.to_dict() for s in self.slow]
+        }
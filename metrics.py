@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+#
+# Metrics in the Prometheus text format
+#
+# The hot path only does what can't be avoided: a handler call is timed with two
+# perf_counter() calls and dropped into a fixed bucket, the counts are plain integer
+# increments. Everything else (gauges, per second rates) is computed when /metrics
+# is scraped.
+#
+# LatencyStats keeps the recent samples of a timing for the JSON stats pages.
+#
+# In cluster mode every worker has its own metrics, and a scrape through the shared
+# port reaches one of them. Each exported line carries the worker's pid.
+#
+
+import os
+import time
+import bisect
+import functools
+import collections
+
+# handler latency buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    '''
+    Cumulative bucket counts, sum and count of observed values
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''
+        :return list of (upper bound as a string, count of values <= bound)
+        '''
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+
+class LatencyStats:
+    '''
+    Count, mean, max and percentiles over the most recent samples
+    '''
+
+    def __init__(self, size=1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=size)
+
+    def add(self, secs):
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+        self.recent.append(secs)
+
+    def percentile(self, p):
+        '''
+        :p float 0 - 100
+        :return float None if there are no samples
+        '''
+        if not self.recent:
+            return None
+        samples = sorted(self.recent)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99)
+        }
+
+
+class Metrics:
+    '''
+    A set of metrics rendered together
+    '''
+
+    def __init__(self, prefix):
+        '''
+        :prefix string Prepended to every metric name.
+        '''
+        self.prefix = prefix
+        self.handlers = {}  # event -> Histogram
+        self.counters = []  # (name, help, callable returning the running total or a {label value: total} dict, label name)
+        self.gauges = []    # (name, help, callable returning a number or a {label value: number} dict, label name)
+        self.rates = []     # (name, help, callable returning a running total)
+        self.last_scrape = {} # rate name -> (time, total)
+
+    def timed(self, event):
+        '''
+        Decorator, record the latency of an async socket.io handler
+
+        :event string
+        :return callable
+        '''
+        histogram = self.handlers.setdefault(event, Histogram())
+        perf_counter = time.perf_counter
+
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(*args):
+                started = perf_counter()
+                try:
+                    return await handler(*args)
+                finally:
+                    histogram.observe(perf_counter() - started)
+            return wrapper
+
+        return decorator
+
+    def messages(self):
+        '''
+        :return int Handler calls so far, over every timed event
+        '''
+        return sum(histogram.count for histogram in self.handlers.values())
+
+    def counter(self, name, help, fn, label=None):
+        '''
+        :fn callable Returns the running total, or a dict of label value -> total.
+        :label string The label name when fn returns a dict.
+        '''
+        self.counters.append((name, help, fn, label))
+
+    def gauge(self, name, help, fn, label=None):
+        '''
+        :fn callable Returns the value, or a dict of label value -> value.
+        :label string The label name when fn returns a dict.
+        '''
+        self.gauges.append((name, help, fn, label))
+
+    def rate(self, name, help, fn):
+        '''
+        Per second rate of a running total, between two scrapes
+
+        :fn callable Returns the running total.
+        '''
+        self.rates.append((name, help, fn))
+
+    def _labels(self, extra=None):
+        # read at render time, workers are forked after the metrics are set up
+        labels = {"pid": os.getpid()}
+        if extra:
+            labels.update(extra)
+        return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels.items()) + "}"
+
+    def _render_value(self, lines, kind, name, help, value, label):
+        p = self.prefix
+        lines.append("# HELP {}_{} {}".format(p, name, help))
+        lines.append("# TYPE {}_{} {}".format(p, name, kind))
+        if isinstance(value, dict):
+            for key, v in value.items():
+                if v is not None:
+                    lines.append("{}_{}{} {}".format(p, name, self._labels({label: key}), v))
+        elif value is not None:
+            lines.append("{}_{}{} {}".format(p, name, self._labels(), value))
+
+    def render(self):
+        '''
+        :return string Prometheus text exposition format
+        '''
+        lines = []
+        p = self.prefix
+
+        name = p + "_handler_seconds"
+        lines.append("# HELP {} socket.io handler latency".format(name))
+        lines.append("# TYPE {} histogram".format(name))
+        for event, histogram in self.handlers.items():
+            for bound, count in histogram.cumulative():
+                lines.append("{}_bucket{} {}".format(name, self._labels({"event": event, "le": bound}), count))
+            lines.append("{}_sum{} {}".format(name, self._labels({"event": event}), histogram.sum))
+            lines.append("{}_count{} {}".format(name, self._labels({"event": event}), histogram.count))
+
+        for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+            for name, help, fn, label in metrics:
+                self._render_value(lines, kind, name, help, fn(), label)
+
+        now = time.monotonic()
+        for name, help, fn in self.rates:
+            total = fn()
+            last_on, last_total = self.last_scrape.get(name, (None, None))
+            self.last_scrape[name] = (now, total)
+            lines.append("# HELP {}_{} {}".format(p, name, help))
+            lines.append("# TYPE {}_{} gauge".format(p, name))
+            if last_on is not None and now > last_on:
+                lines.append("{}_{}{} {:.3f}".format(p, name, self._labels(), (total - last_total) / (now - last_on)))
+
+        return "\n".join(lines) + "\n"
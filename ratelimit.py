@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# Per connection rate limiting of socket.io events
+#
+# Every (sid, event) pair gets a token bucket: `rate` tokens per second, at most
+# `burst` saved up, one token per event. An event arriving to an empty bucket is
+# either rejected right away or, in DELAY mode, held until a token is due, as long
+# as that is no more than `max_delay` seconds away. Events past that are rejected.
+#
+# A bucket is a two item list [tokens, refilled_on], created on the sid's first
+# limited event and dropped with forget() on disconnect. Checking one is a dict
+# lookup and some arithmetic.
+#
+# All methods must be called from the event loop thread.
+#
+
+import time
+import asyncio
+import functools
+
+REJECT = "reject"
+DELAY = "delay"
+
+MODES = (REJECT, DELAY)
+
+
+class RateLimiter:
+    '''
+    Token buckets by sid and event, applied with the limited() handler decorator
+    '''
+
+    def __init__(self, limits, mode=REJECT, max_delay=1.0, on_reject=None):
+        '''
+        :limits dict event -> (rate per second, burst). Events not listed are not limited.
+        :mode string REJECT or DELAY.
+        :max_delay float DELAY mode, longest an event is held before it is rejected.
+        :on_reject coroutine function on_reject(sid, event, retry_after) tells the client,
+                   its return value is the handler's ack. None to only ack "<event> rate-limited".
+        '''
+        if mode not in MODES:
+            raise ValueError("unknown rate limit mode {}, use one of {}".format(mode, ", ".join(MODES)))
+
+        self.limits = limits
+        self.on_reject = on_reject
+        self.mode = mode
+        self.max_delay = max_delay
+        self.buckets = {} # sid -> {event: [tokens, refilled_on]}
+        self.rejected = {} # event -> count
+        self.delayed = {} # event -> count
+
+    def acquire(self, sid, event):
+        '''
+        Take a token
+
+        :sid string
+        :event string
+        :return float 0.0 to go ahead now, seconds to wait before going ahead, or
+                      None to reject
+        '''
+        limit = self.limits.get(event)
+        if limit is None:
+            return 0.0
+
+        rate, burst = limit
+        now = time.monotonic()
+
+        buckets = self.buckets.get(sid)
+        if buckets is None:
+            buckets = self.buckets[sid] = {}
+
+        bucket = buckets.get(event)
+        if bucket is None:
+            bucket = buckets[event] = [burst, now]
+
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+        if tokens >= 1.0:
+            bucket[0] = tokens - 1.0
+            return 0.0
+
+        # the token is due (1 - tokens) / rate from now
+        wait = (1.0 - tokens) / rate
+        if self.mode == DELAY and wait <= self.max_delay:
+            # borrow it: the bucket goes negative until the wait is over
+            bucket[0] = tokens - 1.0
+            self.delayed[event] = self.delayed.get(event, 0) + 1
+            return wait
+
+        bucket[0] = tokens
+        self.rejected[event] = self.rejected.get(event, 0) + 1
+        return None
+
+    def retry_after(self, sid, event):
+        '''
+        :return float Seconds until the next token for sid's event
+        '''
+        rate, burst = self.limits[event]
+        bucket = self.buckets.get(sid, {}).get(event)
+        if bucket is None:
+            return 0.0
+        return max(0.0, (1.0 - bucket[0]) / rate)
+
+    def forget(self, sid):
+        '''
+        Drop a disconnected sid's buckets
+        '''
+        self.buckets.pop(sid, None)
+
+    def limited(self, event):
+        '''
+        Decorator, rate limit an async socket.io handler(sid, data)
+
+        :event string
+        :return callable
+        '''
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(sid, *args):
+                wait = self.acquire(sid, event)
+                if wait is None:
+                    if self.on_reject is None:
+                        return "{} rate-limited".format(event)
+                    return await self.on_reject(sid, event, self.retry_after(sid, event))
+                if wait > 0.0:
+                    await asyncio.sleep(wait)
+                return await handler(sid, *args)
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        return {
+            "mode": self.mode,
+            "sids": len(self.buckets),
+            "rejected": dict(self.rejected),
+            "delayed": dict(self.delayed)
+        }
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# Connected client registry
+#
+# Keeping the socket.io connect environ per client holds on to the aiohttp request
+# object and every header of the handshake. A Connection keeps only the fields the
+# servers use, in __slots__, and user agent strings are interned so clients running
+# the same browser share one copy.
+#
+# X-Forwarded-For is only believed when the peer is one of the registry's trusted
+# proxies, anyone else could put any address in it.
+#
+
+import sys
+import time
+import bisect
+
+# socket.io packet types by the first character of a packet, see packet_name()
+packet_names = {"0": "connect", "1": "disconnect", "2": "event", "3": "ack", "4": "error", "5": "event", "6": "ack"}
+
+# longer event names are cut short in Connection.last_message
+max_event_name = 32
+
+
+class Connection:
+    '''
+    One connected client
+    '''
+
+    __slots__ = ("sid", "remote_addr", "user_agent", "connected_on", "last_seen", "last_message")
+
+    def __init__(self, sid, remote_addr, user_agent):
+        now = time.time()
+        self.sid = sid
+        self.remote_addr = remote_addr
+        self.user_agent = user_agent
+        self.connected_on = now
+        self.last_seen = now
+        self.last_message = ""
+
+    def to_dict(self):
+        '''
+        :return dict
+        '''
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def remote_addr_from_environ(environ, trusted_proxies=()):
+    '''
+    Client address from a socket.io connect environ
+
+    engine.io's aiohttp driver always sets REMOTE_ADDR to 127.0.0.1, the real peer
+    is on the aiohttp request. When the peer is a trusted proxy, the client is the
+    last X-Forwarded-For hop that isn't one.
+
+    :environ dictionary
+    :trusted_proxies collection of string Proxy addresses, empty to ignore X-Forwarded-For.
+    :return string
+    '''
+    request = environ.get("aiohttp.request")
+    if request is not None and request.remote:
+        peer = request.remote
+    else:
+        peer = environ.get("REMOTE_ADDR", "")
+
+    forwarded = environ.get("HTTP_X_FORWARDED_FOR")
+    if forwarded and peer in trusted_proxies:
+        # each proxy appends the address it got the request from
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        for hop in reversed(hops):
+            if hop not in trusted_proxies:
+                return hop
+        if hops:
+            return hops[0]
+
+    return peer
+
+
+def packet_name(data):
+    '''
+    What an inbound socket.io packet is, without decoding it: the event name of an
+    event packet, "ack" for an ack, otherwise the packet type
+
+    :data string or bytes The engine.io message.
+    :return string
+    '''
+    if not isinstance(data, str) or not data:
+        return "binary"
+
+    kind = data[0]
+    if kind in "25":
+        # 2["name",...] or 51-["name",...], maybe with a namespace and an ack id first
+        start = data.find('"')
+        end = data.find('"', start + 1)
+        if start != -1 and end != -1:
+            return data[start + 1:min(end, start + 1 + max_event_name)]
+    return packet_names.get(kind, "unknown")
+
+
+class SidIndex:
+    '''
+    sids in arrival order, for cursor based paging
+
+    A cursor is the sequence number of the last sid of the previous page, so pages
+    stay stable while clients come and go. Removed sids leave a gap in `seqs` that
+    is compacted away once gaps make up half of it.
+    '''
+
+    def __init__(self):
+        self.last_seq = 0
+        self.seqs = []    # ascending, includes removed entries until compacted
+        self.sids = {}    # seq -> sid
+        self.seq_of = {}  # sid -> seq
+
+    def __len__(self):
+        return len(self.seq_of)
+
+    def __contains__(self, sid):
+        return sid in self.seq_of
+
+    def add(self, sid):
+        if sid in self.seq_of:
+            return
+        self.last_seq += 1
+        self.seqs.append(self.last_seq)
+        self.sids[self.last_seq] = sid
+        self.seq_of[sid] = self.last_seq
+
+    def remove(self, sid):
+        seq = self.seq_of.pop(sid, None)
+        if seq is None:
+            return
+        del self.sids[seq]
+
+        if len(self.seqs) > 64 and len(self.sids) < len(self.seqs) // 2:
+            self.seqs = [seq for seq in self.seqs if seq in self.sids]
+
+    def page(self, cursor, limit):
+        '''
+        :cursor int None for the first page.
+        :limit int
+        :return tuple (list of sids, cursor for the next page or None if this is the last)
+        '''
+        i = bisect.bisect_right(self.seqs, cursor or 0)
+        n = len(self.seqs)
+        page = []
+
+        while i < n and len(page) < limit:
+            sid = self.sids.get(self.seqs[i])
+            if sid is not None:
+                page.append(sid)
+            i += 1
+
+        if i < n and page:
+            return page, self.seq_of[page[-1]]
+
+        return page, None
+
+
+class ConnectionRegistry:
+    '''
+    Connections by sid, with indexes by remote address and by arrival order
+    '''
+
+    def __init__(self, trusted_proxies=()):
+        '''
+        :trusted_proxies collection of string See remote_addr_from_environ().
+        '''
+        self.connections = {}
+        self.by_addr = {} # remote address -> set of sids
+        self.index = SidIndex()
+        self.trusted_proxies = frozenset(trusted_proxies)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __contains__(self, sid):
+        return sid in self.connections
+
+    def __iter__(self):
+        '''
+        Iterate over the sids
+        '''
+        return iter(self.connections)
+
+    def add(self, sid, environ):
+        '''
+        Register a new connection
+
+        :sid string
+        :environ dictionary The socket.io connect environ, not kept.
+        :return Connection
+        '''
+        user_agent = sys.intern(environ.get("HTTP_USER_AGENT", ""))
+        conn = Connection(sid, remote_addr_from_environ(environ, self.trusted_proxies), user_agent)
+
+        self.connections[sid] = conn
+        self.by_addr.setdefault(conn.remote_addr, set()).add(sid)
+        self.index.add(sid)
+
+        return conn
+
+    def remove(self, sid):
+        '''
+        :sid string
+        :return Connection None if unknown
+        '''
+        conn = self.connections.pop(sid, None)
+
+        if conn is not None:
+            self.index.remove(sid)
+            sids = self.by_addr.get(conn.remote_addr)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self.by_addr[conn.remote_addr]
+
+        return conn
+
+    def get(self, sid):
+        '''
+        :sid string
+        :return Connection None if unknown
+        '''
+        return self.connections.get(sid)
+
+    def touch(self, sid, message):
+        '''
+        Record a packet from sid, see idlereaper.py
+
+        :sid string None for a packet before the connect completed, ignored.
+        :message string What was received, e.g. the event name.
+        :return None
+        '''
+        conn = self.connections.get(sid)
+        if conn is not None:
+            conn.last_seen = time.time()
+            conn.last_message = message
+
+    def from_addr(self, remote_addr):
+        '''
+        :remote_addr string
+        :return list Connections from remote_addr
+        '''
+        return [self.connections[sid] for sid in self.by_addr.get(remote_addr, ())]
+
+    def count_from_addr(self, remote_addr):
+        '''
+        :remote_addr string
+        :return int
+        '''
+        return len(self.by_addr.get(remote_addr, ()))
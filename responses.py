@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+#
+# Reply encoding for the socket.io handlers
+#
+# Replies are dicts in the {"response": ..., "response-text": ..., "response-code": ...}
+# shape the clients expect. They are serialized to a JSON string, or to msgpack bytes
+# for clients that asked for it with the "serializer" event.
+#
+# A Frame is a constant reply. Its body is serialized and wrapped into socket.io and
+# engine.io packets once per format, then the same packets are sent on every call.
+# Responder.send() writes straight to the client's engine.io socket, skipping the
+# room lookup and task per emit of sio.emit(room=sid). Responder.broadcast() encodes
+# once per format and writes to every recipient in a single pass.
+#
+
+import json
+import time
+import functools
+
+from engineio import packet as eio_packet
+from socketio import packet as sio_packet
+
+# the fastest JSON encoder installed
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    try:
+        import ujson
+        json_dumps = functools.partial(ujson.dumps, ensure_ascii=False)
+    except ImportError:
+        json_dumps = functools.partial(json.dumps, separators=(",", ":"), ensure_ascii=False)
+
+# msgpack is optional
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+
+def formats():
+    '''
+    :return list The serializers a client can choose from
+    '''
+    return [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+
+def reply(request, response="ok", text="ok", code=200, **extra):
+    '''
+    Build a reply
+
+    :request string The request being answered.
+    :response The response value.
+    :text string response-text
+    :code int response-code
+    :extra Additional fields, underscores in names become dashes.
+    :return dict
+    '''
+    body = {"response": response, "response-text": text, "response-code": code, "request": request}
+    for name, value in extra.items():
+        body[name.replace("_", "-")] = value
+    return body
+
+
+def serialize(body, fmt=JSON):
+    '''
+    :body dict, or a string that is already JSON
+    :fmt string JSON or MSGPACK
+    :return string for JSON, bytes for MSGPACK
+    '''
+    if fmt == MSGPACK:
+        return msgpack.packb(body, use_bin_type=True)
+    if isinstance(body, str):
+        return body
+    return json_dumps(body)
+
+
+def encode_packets(sio, event, payload, namespace='/'):
+    '''
+    Wrap a payload into ready to send engine.io packets
+
+    :sio socketio.AsyncServer
+    :event string
+    :payload string or bytes
+    :namespace string
+    :return list engine.io packets, binary payloads need more than one
+    '''
+    pkt = sio.packet_class(sio_packet.EVENT, namespace=namespace, data=[event, payload])
+    encoded = pkt.encode()
+    if not isinstance(encoded, list):
+        encoded = [encoded]
+    return [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+
+
+class Frame:
+    '''
+    A constant reply, encoded once per format
+    '''
+
+    def __init__(self, body, event="message", namespace='/'):
+        self.body = body
+        self.event = event
+        self.namespace = namespace
+        self.packets = {} # format -> engine.io packets
+
+    def packets_for(self, sio, fmt):
+        packets = self.packets.get(fmt)
+        if packets is None:
+            packets = encode_packets(sio, self.event, serialize(self.body, fmt), self.namespace)
+            self.packets[fmt] = packets
+        return packets
+
+
+class Responder:
+    '''
+    Send replies to single clients in the format each of them asked for
+    '''
+
+    def __init__(self, sio, namespace='/'):
+        self.sio = sio
+        self.namespace = namespace
+        self.formats = {} # sid -> format, for clients not using JSON
+        self.sent = 0     # replies sent, broadcasts count once per recipient
+
+    def set_format(self, sid, fmt):
+        '''
+        :sid string
+        :fmt string
+        :return bool False if the format is not available
+        '''
+        if fmt not in formats():
+            return False
+        if fmt == JSON:
+            self.formats.pop(sid, None)
+        else:
+            self.formats[sid] = fmt
+        return True
+
+    def forget(self, sid):
+        '''
+        Drop a disconnected client
+        '''
+        self.formats.pop(sid, None)
+
+    async def send(self, sid, reply, event="message"):
+        '''
+        Send a reply to one client
+
+        :sid string
+        :reply Frame, dict or JSON string
+        :event string Event name for dict and string replies, a Frame has its own.
+        :return None
+        '''
+        eio_sid = self.sio.manager.eio_sid_from_sid(sid, self.namespace)
+        if eio_sid is None:
+            return # gone, or connected to another cluster worker
+
+        fmt = self.formats.get(sid, JSON)
+
+        if isinstance(reply, Frame):
+            packets = reply.packets_for(self.sio, fmt)
+        else:
+            packets = encode_packets(self.sio, event, serialize(reply, fmt), self.namespace)
+
+        for p in packets:
+            await self.sio.eio.send_packet(eio_sid, p)
+        self.sent += 1
+
+    async def broadcast(self, reply, room=None, skip_sid=None, event="message"):
+        '''
+        Send a reply to every client in a room, or to every client
+
+        The reply is encoded once per format in use. Clients of other cluster
+        workers are not reached.
+
+        :reply Frame, dict or JSON string
+        :room string None for every connected client.
+        :skip_sid string A client to leave out, usually the sender.
+        :event string Event name for dict and string replies, a Frame has its own.
+        :return tuple (number of recipients, fan-out time in seconds)
+        '''
+        started = time.perf_counter()
+
+        if not isinstance(reply, Frame):
+            reply = Frame(reply, event, self.namespace)
+
+        recipients = 0
+
+        # get_participants() yields from a copy, clients may leave while we send
+        for sid, eio_sid in self.sio.manager.get_participants(self.namespace, room):
+            if sid == skip_sid:
+                continue
+            for p in reply.packets_for(self.sio, self.formats.get(sid, JSON)):
+                await self.sio.eio.send_packet(eio_sid, p)
+            recipients += 1
+
+        self.sent += recipients
+        return recipients, time.perf_counter() - started
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+# Fair scheduling of the jobs waiting in an AdmissionQueue
+#
+# A FairQueue takes the place of a FIFO deque. Waiting jobs are grouped by
+# priority class, then by owner (the client that submitted them):
+#
+#   - a lower class number is always served first, so interactive requests never
+#     wait behind batch jobs
+#   - within a class the owners take turns, one job each (round robin), so a client
+#     sending a burst of requests only delays its own requests
+#
+# Per client queued / served counts and queue wait are kept until the client is
+# forgotten, for capacity planning, see stats().
+#
+# All methods must be called from the event loop thread.
+#
+
+import time
+import collections
+
+INTERACTIVE = 0
+BATCH = 1
+
+CLASS_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+
+class ClientStats:
+    '''
+    Scheduling stats of one owner
+    '''
+
+    __slots__ = ("queued", "served", "wait_total", "gone")
+
+    def __init__(self):
+        self.queued = 0
+        self.served = 0
+        self.wait_total = 0.0
+        self.gone = False
+
+    def to_dict(self):
+        return {
+            "queued": self.queued,
+            "served": self.served,
+            "avg_wait": self.wait_total / self.served if self.served else None
+        }
+
+
+class FairQueue:
+    '''
+    Waiting jobs by priority class, round robin between owners within a class.
+    Jobs need `owner`, `priority` and `submitted_on` attributes, see admission.Job.
+    '''
+
+    def __init__(self):
+        self.classes = {} # priority -> OrderedDict owner -> deque of jobs, next owner first
+        self.depths = collections.Counter() # priority -> jobs waiting
+        self.served = collections.Counter() # priority -> jobs handed out
+        self.waits = collections.Counter() # priority -> total seconds waited
+        self.clients = {} # owner -> ClientStats
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def depth_of(self, owner):
+        '''
+        :return int Jobs owner has waiting, in every class
+        '''
+        client = self.clients.get(owner)
+        return client.queued if client is not None else 0
+
+    def append(self, job):
+        '''
+        :job admission.Job
+        :return None
+        '''
+        owners = self.classes.setdefault(job.priority, collections.OrderedDict())
+        jobs = owners.get(job.owner)
+        if jobs is None:
+            # a new owner waits for its turn behind the ones already waiting
+            jobs = owners[job.owner] = collections.deque()
+        jobs.append(job)
+
+        self.clients.setdefault(job.owner, ClientStats()).queued += 1
+        self.depths[job.priority] += 1
+        self.length += 1
+
+    def popleft(self):
+        '''
+        Next job: from the highest class with jobs waiting, from the owner whose turn it is
+
+        :return admission.Job
+        :raises IndexError if no job is waiting
+        '''
+        for priority in sorted(self.classes):
+            owners = self.classes[priority]
+            if not owners:
+                continue
+
+            owner, jobs = next(iter(owners.items()))
+            job = jobs.popleft()
+            if jobs:
+                owners.move_to_end(owner)
+            else:
+                del owners[owner]
+
+            client = self.clients[owner]
+            client.served += 1
+            wait = time.monotonic() - job.submitted_on
+            client.wait_total += wait
+            self.served[priority] += 1
+            self.waits[priority] += wait
+
+            self._taken(job)
+            return job
+
+        raise IndexError("pop from an empty FairQueue")
+
+    def remove(self, job):
+        '''
+        Take a waiting job out without serving it
+
+        :job admission.Job
+        :return None
+        :raises ValueError if job is not waiting
+        '''
+        owners = self.classes.get(job.priority, {})
+        jobs = owners.get(job.owner)
+        if jobs is None:
+            raise ValueError("job not queued")
+
+        jobs.remove(job)
+        if not jobs:
+            del owners[job.owner]
+
+        self._taken(job)
+
+    def forget(self, owner):
+        '''
+        Drop an owner's stats once it has nothing waiting, e.g. on disconnect
+        '''
+        client = self.clients.get(owner)
+        if client is None:
+            return
+        if client.queued == 0:
+            del self.clients[owner]
+        else:
+            # still owns jobs other clients joined
+            client.gone = True
+
+    def _taken(self, job):
+        client = self.clients[job.owner]
+        client.queued -= 1
+        if client.queued == 0 and client.gone:
+            del self.clients[job.owner]
+        self.depths[job.priority] -= 1
+        self.length -= 1
+
+    def stats(self, top=10):
+        '''
+        :top int Number of clients to list, most jobs waiting first.
+        :return dict
+        '''
+        classes = {}
+        for priority in sorted(set(self.classes) | set(self.served)):
+            served = self.served[priority]
+            classes[CLASS_NAMES.get(priority, str(priority))] = {
+                "depth": self.depths[priority],
+                "clients": len(self.classes.get(priority, ())),
+                "served": served,
+                "avg_wait": self.waits[priority] / served if served else None
+            }
+
+        busiest = sorted(self.clients.items(), key=lambda item: (item[1].queued, item[1].served), reverse=True)[:top]
+
+        return {
+            "classes": classes,
+            "clients_waiting": sum(1 for client in self.clients.values() if client.queued),
+            "clients": {str(owner): client.to_dict() for owner, client in busiest}
+        }
@@ -5,8 +5,19 @@ setup (
        version='0.1',
        packages=find_packages(),
 
+       # python-socketio 5 / python-engineio 4 need python 3.8
+       python_requires='>=3.8',
+
        # Declare your packages' dependencies here, for eg:
-       install_requires=['foo>=3'],
+       # The upper bounds are for transport.py. Compressing only the websocket frames
+       # over --compress and counting websocket traffic has no public option: it
+       # replaces the websocket class in python-engineio's private driver table
+       # (AsyncServer._async) and turns off compression on aiohttp's private frame
+       # writer (WebSocketResponse._writer.compress) to ask for it frame by frame.
+       # Both were checked against the versions allowed here. On others transport.py
+       # falls back to engine.io's stock websocket: every frame compressed once
+       # negotiated and no websocket traffic counts.
+       install_requires=['aiohttp>=3.8,<3.15', 'python-socketio>=5,<6', 'python-engineio>=4.14,<4.15'],
 
        # Fill in these to make your Egg ready for upload to
        # PyPI
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+# Large process pool results through shared memory
+#
+# A process pool result comes back pickled: the worker pickles it and writes it to
+# the result pipe, the executor's management thread reads and unpickles it. For a
+# payload of a few MB that is several copies and a thread holding the GIL while
+# the event loop waits.
+#
+# A SegmentPool hands the job a shared memory segment before it is submitted. The
+# work runs in the worker through into_segment(), which writes the result's bytes
+# into the segment and returns only its length. The event loop gets a
+# SharedResult, a memoryview over the segment it can write to a transport slice by
+# slice, and release()s it once sent to give the segment back to the pool.
+#
+# Segments come in power of two size classes from min_size up. Released segments
+# are kept for the next result of their class, at most `keep` per class, the rest
+# are unlinked. A segment whose job failed or was cancelled is unlinked, not
+# reused, the worker may still be writing to it. A result that does not fit its
+# segment, or is not bytes, comes back pickled as usual.
+#
+# multiprocessing.shared_memory is python 3.8+, without it `available` is False
+# and SegmentPool.run() always uses the pickled path.
+#
+# Create the SegmentPool before the process pool forks its workers.
+#
+# SegmentPool methods must be called from the event loop thread.
+#
+
+import logging
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+    available = True
+except ImportError:
+    shared_memory = None
+    available = False
+
+
+def _attach(name):
+    '''
+    Open an existing segment in a worker
+
+    :name string
+    :return shared_memory.SharedMemory
+    '''
+    try:
+        # python 3.13+, the creating process owns the segment
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def into_segment(name, capacity, fn, *args):
+    '''
+    Run fn(*args) in a worker and write its result into a segment
+
+    :name string The segment, from SegmentPool.allocate().
+    :capacity int Bytes the segment holds.
+    :fn callable Must be picklable, see workloads.py.
+    :return tuple (True, length) if the result went into the segment, (False, result)
+                  if it is sent back pickled
+    '''
+    result = fn(*args)
+
+    if not isinstance(result, (bytes, bytearray, memoryview)):
+        return (False, result)
+
+    data = memoryview(result).cast("B")
+    if data.nbytes > capacity:
+        return (False, result)
+
+    segment = _attach(name)
+    try:
+        segment.buf[:data.nbytes] = data
+    finally:
+        segment.close()
+
+    return (True, data.nbytes)
+
+
+class SharedResult:
+    '''
+    A result as a memoryview, over a shared memory segment or the unpickled bytes
+    '''
+
+    def __init__(self, pool=None, segment=None, length=0, data=None):
+        self.pool = pool
+        self.segment = segment
+        self.view = segment.buf[:length] if segment is not None else memoryview(data if data is not None else b"")
+
+    def __len__(self):
+        return self.view.nbytes
+
+    @property
+    def shared(self):
+        '''
+        :return bool True if the result is in shared memory
+        '''
+        return self.segment is not None
+
+    def chunks(self, size):
+        '''
+        :size int Bytes per chunk.
+        :return generator of memoryview slices, no copies
+        '''
+        for start in range(0, self.view.nbytes, size):
+            yield self.view[start:start + size]
+
+    def release(self, reuse=True):
+        '''
+        Done with the result
+
+        :reuse bool False if slices of view may still be in use, the segment is
+                    unlinked instead of going back to the pool.
+        '''
+        if self.segment is None:
+            return
+        if reuse:
+            self.view.release()
+            self.pool.release(self.segment)
+        else:
+            self.pool.discard(self.segment)
+        self.segment = None
+
+
+class SegmentPool:
+    '''
+    Shared memory segments by size class, reused between results
+    '''
+
+    def __init__(self, threshold=64 * 1024, min_size=64 * 1024, max_size=64 * 1024 * 1024, keep=4, enabled=True):
+        '''
+        :threshold int Results expected to be smaller come back pickled.
+        :min_size int Smallest segment.
+        :max_size int Largest segment, larger results come back pickled.
+        :keep int Released segments kept per size class.
+        :enabled bool False to always use the pickled path.
+        '''
+        self.threshold = threshold
+        self.min_size = min_size
+        self.max_size = max_size
+        self.keep = keep
+        self.enabled = enabled and available
+        if self.enabled:
+            # workers forked from here on share this process's resource tracker, one
+            # started by a worker would report the segments it opened as leaked
+            resource_tracker.ensure_running()
+        self.free = {} # size class -> list of segments
+        self.in_use = {} # name -> (size class, segment)
+        self.lingering = [] # unlinked, but views of them were still around to close
+        self.created = 0
+        self.reused = 0
+        self.unlinked = 0
+        self.shared_results = 0
+        self.pickled_results = 0
+        self.overflows = 0 # results that did not fit their segment
+
+    def size_class(self, size):
+        '''
+        :size int
+        :return int The smallest segment size that holds size bytes
+        '''
+        cls = self.min_size
+        while cls < size:
+            cls *= 2
+        return cls
+
+    def allocate(self, size):
+        '''
+        :size int Bytes needed.
+        :return shared_memory.SharedMemory
+        :raises ValueError if size is over max_size
+        '''
+        if size > self.max_size:
+            raise ValueError("{} bytes is over the {} byte segment limit".format(size, self.max_size))
+
+        if self.lingering:
+            self._close_lingering()
+
+        cls = self.size_class(size)
+        free = self.free.get(cls)
+        if free:
+            segment = free.pop()
+            self.reused += 1
+        else:
+            segment = shared_memory.SharedMemory(create=True, size=cls)
+            self.created += 1
+
+        self.in_use[segment.name] = (cls, segment)
+        return segment
+
+    def release(self, segment):
+        '''
+        Give a segment back for reuse
+        '''
+        cls, segment = self.in_use.pop(segment.name)
+        free = self.free.setdefault(cls, [])
+        if len(free) < self.keep:
+            free.append(segment)
+        else:
+            self._unlink(segment)
+
+    def discard(self, segment):
+        '''
+        Unlink a segment that must not be reused
+        '''
+        self.in_use.pop(segment.name, None)
+        self._unlink(segment)
+
+    def _unlink(self, segment):
+        segment.unlink()
+        self.unlinked += 1
+        try:
+            segment.close()
+        except BufferError:
+            # a view of it is still around, e.g. in a transport's buffer
+            self.lingering.append(segment)
+
+    def _close_lingering(self):
+        lingering = self.lingering
+        self.lingering = []
+        for segment in lingering:
+            try:
+                segment.close()
+            except BufferError:
+                self.lingering.append(segment)
+
+    async def run(self, submit, size, fn, *args):
+        '''
+        Run fn(*args) in a process pool, its bytes result through a segment
+
+        :submit callable submit(fn, *args) starts the work in a process pool and
+                returns an awaitable for its result, e.g. a job's future.
+        :size int Expected result size in bytes.
+        :fn callable Returns bytes, must be picklable.
+        :return SharedResult release() it when done with it
+        '''
+        if not self.enabled or size < self.threshold or size > self.max_size:
+            self.pickled_results += 1
+            return SharedResult(data=await submit(fn, *args))
+
+        segment = self.allocate(size)
+        try:
+            stored, value = await submit(into_segment, segment.name, self.size_class(size), fn, *args)
+        except BaseException:
+            self.discard(segment)
+            raise
+
+        if not stored:
+            self.release(segment)
+            self.overflows += 1
+            self.pickled_results += 1
+            return SharedResult(data=value)
+
+        self.shared_results += 1
+        return SharedResult(self, segment, value)
+
+    def close(self):
+        '''
+        Unlink every segment, at shutdown
+        '''
+        for free in self.free.values():
+            for segment in free:
+                self._unlink(segment)
+        self.free = {}
+
+        for cls, segment in list(self.in_use.values()):
+            self._unlink(segment)
+        self.in_use = {}
+
+        self._close_lingering()
+
+        logging.info("shmresult - closed, {} segment(s) created, {} reused".format(self.created, self.reused))
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        free = sum(len(segments) for segments in self.free.values())
+        return {
+            "enabled": self.enabled,
+            "segments_free": free,
+            "segments_in_use": len(self.in_use),
+            "segments_lingering": len(self.lingering),
+            "bytes_mapped": sum(cls * len(segments) for cls, segments in self.free.items()) +
+                            sum(cls for cls, segment in self.in_use.values()),
+            "created": self.created,
+            "reused": self.reused,
+            "unlinked": self.unlinked,
+            "shared_results": self.shared_results,
+            "pickled_results": self.pickled_results,
+            "overflows": self.overflows
+        }
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+#
+# In-memory cache for the static pages served by the web servers
+#
+# Each page is read from disk once and kept in memory together with pre-compressed
+# gzip (and brotli, if the module is installed) bodies and a strong ETag per
+# encoding. The file mtime is re-checked at most every check_interval seconds. The
+# check and any reload run in the default executor, so GET / never does blocking
+# file I/O on the event loop thread. Concurrent requests for a path share one
+# check / load in flight.
+#
+
+import os
+import gzip
+import time
+import asyncio
+import hashlib
+import logging
+
+from aiohttp import web
+
+# brotli is optional, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class StaticEntry:
+    '''
+    One cached file, all of its encoded bodies and their ETags
+    '''
+
+    def __init__(self, path, mtime, size, body):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.checked_on = time.monotonic()
+
+        digest = hashlib.sha1(body).hexdigest()[:20]
+
+        # encoding -> (body, etag), identity is always present
+        self.bodies = {
+            "identity": (body, '"{}"'.format(digest)),
+            "gzip": (gzip.compress(body, 9), '"{}-gz"'.format(digest))
+        }
+
+        if brotli is not None:
+            self.bodies["br"] = (brotli.compress(body), '"{}-br"'.format(digest))
+
+
+class StaticCache:
+    '''
+    Cache of static files keyed by path
+    '''
+
+    # preferred order when the client accepts several encodings
+    encodings = ("br", "gzip")
+
+    def __init__(self, check_interval=1.0, min_compress_size=256):
+        '''
+        :check_interval float Minimum seconds between mtime checks of a cached file.
+        :min_compress_size int Bodies smaller than this are always sent as identity.
+        '''
+        self.check_interval = check_interval
+        self.min_compress_size = min_compress_size
+        self.entries = {}
+        self.loading = {} # path -> future of the check / load in flight
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def _load(self, path):
+        '''
+        Read a file and build its cache entry. Blocking, runs in an executor.
+
+        :path string
+        :return StaticEntry
+        '''
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            body = f.read()
+        return StaticEntry(path, st.st_mtime, st.st_size, body)
+
+    def _refresh(self, path, entry):
+        '''
+        Load a file, or reload it if it changed on disk since it was cached.
+        Blocking, runs in an executor.
+
+        :path string
+        :entry StaticEntry The cached entry, None if there is none.
+        :return tuple (StaticEntry, bool True if the file was read)
+        '''
+        if entry is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                # keep serving the cached copy if the file went away
+                return entry, False
+            if st.st_mtime == entry.mtime and st.st_size == entry.size:
+                return entry, False
+
+        return self._load(path), True
+
+    async def _check(self, path, entry):
+        '''
+        :path string
+        :entry StaticEntry or None
+        :return StaticEntry
+        '''
+        loop = asyncio.get_event_loop()
+        try:
+            entry, loaded = await loop.run_in_executor(None, self._refresh, path, entry)
+        finally:
+            del self.loading[path]
+
+        entry.checked_on = time.monotonic()
+        self.entries[path] = entry
+
+        if loaded:
+            logging.info("static_cache - loaded {} ({} bytes)".format(path, entry.size))
+
+        return entry
+
+    async def get(self, path):
+        '''
+        Get the cache entry for path, loading or reloading it if needed.
+
+        :path string
+        :return StaticEntry
+        '''
+        entry = self.entries.get(path)
+
+        if entry is not None and time.monotonic() - entry.checked_on < self.check_interval:
+            self.hits += 1
+            return entry
+
+        future = self.loading.get(path)
+        if future is None:
+            future = self.loading[path] = asyncio.ensure_future(self._check(path, entry))
+
+        # shielded: one waiter going away must not cancel the load for the others
+        checked = await asyncio.shield(future)
+
+        if checked is entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        return checked
+
+    def choose_encoding(self, entry, accept_encoding):
+        '''
+        Pick the best available encoding for an Accept-Encoding header.
+
+        :entry StaticEntry
+        :accept_encoding string
+        :return string
+        '''
+        if not accept_encoding or entry.size < self.min_compress_size:
+            return "identity"
+
+        accepted = {}
+        for token in accept_encoding.split(","):
+            name, _, params = token.strip().partition(";")
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            accepted[name.strip().lower()] = q
+
+        for encoding in self.encodings:
+            if encoding in entry.bodies and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+                return encoding
+
+        return "identity"
+
+    async def response(self, request, path, content_type='text/html'):
+        '''
+        Build a response for a cached file, honouring If-None-Match and Accept-Encoding.
+
+        :request web.Request
+        :path string
+        :content_type string
+        :return web.Response
+        '''
+        entry = await self.get(path)
+
+        encoding = self.choose_encoding(entry, request.headers.get("Accept-Encoding"))
+        body, etag = entry.bodies[encoding]
+
+        headers = {
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache"
+        }
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            # If-None-Match uses weak comparison, so a W/ prefix still matches
+            tags = [t.strip().replace("W/", "", 1) for t in if_none_match.split(",")]
+            if "*" in tags or etag in tags:
+                self.not_modified += 1
+                return web.Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        return web.Response(body=body, content_type=content_type, charset='utf-8', headers=headers)
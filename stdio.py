@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#
+# STDIN / STDOUT pipeline on the event loop
+#
+# STDIN is read in chunks of up to chunk_size bytes through a non-blocking pipe
+# reader (loop.connect_read_pipe()) instead of a thread looping over sys.stdin.
+# The complete lines of each chunk are handed to a callback as one batch, and what
+# it returns is written to STDOUT in one write through a non-blocking pipe writer.
+# When more than high_water bytes are waiting to go out the pipeline stops reading
+# until the pipe drains, so a slow consumer slows the producer down instead of
+# filling memory.
+#
+# The event loop can't watch regular files or character devices such as /dev/null
+# (epoll refuses them) and a terminal's STDIN and STDOUT share their non-blocking
+# flag with everything else using the terminal. In those cases reads and writes
+# are blocking calls run in the loop's default executor, still a chunk at a time.
+# Output to a terminal is written after every batch. Reads from a terminal can
+# block until the user types, and interpreter exit waits for the default
+# executor's threads, so a terminal is read by a daemon thread of its own that
+# hands each chunk to the loop, exit never waits for it.
+#
+# STDIN and STDOUT are set back to blocking once the pipeline is done, print()
+# works as before.
+#
+
+import os
+import sys
+import stat
+import time
+import asyncio
+import logging
+import threading
+
+# a line longer than this without a newline is passed on as it is
+max_line = 1024 * 1024
+
+
+def _watchable(fileobj):
+    '''
+    :return bool True if the event loop can watch the file's descriptor
+    '''
+    try:
+        fd = fileobj.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    if os.isatty(fd):
+        return False
+    mode = os.fstat(fd).st_mode
+    # pipes and sockets. Not regular files, nor character devices such as /dev/null
+    # (the STDIN of daemons), epoll refuses them too.
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+
+def _isatty(fileobj):
+    try:
+        return os.isatty(fileobj.fileno())
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+class ExecutorReader:
+    '''
+    Blocking reads in the default executor, for files the loop can't watch
+    '''
+
+    def __init__(self, fileobj, loop):
+        self.file = fileobj.buffer if hasattr(fileobj, "buffer") else fileobj
+        self.loop = loop
+
+    async def read(self, n):
+        return await self.loop.run_in_executor(None, self.file.read1, n)
+
+    def close(self):
+        pass
+
+
+class ThreadReader:
+    '''
+    Blocking reads in a daemon thread, for terminals
+    '''
+
+    def __init__(self, fileobj, loop, chunk_size, ahead=2):
+        '''
+        :fileobj
+        :loop asyncio event loop The chunks are handed to.
+        :chunk_size int
+        :ahead int Chunks read before read() asks for them.
+        '''
+        # os.read() on a descriptor of its own: a daemon thread blocked in the
+        # file object's read would hold its lock at interpreter shutdown
+        self.fd = os.dup(fileobj.fileno())
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.chunks = asyncio.Queue()
+        self.slots = threading.Semaphore(ahead)
+        # guards closed and reading: the descriptor is closed by close() unless a
+        # read is in progress, then by the thread once the read returns
+        self.lock = threading.Lock()
+        self.closed = False
+        self.reading = False
+        self.thread = threading.Thread(target=self._run, name="stdio reader", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.slots.acquire()
+            with self.lock:
+                if self.closed:
+                    return
+                self.reading = True
+            try:
+                data = os.read(self.fd, self.chunk_size)
+            except OSError as e:
+                logging.info("stdio - read failed: {}".format(e))
+                data = b""
+            with self.lock:
+                self.reading = False
+                if self.closed:
+                    os.close(self.fd)
+                    return
+            try:
+                self.loop.call_soon_threadsafe(self.chunks.put_nowait, data)
+            except RuntimeError:
+                # the loop is closed
+                break
+            if not data:
+                break
+        self.close()
+
+    async def read(self, n):
+        # n is chunk_size, the thread reads ahead with it
+        data = await self.chunks.get()
+        if data:
+            self.slots.release()
+        return data
+
+    def close(self):
+        # a read in progress is left blocked, the thread is a daemon
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if not self.reading:
+                os.close(self.fd)
+        self.slots.release()
+
+
+class PipeReader:
+    '''
+    A StreamReader on a non-blocking pipe
+    '''
+
+    def __init__(self, stream, transport):
+        self.stream = stream
+        self.transport = transport
+
+    async def read(self, n):
+        return await self.stream.read(n)
+
+    def close(self):
+        self.transport.close()
+
+
+class WriteProtocol(asyncio.Protocol):
+    '''
+    Flow control for a write pipe: drain() waits while the transport is paused
+    '''
+
+    def __init__(self):
+        self.paused = False
+        self.waiter = None
+        self.closed = False
+        self.lost = asyncio.get_event_loop().create_future()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._wake()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._wake()
+        if not self.lost.done():
+            self.lost.set_result(exc)
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+        self.waiter = None
+
+    async def drain(self):
+        if self.paused and not self.closed:
+            self.waiter = asyncio.get_event_loop().create_future()
+            await self.waiter
+
+
+class PipeWriter:
+    '''
+    Writes to a non-blocking pipe, drain() applies the backpressure
+    '''
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    def write(self, data):
+        if not self.protocol.closed:
+            self.transport.write(data)
+
+    async def drain(self):
+        await self.protocol.drain()
+
+    async def close(self):
+        # the transport writes out its buffer before it closes
+        self.transport.close()
+        await self.protocol.lost
+
+    def abort(self):
+        self.transport.abort()
+
+
+class ExecutorWriter:
+    '''
+    Buffers writes and hands them to the default executor every high_water bytes,
+    or at every drain() on a terminal, where the user waits for each line
+    '''
+
+    def __init__(self, fileobj, loop, high_water):
+        self.file = fileobj.buffer if hasattr(fileobj, "buffer") else fileobj
+        self.loop = loop
+        self.high_water = high_water
+        self.interactive = _isatty(fileobj)
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+
+    async def drain(self):
+        if self.buffered >= self.high_water or (self.interactive and self.buffered):
+            await self.flush()
+
+    async def flush(self):
+        if self.buffer:
+            data = b"".join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            await self.loop.run_in_executor(None, self._write, data)
+
+    def _write(self, data):
+        self.file.write(data)
+        self.file.flush()
+
+    async def close(self):
+        await self.flush()
+
+    def abort(self):
+        self.buffer = []
+        self.buffered = 0
+
+
+async def open_reader(fileobj, chunk_size):
+    '''
+    :fileobj The file to read, e.g. sys.stdin.
+    :chunk_size int Read buffer size.
+    :return PipeReader, ThreadReader or ExecutorReader
+    '''
+    loop = asyncio.get_event_loop()
+    if _isatty(fileobj):
+        return ThreadReader(fileobj, loop, chunk_size)
+    if _watchable(fileobj):
+        stream = asyncio.StreamReader(limit=chunk_size)
+        protocol = asyncio.StreamReaderProtocol(stream)
+        try:
+            transport, protocol = await loop.connect_read_pipe(lambda: protocol, os.fdopen(os.dup(fileobj.fileno()), "rb", buffering=0))
+            return PipeReader(stream, transport)
+        except (ValueError, OSError, NotImplementedError) as e:
+            logging.info("stdio - {} not watchable ({}), reading in the executor".format(fileobj.name, e))
+    return ExecutorReader(fileobj, loop)
+
+
+async def open_writer(fileobj, high_water):
+    '''
+    :fileobj The file to write, e.g. sys.stdout.
+    :high_water int Bytes buffered before writers have to wait.
+    :return PipeWriter or ExecutorWriter
+    '''
+    loop = asyncio.get_event_loop()
+    fileobj.flush()
+    if _watchable(fileobj):
+        try:
+            transport, protocol = await loop.connect_write_pipe(WriteProtocol, os.fdopen(os.dup(fileobj.fileno()), "wb", buffering=0))
+            transport.set_write_buffer_limits(high=high_water)
+            return PipeWriter(transport, protocol)
+        except (ValueError, OSError, NotImplementedError) as e:
+            logging.info("stdio - {} not watchable ({}), writing in the executor".format(fileobj.name, e))
+    return ExecutorWriter(fileobj, loop, high_water)
+
+
+async def pipeline(on_lines, chunk_size=64 * 1024, high_water=256 * 1024, stdin=None, stdout=None, output=True):
+    '''
+    Read stdin to EOF, pass each chunk's complete lines to on_lines() and write what
+    it returns to stdout
+
+    :on_lines callable on_lines(list of string) returns a string to write, or None.
+                       Lines are decoded as UTF-8 and have no line ending.
+    :chunk_size int Bytes read at a time.
+    :high_water int Output bytes buffered before reading pauses.
+    :stdin Default sys.stdin.
+    :stdout Default sys.stdout.
+    :output bool False if on_lines() never returns anything, stdout is left alone.
+    :return dict lines, bytes, batches, seconds
+    '''
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+
+    reader = await open_reader(stdin, chunk_size)
+    writer = await open_writer(stdout, high_water) if output else ExecutorWriter(stdout, asyncio.get_event_loop(), high_water)
+
+    started = time.perf_counter()
+    stats = {"lines": 0, "bytes": 0, "batches": 0}
+    rest = b""
+
+    def batch(data):
+        lines = data.decode("utf-8", "replace").split("\n")
+        stats["lines"] += len(lines)
+        stats["batches"] += 1
+        text = on_lines(lines)
+        if text:
+            writer.write(text.encode("utf-8"))
+
+    done = False
+    try:
+        while True:
+            data = await reader.read(chunk_size)
+            if not data:
+                break
+            stats["bytes"] += len(data)
+
+            head, newline, rest = (rest + data).rpartition(b"\n")
+            if newline:
+                batch(head)
+            elif len(rest) > max_line:
+                batch(rest)
+                rest = b""
+
+            await writer.drain()
+
+        if rest:
+            batch(rest)
+        await writer.close()
+        done = True
+    finally:
+        reader.close()
+        if not done:
+            writer.abort()
+        for f in (stdin, stdout) if output else (stdin,):
+            if _watchable(f):
+                os.set_blocking(f.fileno(), True)
+
+    stats["seconds"] = time.perf_counter() - started
+    return stats
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+#
+# socket.io transport profile and per transport traffic counters
+#
+# A Profile holds the engine.io settings that decide what a connection costs:
+#
+#   - transports: websocket only skips the long-polling handshake and the HTTP
+#     requests of polling clients, the browser client is websocket only anyway
+#   - ping_interval / ping_timeout: how often engine.io pings each client and how
+#     long it waits for the pong before dropping the connection
+#   - compression_threshold: outgoing messages this size or larger are compressed,
+#     smaller ones go out as they are. 0 never compresses.
+#
+# engine.io applies the threshold to polling responses itself. On websocket
+# aiohttp's permessage-deflate compresses every frame once negotiated, so the
+# profile installs its own websocket class, which negotiates it but compresses
+# only the frames at or above the threshold. That takes two private hooks, the
+# engine.io driver table and the aiohttp frame writer, tested with python-engineio
+# 4.14 and aiohttp 3.14 (see setup.py). Without them the stock websocket is used.
+#
+# TrafficStats counts messages and bytes by transport. A websocket message is one
+# frame (one engine.io packet), its bytes are the UTF-8 or binary payload before
+# compression. A polling message is one HTTP request or response body, a batch of
+# packets, its bytes are the body as sent.
+#
+
+import logging
+import functools
+
+from aiohttp import web
+from engineio.async_drivers import aiohttp as aiohttp_driver
+
+POLLING = "polling"
+WEBSOCKET = "websocket"
+
+TRANSPORTS = (POLLING, WEBSOCKET)
+
+
+class TrafficStats:
+    '''
+    Message and byte counts by transport
+    '''
+
+    def __init__(self):
+        self.counters = {name: {"messages_in": 0, "bytes_in": 0, "messages_out": 0, "bytes_out": 0, "compressed_out": 0}
+                         for name in TRANSPORTS}
+
+    def received(self, name, size):
+        '''
+        :name string POLLING or WEBSOCKET
+        :size int Bytes
+        :return None
+        '''
+        counters = self.counters[name]
+        counters["messages_in"] += 1
+        counters["bytes_in"] += size
+
+    def sent(self, name, size, compressed=False):
+        '''
+        :name string POLLING or WEBSOCKET
+        :size int Bytes
+        :compressed bool
+        :return None
+        '''
+        counters = self.counters[name]
+        counters["messages_out"] += 1
+        counters["bytes_out"] += size
+        if compressed:
+            counters["compressed_out"] += 1
+
+    def total(self, counter):
+        '''
+        :counter string e.g. "bytes_out"
+        :return dict transport -> count
+        '''
+        return {name: counters[counter] for name, counters in self.counters.items()}
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        return {name: dict(counters) for name, counters in self.counters.items()}
+
+
+def _size(message):
+    '''
+    :message string or bytes
+    :return int Bytes on the wire before compression, text is sent as UTF-8
+    '''
+    if isinstance(message, str) and not message.isascii():
+        return len(message.encode("utf-8"))
+    return len(message)
+
+
+class WebSocket(aiohttp_driver.WebSocket):
+    '''
+    engine.io's aiohttp websocket with a compression threshold and traffic counts
+    '''
+
+    def __init__(self, handler, server, threshold=0, traffic=None):
+        # the stock __call__ prepares the response, _prepared() runs before the handler
+        super().__init__(self._prepared, server)
+        self.engineio_handler = handler
+        self.threshold = threshold
+        self.traffic = traffic
+        self.wbits = 0 # permessage-deflate window bits, 0 when not negotiated
+
+    async def _prepared(self, ws):
+        # as negotiated the writer compresses every frame: keep the window bits and
+        # turn that off, send() asks for compression frame by frame instead. The
+        # writer is private, without it every frame stays compressed.
+        writer = getattr(self._sock, "_writer", None)
+        if self._sock.compress and isinstance(getattr(writer, "compress", None), int):
+            self.wbits = self._sock.compress
+            writer.compress = 0
+
+        await self.engineio_handler(ws)
+
+    async def send(self, message):
+        size = _size(message)
+        compress = self.wbits if self.wbits and self.threshold and size >= self.threshold else None
+
+        if isinstance(message, bytes):
+            await self._sock.send_bytes(message, compress=compress)
+        else:
+            await self._sock.send_str(message, compress=compress)
+
+        if self.traffic is not None:
+            self.traffic.sent(WEBSOCKET, size, compress is not None)
+
+    async def wait(self):
+        data = await super().wait()
+        if self.traffic is not None:
+            self.traffic.received(WEBSOCKET, _size(data))
+        return data
+
+
+class Profile:
+    '''
+    Transport settings for a socketio.AsyncServer
+    '''
+
+    def __init__(self, transports=(WEBSOCKET,), ping_interval=25, ping_timeout=20, compression_threshold=1024):
+        '''
+        :transports tuple Of POLLING and WEBSOCKET, the transports clients may use.
+        :ping_interval float Seconds between engine.io pings.
+        :ping_timeout float Seconds to wait for a pong.
+        :compression_threshold int Smallest message compressed, in bytes. 0 to never compress.
+        '''
+        for name in transports:
+            if name not in TRANSPORTS:
+                raise ValueError("unknown transport {}, use {}".format(name, " and/or ".join(TRANSPORTS)))
+
+        self.transports = tuple(transports)
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.compression_threshold = compression_threshold
+
+    def server_options(self):
+        '''
+        :return dict socketio.AsyncServer() keyword arguments
+        '''
+        return {
+            "transports": list(self.transports),
+            "ping_interval": self.ping_interval,
+            "ping_timeout": self.ping_timeout,
+            "http_compression": self.compression_threshold > 0,
+            "compression_threshold": self.compression_threshold
+        }
+
+    def install(self, sio, traffic):
+        '''
+        Use the profile's websocket class on sio and count polling traffic. Call
+        before the app is started.
+
+        :sio socketio.AsyncServer Created with server_options(), attached to an aiohttp app.
+        :traffic TrafficStats
+        :return aiohttp middleware Add it to the app's middlewares for the polling counts.
+        '''
+        # engine.io looks its websocket class up in the driver's table, replace it in
+        # a copy so other servers keep the stock one. The table is private: if it is
+        # not the one this was written against the stock class stays, websocket
+        # frames are not counted and all of them are compressed.
+        table = getattr(sio.eio, "_async", None)
+        if isinstance(table, dict) and table.get("websocket") is aiohttp_driver.WebSocket:
+            websocket = functools.partial(WebSocket, threshold=self.compression_threshold, traffic=traffic)
+            sio.eio._async = dict(table, websocket=websocket)
+        else:
+            logging.info("transport - unknown engine.io driver, using its websocket as it is")
+
+        return polling_middleware(traffic)
+
+
+def polling_middleware(traffic, path="/socket.io/"):
+    '''
+    aiohttp middleware counting the long-polling requests and responses
+
+    The request bodies are engine.io's to read, they are counted by their
+    Content-Length.
+
+    :traffic TrafficStats
+    :path string The socket.io endpoint.
+    :return aiohttp middleware
+    '''
+    @web.middleware
+    async def middleware(request, handler):
+        if not request.path.startswith(path) or request.query.get("transport") != POLLING:
+            return await handler(request)
+
+        if request.method == "POST":
+            traffic.received(POLLING, request.content_length or 0)
+
+        response = await handler(request)
+
+        if request.method == "GET" and isinstance(response, web.Response) and response.body is not None:
+            traffic.sent(POLLING, len(response.body), "Content-Encoding" in response.headers)
+
+        return response
+
+    return middleware
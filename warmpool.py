@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# Pre-warmed, self-healing process pool
+#
+# A ProcessPoolExecutor starts its workers as work arrives, so the first cpu-bound
+# requests after startup pay for spawning a process and its imports. And when a
+# worker dies (killed, out of memory, a crash in an extension module) the whole
+# executor is broken: the jobs in it fail and so does every later submit.
+#
+# A WarmProcessPool is an Executor around a ProcessPoolExecutor, a generation, that
+#
+#   - starts every worker in warm(), each running `initializer` first, e.g.
+#     workloads.preload() to import heavy modules and build read-only data
+#   - with the forkserver start method imports the `preload` modules once in the
+#     fork server, new workers start with them already loaded
+#   - checks the workers every `interval` seconds from the event loop and replaces
+#     a broken generation, or one with a dead worker, warming the new one in a
+#     thread. A submit to a broken generation replaces it on the spot.
+#   - keeps the latency (submit to result) of jobs submitted while a generation
+#     was still starting (cold) apart from the rest (warm), and the start up time
+#     of every generation
+#
+# Jobs in a generation when it breaks fail with BrokenProcessPool, there is no
+# telling which of them the dead worker had.
+#
+# Replacing forks new workers while other threads run. With the "fork" start
+# method that can deadlock a worker (see dispatcher.Dispatcher.warm()), use
+# "forkserver" or "spawn" for replacement to be safe.
+#
+
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+import workloads
+
+
+class WarmProcessPool(concurrent.futures.Executor):
+    '''
+    A ProcessPoolExecutor started up front and replaced when a worker dies
+    '''
+
+    # warm_up() sleeps this long so the warm up jobs land on different workers
+    warm_up_secs = 0.05
+
+    def __init__(self, max_workers, initializer=None, initargs=(), start_method=None, preload=(), interval=5.0):
+        '''
+        :max_workers int
+        :initializer callable Run in each worker before its first job, must be picklable.
+        :initargs tuple
+        :start_method string "fork", "forkserver", "spawn" or None for the platform's
+                      default. Falls back to the default when not available.
+        :preload tuple Module names the fork server imports, forkserver only.
+        :interval float Seconds between health checks.
+        '''
+        if start_method is not None and start_method not in multiprocessing.get_all_start_methods():
+            logging.info("warmpool - start method {} not available, using the default".format(start_method))
+            start_method = None
+
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.interval = interval
+        self.context = multiprocessing.get_context(start_method)
+        if preload and self.context.get_start_method() == "forkserver":
+            self.context.set_forkserver_preload(list(preload))
+
+        # guards the generation and the latency stats: submit() runs on the event
+        # loop, warming in a thread, future callbacks in the executor's thread
+        self.lock = threading.Lock()
+        self.executor = None
+        self.generation = 0
+        self.ready = False # every worker of the generation is up
+        self.warming = False
+        self.pids = set()
+
+        self.task = None
+        self.checks = 0
+        self.replacements = 0
+        self.last_startup = None # seconds, the current generation's
+        self.startup = metrics.LatencyStats()
+        self.cold_latency = metrics.LatencyStats()
+        self.warm_latency = metrics.LatencyStats()
+
+    @property
+    def start_method(self):
+        return self.context.get_start_method()
+
+    def _new_executor(self):
+        options = {"max_workers": self.max_workers, "mp_context": self.context}
+        if self.initializer is not None:
+            options["initializer"] = self.initializer
+            options["initargs"] = self.initargs
+        return concurrent.futures.ProcessPoolExecutor(**options)
+
+    def _replace(self, broken):
+        '''
+        Swap in a new generation if broken is still the current one, its workers
+        start as work arrives until it is warmed
+
+        :broken concurrent.futures.ProcessPoolExecutor
+        :return concurrent.futures.ProcessPoolExecutor The current generation
+        '''
+        with self.lock:
+            if self.executor is broken:
+                self.executor = self._new_executor()
+                self.generation += 1
+                self.ready = False
+                self.pids = set()
+                self.last_startup = None
+                if broken is not None:
+                    self.replacements += 1
+            executor = self.executor
+
+        if executor is not broken and broken is not None:
+            logging.info("warmpool - replaced a broken pool, generation {}".format(self.generation))
+            broken.shutdown(wait=False)
+
+        return executor
+
+    def warm(self):
+        '''
+        Start a generation if there is none and every one of its workers. Blocks.
+
+        :return bool False if the generation broke while starting
+        '''
+        if self.executor is None:
+            self._replace(None)
+
+        with self.lock:
+            if self.warming or self.ready:
+                return self.ready
+            self.warming = True
+            executor, generation = self.executor, self.generation
+
+        started = time.monotonic()
+        try:
+            futures = [executor.submit(workloads.warm_up, self.warm_up_secs) for i in range(self.max_workers)]
+            pids = set(f.result()[0] for f in futures)
+        except BrokenProcessPool as e:
+            logging.info("warmpool - generation {} broke while starting: {}".format(generation, e))
+            with self.lock:
+                self.warming = False
+            return False
+
+        secs = max(0.0, time.monotonic() - started - self.warm_up_secs)
+
+        with self.lock:
+            self.warming = False
+            if self.generation == generation:
+                self.ready = True
+                self.pids = pids
+                self.last_startup = secs
+            self.startup.add(secs)
+
+        logging.info("warmpool - generation {} warm, {} worker(s) in {:.3f}s ({})".format(
+            generation, len(pids), secs, self.start_method))
+        return True
+
+    def healthy(self):
+        '''
+        :return bool False if the generation is broken or a worker died
+        '''
+        executor = self.executor
+        if executor is None:
+            return False
+        # neither is public, but there is no other way to ask
+        if getattr(executor, "_broken", False):
+            return False
+        processes = getattr(executor, "_processes", None) or {}
+        return all(process.is_alive() for process in list(processes.values()))
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            executor, cold = self.executor, not self.ready
+
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            executor, cold = self._replace(executor), True
+            try:
+                future = executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool as e:
+                # fail the job, not the caller dispatching it
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+                return future
+
+        submitted = time.monotonic()
+        latency = self.cold_latency if cold else self.warm_latency
+
+        def done(f):
+            with self.lock:
+                latency.add(time.monotonic() - submitted)
+
+        future.add_done_callback(done)
+        return future
+
+    def start_monitor(self):
+        '''
+        Run the health checks on the current event loop
+
+        :return None
+        '''
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._monitor())
+
+    def stop_monitor(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _monitor(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await asyncio.sleep(self.interval)
+            self.checks += 1
+
+            if not self.healthy():
+                logging.info("warmpool - generation {} unhealthy, replacing it".format(self.generation))
+                self._replace(self.executor)
+
+            if not self.ready and not self.warming:
+                await loop.run_in_executor(None, self.warm)
+
+    def shutdown(self, wait=True, **kwargs):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+
+    def stats(self):
+        '''
+        :return dict
+        '''
+        with self.lock:
+            return {
+                "start_method": self.start_method,
+                "generation": self.generation,
+                "ready": self.ready,
+                "pids": sorted(self.pids),
+                "checks": self.checks,
+                "replacements": self.replacements,
+                "startup_secs": self.last_startup,
+                "startup": self.startup.stats(),
+                "cold": self.cold_latency.stats(),
+                "warm": self.warm_latency.stats()
+            }
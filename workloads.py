@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# Work functions for the executors
+#
+# Everything here must be importable by name so it can be pickled into a
+# ProcessPoolExecutor worker, which rules out defining them in asyncwebserver.2.py.
+#
+
+import os
+import hashlib
+import importlib
+import time
+import threading
+
+# make_blob() data blocks by seed, built on first use or by preload()
+_blob_blocks = {}
+
+
+def preload(modules=(), blob_seeds=(0,)):
+    '''
+    Process pool initializer: import modules and build read-only data before the
+    worker takes its first job.
+
+    :modules tuple Module names.
+    :blob_seeds tuple The make_blob() seeds to build the data of.
+    :return None
+    '''
+    for name in modules:
+        importlib.import_module(name)
+    for seed in blob_seeds:
+        _blob_block(seed)
+
+
+def warm_up(secs=0.05):
+    '''
+    No-op used to start a pool worker before real work arrives.
+
+    Sleeps a little so that concurrent warm up calls land on different workers.
+
+    :secs float
+    :return tuple The worker's (pid, thread id)
+    '''
+    time.sleep(secs)
+    return (os.getpid(), threading.get_ident())
+
+
+def count_primes(n):
+    '''
+    CPU-bound work: count the primes below n by trial division.
+
+    :n int
+    :return int
+    '''
+    count = 0
+    for i in range(2, n):
+        j = 2
+        while j * j <= i:
+            if i % j == 0:
+                break
+            j += 1
+        else:
+            count += 1
+    return count
+
+
+def sleep_for(secs):
+    '''
+    io-bound work: wait without using the CPU.
+
+    :secs float
+    :return float secs
+    '''
+    time.sleep(secs)
+    return secs
+
+
+def cpu_and_sleep(n, secs):
+    '''
+    Mixed work: count_primes(n) then sleep_for(secs).
+
+    :n int
+    :secs float
+    :return int
+    '''
+    count = count_primes(n)
+    time.sleep(secs)
+    return count
+
+
+def timed(fn, *args):
+    '''
+    Run fn(*args) and say when it ran.
+
+    time.monotonic() is system wide on Linux, so the times can be compared with the
+    submitting process's.
+
+    :fn callable A function from this module.
+    :return tuple (started, finished, pid, result)
+    '''
+    started = time.monotonic()
+    result = fn(*args)
+    return (started, time.monotonic(), os.getpid(), result)
+
+
+def echo_size(payload):
+    '''
+    Receive a payload and return a payload of the same size, to time argument and
+    result transfer.
+
+    :payload bytes
+    :return bytes
+    '''
+    return bytes(len(payload))
+
+
+def make_blob(size, seed=0):
+    '''
+    A large result: size bytes of hashed data, to time result transfer.
+
+    :size int
+    :seed int Same seed, same bytes.
+    :return bytes
+    '''
+    block = _blob_block(seed)
+    return (block * (size // len(block) + 1))[:size]
+
+
+def _blob_block(seed):
+    '''
+    :return bytes 64KB of hashed data
+    '''
+    block = _blob_blocks.get(seed)
+    if block is None:
+        block = _blob_blocks[seed] = hashlib.sha256(str(seed).encode()).digest() * 2048
+    return block